@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Calls/sec and latency of a client/server pair, with and without batching.
+
+Usage: python bench/bench_batching.py [-d SECONDS] [-c 1,10,100]
+
+For each concurrency level, that many greenlets call a trivial method in a
+loop, over a single client socket, for the given duration.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import argparse
+
+import gevent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zerorpc  # noqa
+
+
+def run(concurrency, duration, batching):
+    endpoint = 'ipc:///tmp/zerorpc_bench_batching_{0}'.format(os.getpid())
+
+    class Srv(zerorpc.Server):
+
+        def add(self, a, b):
+            return a + b
+
+    srv = Srv(heartbeat=None)
+    srv.bind(endpoint)
+    client = zerorpc.Client(heartbeat=None)
+    if batching is not None:
+        srv.enable_batching(delay=batching)
+        client.enable_batching(delay=batching)
+    client.connect(endpoint)
+    srv_task = gevent.spawn(srv.run)
+    client.add(1, 2)
+
+    latencies = []
+    stop = time.time() + duration
+
+    def caller():
+        while time.time() < stop:
+            start = time.time()
+            client.add(1, 2)
+            latencies.append(time.time() - start)
+
+    gevent.joinall([gevent.spawn(caller) for _ in range(concurrency)])
+    client.close()
+    srv_task.kill()
+    srv.close()
+
+    latencies.sort()
+    return (len(latencies) / duration,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--duration', type=float, default=2)
+    parser.add_argument('-c', '--concurrency', default='1,10,100')
+    args = parser.parse_args()
+
+    modes = (('off', None), ('delay=0', 0), ('delay=1ms', 0.001))
+    print('{0:>11} {1:<10} {2:>10} {3:>9} {4:>9}'.format(
+        'concurrency', 'batching', 'calls/s', 'p50 ms', 'p99 ms'))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        for (label, delay) in modes:
+            (rate, p50, p99) = run(concurrency, args.duration, delay)
+            print('{0:>11} {1:<10} {2:>10.0f} {3:>9.2f} {4:>9.2f}'.format(
+                concurrency, label, rate, p50, p99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Throughput and bytes on the wire of the event compression.
+
+Usage: python bench/bench_compression.py [-n COUNT]
+
+For small, medium and large JSON-like payloads, packs and unpacks COUNT
+events with each available compressor, as one-off replies (OK) and as the
+items of a stream (STREAM, sharing a compression context).
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zerorpc  # noqa
+from zerorpc.compression import available_compressors  # noqa
+
+
+def payload(rows):
+    return [{u'id': i, u'user': u'user{0}'.format(i % 100),
+        u'status': u'active', u'score': i * 0.5,
+        u'tags': [u'alpha', u'beta', u'gamma']} for i in range(rows)]
+
+
+PAYLOADS = (
+    ('small', payload(2)),
+    ('medium', payload(100)),
+    ('large', payload(10000)),
+)
+
+
+def bench(compression, name, args, count):
+    context = zerorpc.Context()
+    sender = zerorpc.EventCodec(context)
+    sender.compression = compression
+    receiver = zerorpc.EventCodec(context)
+    peer_caps = receiver.capabilities
+    channel_id = context.new_msgid()
+
+    wire_bytes = 0
+    start = time.time()
+    for _ in range(count):
+        event = zerorpc.Event(name, (args,), context)
+        event.header[u'response_to'] = channel_id
+        (blob,) = sender.pack_frames(event, peer_caps)
+        wire_bytes += len(blob)
+        zerorpc.Event.unpack(blob, receiver).args
+    elapsed = time.time() - start
+    return (count / elapsed, wire_bytes / count)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    compressions = [None] + [c.name for c in available_compressors()]
+    print('{0:<8} {1:<8} {2:<7} {3:>12} {4:>14}'.format(
+        'payload', 'event', 'codec', 'events/s', 'bytes/event'))
+    for (label, value) in PAYLOADS:
+        count = max(1, args.count if label != 'large' else args.count // 100)
+        for name in (u'OK', u'STREAM'):
+            for compression in compressions:
+                (rate, size) = bench(compression, name, value, count)
+                print('{0:<8} {1:<8} {2:<7} {3:>12.0f} {4:>14.0f}'.format(
+                    label, name, compression or 'none', rate, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Events/sec of the event codec, and of a PUSH/PULL pair using it.
+
+Usage: python bench/bench_events.py [-n COUNT]
+
+The "legacy" lines reproduce the codec as it was before EventCodec (a new
+msgpack Packer/Unpacker per event), as a point of comparison.
+"""
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import argparse
+
+import msgpack
+import gevent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zerorpc  # noqa
+from zerorpc import zmq  # noqa
+
+
+def legacy_pack(event):
+    payload = (event.header, event.name, event.args)
+    return msgpack.Packer(use_bin_type=True).pack(payload)
+
+
+def legacy_unpack(blob):
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(blob)
+    (header, name, args) = unpacker.unpack()
+    return zerorpc.Event(name, args, None, header)
+
+
+def rate(label, count, fn):
+    start = time.time()
+    fn(count)
+    elapsed = time.time() - start
+    print('{0:<28} {1:>12.0f} events/s'.format(label, count / elapsed))
+
+
+def bench_codec(count):
+    context = zerorpc.Context()
+    codec = zerorpc.EventCodec(context)
+    event = zerorpc.Event(u'OK', (42,), context)
+    event.header[u'response_to'] = context.new_msgid()
+    blob = codec.pack(event)
+
+    def legacy_roundtrip(n):
+        for _ in range(n):
+            legacy_unpack(legacy_pack(event))
+
+    def codec_roundtrip(n):
+        for _ in range(n):
+            zerorpc.Event.unpack(codec.pack(event), codec)
+
+    def legacy_new_event(n):
+        for _ in range(n):
+            zerorpc.Event(u'OK', (42,), None,
+                {u'message_id': context.new_msgid(), u'v': 3})
+
+    rate('legacy pack+unpack', count, legacy_roundtrip)
+    rate('codec pack+unpack', count, codec_roundtrip)
+    rate('codec pack', count, lambda n: [codec.pack(event) for _ in range(n)])
+    rate('codec unpack', count, lambda n: [codec.unpack(blob) for _ in range(n)])
+    rate('new event', count, legacy_new_event)
+
+
+def bench_push_pull(count):
+    endpoint = 'inproc://bench_events'
+    puller = zerorpc.Events(zmq.PULL)
+    puller.bind(endpoint)
+    pusher = zerorpc.Events(zmq.PUSH, context=puller.context)
+    pusher.connect(endpoint)
+
+    def run(n):
+        def producer():
+            for i in range(n):
+                pusher.emit(u'myevent', (i,))
+        task = gevent.spawn(producer)
+        for _ in range(n):
+            puller.recv()
+        task.get()
+
+    rate('push/pull emit+recv', count, run)
+    pusher.close()
+    puller.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200000)
+    args = parser.parse_args()
+    bench_codec(args.count)
+    bench_push_pull(args.count // 10)
+
+
+if __name__ == '__main__':
+    main()
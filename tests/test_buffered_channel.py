@@ -437,7 +437,7 @@ def test_congestion_control_server_pushing():
             with pytest.raises(zerorpc.TimeoutExpired):
                 for x in range(2, 200):
                     server_bufchan.emit('coucou', x, timeout=0)  # will fail when x == 100
-        for x in range(read_cnt.value, 200):
+        for x in range(x, 200):
             server_bufchan.emit('coucou', x) # block until receiver is ready
         server_bufchan.close()
 
@@ -507,3 +507,177 @@ def test_on_close_if():
     server_bufchan.close()
     client.close()
     server.close()
+
+
+def test_bufchan_byte_budget():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    client_channel = client.channel()
+    client_bufchan = zerorpc.BufferedChannel(client_channel,
+            inqueue_size=100, inqueue_bytes=10 * 10000)
+    client_bufchan.emit('openthat', None)
+
+    event = server.recv()
+    server_channel = server.channel(event)
+    server_bufchan = zerorpc.BufferedChannel(server_channel)
+    server_bufchan.recv()
+
+    def server_do():
+        for x in range(50):
+            server_bufchan.emit('big', (x, b'x' * 10000))
+    server_task = gevent.spawn(server_do)
+
+    # The consumer is slow: never more than about 10 events of 10kB queued.
+    for x in range(50):
+        gevent.sleep(0.001)
+        assert client_bufchan.stats['queued'] <= 11
+        event = client_bufchan.recv()
+        assert event.args[0] == x
+        assert event.size > 10000
+    server_task.get()
+
+    assert client_bufchan.stats['window'] == 9
+    stats = server_bufchan.stats
+    assert stats['stalls'] > 0
+    assert stats['stall_time'] > 0
+    client_bufchan.close()
+    server_bufchan.close()
+    client.close()
+    server.close()
+
+
+def test_bufchan_byte_budget_bursts():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    client_channel = client.channel()
+    client_bufchan = zerorpc.BufferedChannel(client_channel,
+            inqueue_size=100, inqueue_bytes=10 * 10000)
+    client_bufchan.emit('openthat', None)
+
+    event = server.recv()
+    server_channel = server.channel(event)
+    server_bufchan = zerorpc.BufferedChannel(server_channel)
+    server_bufchan.recv()
+
+    # Bursts of large events, each after a run of small ones.
+    sizes = ([10] * 40 + [10000] * 20) * 3
+
+    def server_do():
+        for (x, size) in enumerate(sizes):
+            server_bufchan.emit('data', (x, b'x' * size))
+    server_task = gevent.spawn(server_do)
+
+    queued_bytes = []
+    for x in range(len(sizes)):
+        gevent.sleep(0.001)
+        queued_bytes.append(client_bufchan.stats['queued_bytes'])
+        event = client_bufchan.recv()
+        assert event.args[0] == x
+    server_task.get()
+
+    # Only the first burst overflows the budget.
+    assert max(queued_bytes[60:]) <= 12 * 10100
+    client_bufchan.close()
+    server_bufchan.close()
+    client.close()
+    server.close()
+
+
+def test_bufchan_adaptive_window():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    client_channel = client.channel()
+    client_bufchan = zerorpc.BufferedChannel(client_channel,
+            inqueue_size=1000, adaptive=True)
+    client_bufchan.emit('openthat', None)
+
+    event = server.recv()
+    server_channel = server.channel(event)
+    server_bufchan = zerorpc.BufferedChannel(server_channel)
+    server_bufchan.recv()
+
+    def server_do():
+        for x in range(300):
+            server_bufchan.emit('small', (x,))
+    server_task = gevent.spawn(server_do)
+
+    # A slow consumer on a fast link doesn't need a large window.
+    for x in range(300):
+        if x % 10 == 0:
+            gevent.sleep(0.01)
+        assert client_bufchan.recv().args[0] == x
+    server_task.get()
+
+    stats = client_bufchan.stats
+    assert stats['rtt'] is not None and stats['rate'] is not None
+    assert 2 <= stats['window'] < 1000
+    client_bufchan.close()
+    server_bufchan.close()
+    client.close()
+    server.close()
+
+
+def test_bufchan_overflow():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    # The client ignores the credits it is given.
+    client_channel = client.channel()
+    client_channel.emit('openthat', None)
+    event = server.recv()
+    server_channel = server.channel(event)
+    server_bufchan = zerorpc.BufferedChannel(server_channel, inqueue_size=5)
+    for x in range(10):
+        client_channel.emit('flood', (x,))
+    gevent.sleep(0.1)
+
+    # Closed on overflow, the reader is told after the queued events.
+    assert server_channel._channel_id is None
+    assert not server.active_channels
+    events = [server_bufchan.recv(timeout=1) for x in range(6)]
+    assert [e.name for e in events] == ['openthat'] + ['flood'] * 4 + ['ERR']
+    assert events[-1].args[0] == 'RuntimeError'
+
+    # A channel without flow control has a bounded queue too.
+    client_channel.close()
+    client_channel = client.channel()
+    client_channel.emit('openthat', None)
+    server_channel = server.channel(server.recv())
+    size = client_channel._inbox_size
+    for x in range(size + 1):
+        server_channel.emit('flood', (x,))
+    gevent.sleep(0.1)
+    assert not client.active_channels
+    events = [client_channel.recv(timeout=1) for x in range(size + 1)]
+    assert [e.args[0] for e in events[:-1]] == list(range(size))
+    assert events[-1].name == 'ERR'
+    server_channel.close()
+    server.close()
+    client.close()
@@ -27,6 +27,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import range
 
+import gevent
+
 from zerorpc import zmq
 import zerorpc
 from .testutils import teardown, random_ipc_endpoint
@@ -121,3 +123,82 @@ def test_events_channel_both_side():
     server_channel.close()
     client_channel.close()
     client_events.close()
+
+
+def test_channel_stack_push():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    client_channel = client.channel()
+    client_hbchan = zerorpc.HeartBeatOnChannel(client_channel, passive=True)
+    client_bufchan = zerorpc.BufferedChannel(client_hbchan)
+    # No greenlet reading each layer, and no per instance __dict__.
+    assert client_hbchan._recv_task is None
+    assert client_bufchan._recv_task is None
+    assert not hasattr(client_bufchan, '__dict__')
+    client_bufchan.emit('openthat', (42,))
+
+    event = server.recv()
+    server_channel = server.channel(event)
+    server_hbchan = zerorpc.HeartBeatOnChannel(server_channel, passive=True)
+    server_bufchan = zerorpc.BufferedChannel(server_hbchan)
+    event = server_bufchan.recv()
+    assert list(event.args) == [42]
+
+    def server_do():
+        for x in range(10):
+            server_bufchan.emit('test', (x,))
+    server_task = gevent.spawn(server_do)
+    for x in range(10):
+        event = client_bufchan.recv()
+        assert list(event.args) == [x]
+    server_task.get()
+
+    server_bufchan.close()
+    client_bufchan.close()
+    server_events.close()
+    client_events.close()
+
+
+def test_channel_caps_once_per_peer():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events)
+
+    def request(server):
+        client_channel = client.channel()
+        client_channel.emit('someevent', (42,))
+        event = server.recv(timeout=5)
+        server.channel(event).emit('someanswer', (21,))
+        return event, client_channel.recv(timeout=5)
+
+    (event, reply) = request(server)
+    assert u'caps' in event.header
+    assert u'caps' in reply.header
+    for i in range(3):
+        (event, reply) = request(server)
+        assert u'caps' not in event.header
+        assert u'caps' not in reply.header
+
+    # A new server process has to be told again.
+    server.close()
+    server_events.close()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+    gevent.sleep(1)
+    (event, reply) = request(server)
+    assert u'caps' in event.header
+    assert u'caps' in reply.header
+    assert server.peer_capabilities(event.identity)
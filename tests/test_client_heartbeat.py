@@ -28,10 +28,14 @@ from __future__ import absolute_import
 from builtins import next
 from builtins import range
 
+import pytest
 import gevent
+import threading
+import time
 
 import zerorpc
-from .testutils import teardown, random_ipc_endpoint, TIME_FACTOR
+from .testutils import teardown, random_ipc_endpoint, spy_emit_event, \
+        TIME_FACTOR
 
 
 def test_client_server_hearbeat():
@@ -198,3 +202,114 @@ def test_client_drop_stream():
         gevent.sleep(TIME_FACTOR * 3)
 
     gevent.spawn(test_client).join()
+
+
+def test_client_server_heartbeat_delay():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def lolita(self):
+            return 42
+
+        def slow(self):
+            gevent.sleep(TIME_FACTOR * 6)
+            return 2
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 1, heartbeat_delay=TIME_FACTOR * 3)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 1,
+            heartbeat_delay=TIME_FACTOR * 3)
+    client.connect(endpoint)
+
+    emitted = spy_emit_event(srv._events)
+
+    # Short calls: the request and the reply, nothing else.
+    for x in range(10):
+        assert client.lolita() == 42
+    assert [event.name for event in emitted] == [u'OK'] * 10
+
+    # Heartbeating starts once the call outlives the delay.
+    del emitted[:]
+    assert client.slow() == 2
+    assert u'_zpc_hb' in [event.name for event in emitted]
+    client.close()
+    srv.close()
+
+
+def _busy(seconds):
+    # Keeps the loop blocked, like a CPU bound call would.
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def test_client_server_heartbeat_blocked_loop():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def crunch(self):
+            gevent.sleep(TIME_FACTOR * 3)
+            _busy(TIME_FACTOR * 6)
+            gevent.sleep(TIME_FACTOR * 1)
+            return 42
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 1)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 1)
+    client.connect(endpoint)
+
+    # Both ends are stalled, neither of them loses the other.
+    assert client.crunch() == 42
+    client.close()
+    srv.close()
+
+
+def test_client_transport_heartbeat_remote_blocked():
+    endpoint = random_ipc_endpoint()
+    ready = threading.Event()
+    done = threading.Event()
+
+    class MySrv(zerorpc.Server):
+
+        def crunch(self):
+            gevent.sleep(TIME_FACTOR * 3)
+            _busy(TIME_FACTOR * 6)
+            return 42
+
+    def serve():
+        # Another thread, so the loop of the client keeps running while the
+        # one of the server is blocked.
+        srv = MySrv(heartbeat=TIME_FACTOR * 1, context=zerorpc.Context())
+        srv.bind(endpoint)
+        gevent.spawn(srv.run)
+        ready.set()
+        while not done.is_set():
+            gevent.sleep(TIME_FACTOR * 1)
+        srv.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 1)
+    client.connect(endpoint)
+    with pytest.raises(zerorpc.LostRemote):
+        client.crunch()
+    client.close()
+
+    # The server's libzmq still answers the transport heartbeats.
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 1)
+    client.enable_transport_heartbeat(TIME_FACTOR * 0.5)
+    client.connect(endpoint)
+    assert client.crunch() == 42
+    client.close()
+
+    done.set()
+    thread.join()
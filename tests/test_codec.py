@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import uuid
+import struct
+import decimal
+import datetime
+
+import gevent
+import msgpack
+import pytest
+
+import zerorpc
+from zerorpc import zmq
+from .testutils import teardown, random_ipc_endpoint
+
+
+class Point(object):
+
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def __eq__(self, other):
+        return (self.x, self.y) == (other.x, other.y)
+
+
+def roundtrip(codec, args, xheader=None):
+    event = zerorpc.Event(u'myevent', args, codec.context)
+    if xheader:
+        event.header.update(xheader)
+    return zerorpc.Event.unpack(codec.pack(event), codec)
+
+
+def test_ext_type():
+    context = zerorpc.Context()
+    context.register_ext_type(1, Point,
+            lambda p: msgpack.packb((p.x, p.y)),
+            lambda d: Point(*msgpack.unpackb(d)))
+    codec = zerorpc.EventCodec(context)
+
+    event = roundtrip(codec, (Point(1, 2), [Point(3, 4)]))
+    assert event.args == [Point(1, 2), [Point(3, 4)]]
+
+    with pytest.raises(TypeError):
+        roundtrip(zerorpc.EventCodec(zerorpc.Context()), (Point(1, 2),))
+
+
+def test_unknown_ext_type_is_left_alone():
+    context = zerorpc.Context()
+    context.register_ext_type(1, Point, lambda p: b'xy', lambda d: None)
+    event = zerorpc.Event(u'myevent', (Point(1, 2),), context)
+    event = zerorpc.Event.unpack(event.pack(zerorpc.EventCodec(context)))
+    assert event.args == [msgpack.ExtType(1, b'xy')]
+
+
+def test_standard_ext_types():
+    context = zerorpc.Context()
+    context.register_standard_ext_types()
+    args = (datetime.datetime(2015, 3, 7, 12, 30, 5, 42),
+            datetime.date(2015, 3, 7),
+            uuid.uuid4(),
+            decimal.Decimal('3.14159265358979323846'))
+    event = roundtrip(zerorpc.EventCodec(context), args)
+    assert tuple(event.args) == args
+
+
+def test_serializer():
+    context = zerorpc.Context()
+    context.register_serializer(*zerorpc.PICKLE_SERIALIZER)
+    codec = zerorpc.EventCodec(context)
+    event = roundtrip(codec, (Point(1, 2), set([3])), {u'enc': u'pickle'})
+    assert event.args == (Point(1, 2), set([3]))
+
+    with pytest.raises(Exception):
+        roundtrip(codec, (1,), {u'enc': u'doesnotexist'})
+    blob = msgpack.packb(({u'enc': u'doesnotexist'}, u'lolita', b''))
+    with pytest.raises(zerorpc.DecodeError) as excinfo:
+        codec.unpack(blob)
+    assert excinfo.value.header == {u'enc': u'doesnotexist'}
+
+
+def test_client_server_encoding():
+    endpoint = random_ipc_endpoint()
+    context = zerorpc.Context()
+    context.register_serializer(*zerorpc.PICKLE_SERIALIZER)
+
+    class MySrv(zerorpc.Server):
+
+        def move(self, point, dx):
+            return Point(point.x + dx, point.y)
+
+    srv = MySrv(context=context)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(context=context)
+    with pytest.raises(ValueError):
+        client.encoding = u'doesnotexist'
+    client.encoding = u'pickle'
+    client.connect(endpoint)
+
+    assert client.move(Point(1, 2), 3) == Point(4, 2)
+    client.close()
+    srv.close()
+
+
+def test_client_server_unknown_encoding():
+    endpoint = random_ipc_endpoint()
+    context = zerorpc.Context()
+    context.register_serializer(*zerorpc.PICKLE_SERIALIZER)
+
+    class MySrv(zerorpc.Server):
+
+        def lolita(self):
+            return 42
+
+    # The server can't decode the request, but says so right away.
+    srv = MySrv()
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(context=context, timeout=10)
+    client.encoding = u'pickle'
+    client.connect(endpoint)
+
+    with gevent.Timeout(2):
+        with pytest.raises(zerorpc.RemoteError) as excinfo:
+            client.lolita()
+    assert excinfo.value.name == 'DecodeError'
+    assert 'pickle' in excinfo.value.msg
+    client.close()
+    srv.close()
+
+    # Nor does the client wait for an answer it can't decode.
+    server_events = zerorpc.Events(zmq.ROUTER, context=context)
+    server_events.bind(endpoint)
+    client = zerorpc.Client(timeout=10)
+    client.connect(endpoint)
+    call = client.lolita(async_=True)
+    request = server_events.recv()
+    reply = server_events.new_event(u'OK', (42,),
+            {u'response_to': request.header[u'message_id'],
+                u'enc': u'pickle'})
+    reply.identity = request.identity
+    server_events.emit_event(reply)
+    with gevent.Timeout(2):
+        with pytest.raises(zerorpc.RemoteError) as excinfo:
+            call.get()
+    assert excinfo.value.name == 'DecodeError'
+    client.close()
+    server_events.close()
+
+
+
+def test_ext_type_decoder_error():
+    context = zerorpc.Context()
+    context.register_ext_type(1, Point,
+            lambda p: msgpack.packb((p.x, p.y)),
+            lambda d: Point(*msgpack.unpackb(d)))
+    broken = zerorpc.Context()
+    broken.register_ext_type(1, Point, lambda p: b'',
+            lambda d: Point(*msgpack.unpackb(d)[:1]))
+
+    event = zerorpc.Event(u'myevent', (Point(1, 2),), context)
+    event.header[u'message_id'] = u'lolita'
+    blob = zerorpc.EventCodec(context).pack(event)
+    with pytest.raises(zerorpc.DecodeError) as excinfo:
+        zerorpc.EventCodec(broken).unpack(blob)
+    assert excinfo.value.header[u'message_id'] == u'lolita'
+
+    # Trailing garbage too.
+    with pytest.raises(zerorpc.DecodeError) as excinfo:
+        zerorpc.EventCodec(context).unpack(blob + b'\x01')
+
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def move(self, point, dx):
+            return Point(point.x + dx, point.y)
+
+    # The server can't decode a small request, and says so right away.
+    srv = MySrv(context=broken)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(context=context, timeout=10)
+    client.connect(endpoint)
+    with gevent.Timeout(2):
+        with pytest.raises(zerorpc.RemoteError) as excinfo:
+            client.move(Point(1, 2), 3)
+    assert excinfo.value.name == 'DecodeError'
+    client.close()
+    srv.close()
+
+def test_oob_frames_push_pull():
+    endpoint = random_ipc_endpoint()
+    puller = zerorpc.Events(zmq.PULL)
+    puller.bind(endpoint)
+    pusher = zerorpc.Events(zmq.PUSH)
+    pusher.oob_threshold = 1024
+    pusher.connect(endpoint)
+
+    big = b'x' * 4096
+    pusher.emit('myevent', (b'small', big, [bytearray(big)],
+        {u'k': memoryview(big)}))
+    event = puller.recv()
+    assert event.identity is None
+    assert u'oob' not in event.header
+    (small, a, (b,), d) = event.args
+    assert small == b'small'
+    for value in (a, b, d[u'k']):
+        assert isinstance(value, memoryview)
+        assert value.tobytes() == big
+
+
+def test_oob_frames_invalid():
+    codec = zerorpc.EventCodec()
+    frames = [b'identity', b'', b'frame']
+
+    def placeholder(distance):
+        return msgpack.ExtType(127, struct.pack('>I', distance))
+    blob = msgpack.packb(({u'oob': 1}, u'myevent', [placeholder(1)]))
+    (header, name, args) = codec.unpack(blob, frames)
+    assert bytes(args[0]) == b'frame'
+    for (header, distance) in (({u'oob': 1}, 0), ({u'oob': 1}, 1000),
+            ({u'oob': 1}, 2), ({}, 1)):
+        blob = msgpack.packb((header, u'myevent', [placeholder(distance)]))
+        with pytest.raises(zerorpc.DecodeError):
+            codec.unpack(blob, frames)
+
+
+def test_oob_frames_client_server():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def echo(self, blob):
+            return blob
+
+        def size(self, blob):
+            return len(blob)
+
+    srv = MySrv()
+    srv.oob_threshold = 1024
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.oob_threshold = 1024
+    client.connect(endpoint)
+
+    big = b'y' * (1 << 20)
+    assert client.size(big) == len(big)
+    assert bytes(client.echo(big)) == big
+    assert client.echo(b'small') == b'small'
+    client.close()
+    srv.close()
+
+
+def test_ndarray():
+    numpy = pytest.importorskip('numpy')
+    codec = zerorpc.EventCodec(zerorpc.Context())
+    a = numpy.arange(12, dtype=numpy.float32).reshape(3, 4)
+    arrays = (a, numpy.asfortranarray(a), a[:, ::2], a[0],
+            numpy.arange(5, dtype=numpy.int64), numpy.float64(1.5))
+
+    event = roundtrip(codec, arrays)
+    for (expected, value) in zip(arrays, event.args):
+        assert numpy.array_equal(expected, value)
+
+    codec.oob_threshold = 16
+    event = zerorpc.Event(u'myevent', arrays, codec.context)
+    frames = codec.pack_frames(event)
+    assert len(frames) == 6
+    event = zerorpc.Event.unpack(frames[-1], codec, frames[:-1])
+    for (expected, value) in zip(arrays, event.args):
+        assert numpy.array_equal(expected, value)
+    assert event.args[4].dtype == numpy.int64
+    assert event.args[1].flags.f_contiguous
+
+    with pytest.raises(TypeError):
+        roundtrip(codec, (numpy.array([object()]),))
+
+
+def test_ndarray_stream():
+    numpy = pytest.importorskip('numpy')
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def scale(self, array, factor):
+            return array * factor
+
+        @zerorpc.stream
+        def rows(self, array):
+            return iter(array)
+
+    srv = MySrv()
+    srv.oob_threshold = 64
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    a = numpy.arange(1000, dtype=numpy.float32).reshape(10, 100)
+    assert numpy.array_equal(client.scale(a, 2), a * 2)
+    rows = list(client.rows(a))
+    assert len(rows) == 10
+    assert numpy.array_equal(numpy.vstack(rows), a)
+    client.close()
+    srv.close()
+
+
+def test_lazy_args():
+    context = zerorpc.Context()
+    codec = zerorpc.EventCodec(context)
+    args = (u'a' * 2000, [1, 2, 3])
+
+    # A header larger than the first chunk fed to the header unpacker.
+    for xheader in ({}, {u'trace': u'x' * 1000}):
+        event = zerorpc.Event(u'myevent', args, context)
+        event.header.update(xheader)
+        blob = codec.pack(event)
+
+        event = zerorpc.Event.unpack(blob, codec, lazy=True)
+        assert event.name == u'myevent'
+        assert event.header[u'message_id']
+        assert event.lazy_args is not None
+
+        # Forwarded without decoding the arguments.
+        event.header[u'response_to'] = b'abc'
+        forwarded = zerorpc.Event.unpack(codec.pack(event), codec)
+        assert forwarded.header[u'response_to'] == b'abc'
+        assert forwarded.args == [args[0], args[1]]
+
+        assert event.args == [args[0], args[1]]
+        assert event.lazy_args is None
+
+    # Small events are decoded eagerly.
+    event = zerorpc.Event(u'myevent', (1,), context)
+    event = zerorpc.Event.unpack(codec.pack(event), codec, lazy=True)
+    assert event.lazy_args is None
+
+    with pytest.raises(Exception):
+        zerorpc.Event.unpack(msgpack.packb([u'x' * 2000]), codec, lazy=True)
+
+
+def test_lazy_args_router():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.ROUTER)
+    server.bind(endpoint)
+    client = zerorpc.Events(zmq.DEALER)
+    client.connect(endpoint)
+
+    # The envelope of the message isn't taken for out-of-band frames: the
+    # arguments can be forwarded untouched.
+    client.emit('myevent', (u'a' * 20000,))
+    event = server.recv()
+    assert event.lazy_args is not None
+    assert event.lazy_args.frames == []
+    blob = server._codec.pack(event)
+    assert bytes(event.lazy_args.raw) in blob
+    assert event.args == [u'a' * 20000]
+    server.close()
+    client.close()
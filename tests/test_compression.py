@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import print_function
+from __future__ import absolute_import
+from builtins import range
+
+import gevent
+import msgpack
+import pytest
+
+import zerorpc
+from zerorpc.compression import available_compressors
+from .testutils import teardown, random_ipc_endpoint
+
+
+def rows(count):
+    return [{u'id': i, u'name': u'row', u'tags': [u'a', u'b', u'c'] * 20}
+            for i in range(count)]
+
+
+def new_codec(compression=u'auto'):
+    codec = zerorpc.EventCodec(zerorpc.Context())
+    codec.compression = compression
+    return codec
+
+
+def wire_header(blob):
+    return msgpack.unpackb(blob, raw=False)[0]
+
+
+@pytest.mark.parametrize('name', [c.name for c in available_compressors()])
+def test_compression(name):
+    sender = new_codec(name)
+    receiver = new_codec(None)
+    args = (rows(50),)
+
+    event = zerorpc.Event(u'OK', args, sender.context)
+    (blob,) = sender.pack_frames(event, receiver.capabilities)
+    assert wire_header(blob)[u'z'] == name
+    assert len(blob) < len(sender.pack(event))
+    for lazy in (False, True):
+        event = zerorpc.Event.unpack(blob, receiver, lazy=lazy)
+        assert u'z' not in event.header
+        assert event.args == [rows(50)]
+
+    # Not supported by the peer, or too small.
+    event = zerorpc.Event(u'OK', args, sender.context)
+    (blob,) = sender.pack_frames(event, [u'doesnotexist'])
+    assert u'z' not in wire_header(blob)
+    event = zerorpc.Event(u'OK', (1,), sender.context)
+    (blob,) = sender.pack_frames(event, receiver.capabilities)
+    assert u'z' not in wire_header(blob)
+
+
+def test_stream_compression():
+    sender = new_codec(u'zlib')
+    receiver = new_codec(None)
+    context = sender.context
+    channel_id = context.new_msgid()
+
+    sizes = []
+    for i in range(5):
+        event = zerorpc.Event(u'STREAM', rows(10), context)
+        event.header[u'response_to'] = channel_id
+        (blob,) = sender.pack_frames(event, [u'zlib'])
+        assert wire_header(blob)[u'z_stream'] is True
+        sizes.append(len(blob))
+        event = zerorpc.Event.unpack(blob, receiver)
+        assert event.args == rows(10)
+    # The context learned from the previous items.
+    assert sizes[-1] < sizes[0]
+
+    # Items still in flight when the receiver closes the channel don't get
+    # a new context.
+    event = zerorpc.Event(u'STREAM', rows(10), context)
+    event.header[u'response_to'] = channel_id
+    (blob,) = sender.pack_frames(event, [u'zlib'])
+    receiver.release_channel(channel_id)
+    with pytest.raises(zerorpc.DecodeError):
+        zerorpc.Event.unpack(blob, receiver)
+    assert receiver._stream_decompressors == {}
+
+    # Nor is a context kept once it failed.
+    other_id = context.new_msgid()
+    for i in range(2):
+        event = zerorpc.Event(u'STREAM', rows(10), context)
+        event.header[u'response_to'] = other_id
+        (blob,) = sender.pack_frames(event, [u'zlib'])
+    with pytest.raises(zerorpc.DecodeError):
+        zerorpc.Event.unpack(blob, receiver)
+    assert receiver._stream_decompressors == {}
+
+    sender.release_channel(channel_id)
+    sender.release_channel(other_id)
+
+
+
+@pytest.mark.parametrize('name', [c.name for c in available_compressors()
+    if c.stream_compressor is not None])
+def test_stream_compression_interleaved(name):
+    sender = new_codec(name)
+    receiver = new_codec(None)
+    context = sender.context
+    channel_id = context.new_msgid()
+
+    def pack(name, args, channel_id=None):
+        event = zerorpc.Event(name, args, context)
+        if channel_id is not None:
+            event.header[u'response_to'] = channel_id
+        (blob,) = sender.pack_frames(event, receiver.capabilities)
+        return blob
+
+    # One-shot events in the middle of a stream leave its context alone, on
+    # the sending end...
+    blobs = []
+    for i in range(3):
+        blobs.append(pack(u'STREAM', rows(10 + i), channel_id))
+        pack(u'OK', (rows(200),))
+    for (i, blob) in enumerate(blobs):
+        assert wire_header(blob)[u'z_stream'] is True
+        assert zerorpc.Event.unpack(blob, receiver).args == rows(10 + i)
+
+    # ... and on the receiving end.
+    other_id = context.new_msgid()
+    blobs = [pack(u'STREAM', rows(10 + i), other_id) for i in range(3)]
+    one_shot = pack(u'OK', (rows(200),))
+    assert u'z_stream' not in wire_header(one_shot)
+    for (i, blob) in enumerate(blobs):
+        assert zerorpc.Event.unpack(blob, receiver).args == rows(10 + i)
+        assert zerorpc.Event.unpack(one_shot, receiver).args == [rows(200)]
+
+    for channel_id in (channel_id, other_id):
+        sender.release_channel(channel_id)
+        receiver.release_channel(channel_id)
+
+def test_client_server_compression():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def echo(self, value):
+            return value
+
+        @zerorpc.stream
+        def table(self, count):
+            return iter(rows(count))
+
+    srv = MySrv()
+    srv.compression = u'auto'
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.compression = u'auto'
+    client.connect(endpoint)
+
+    for i in range(2):
+        assert client.echo(rows(20)) == rows(20)
+        assert list(client.table(100)) == rows(100)
+    assert client._events.peer_capabilities()
+    client.close()
+    srv.close()
@@ -27,6 +27,11 @@ from __future__ import print_function, absolute_import
 from builtins import str, bytes
 from builtins import range, object
 
+import time
+
+import pytest
+import gevent.queue
+
 from zerorpc import zmq
 import zerorpc
 from .testutils import teardown, random_ipc_endpoint
@@ -197,3 +202,338 @@ def test_msgpack():
     assert isinstance(event.header[u'message_id'], bytes)
     assert isinstance(event.header[u'v'], int)
     assert isinstance(event.args[0], str)
+
+
+def test_event_codec():
+    context = zerorpc.Context()
+    codec = zerorpc.EventCodec(context)
+    for i in range(3):
+        event = zerorpc.Event(u'myevent', (u'a', i, b'bin'), context=context)
+        event = zerorpc.Event.unpack(event.pack(codec), codec)
+        assert event.name == u'myevent'
+        assert list(event.args) == [u'a', i, b'bin']
+        assert isinstance(event.header[u'message_id'], bytes)
+
+
+def test_events_custom_codec():
+    class CountingCodec(zerorpc.EventCodec):
+        packed = 0
+        unpacked = 0
+
+        def pack(self, event):
+            CountingCodec.packed += 1
+            return super(CountingCodec, self).pack(event)
+
+        def unpack(self, blob, frames=None, lazy=False):
+            CountingCodec.unpacked += 1
+            return super(CountingCodec, self).unpack(blob, frames, lazy)
+
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL, codec=CountingCodec())
+    server.bind(endpoint)
+    client = zerorpc.Events(zmq.PUSH)
+    client.codec = CountingCodec()
+    client.connect(endpoint)
+
+    client.emit('myevent', (42,))
+    event = server.recv()
+    assert list(event.args) == [42]
+    assert CountingCodec.packed == 1
+    assert CountingCodec.unpacked == 1
+
+
+def test_events_batching():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.ROUTER)
+    server.bind(endpoint)
+    server.enable_batching(max_bytes=1024, delay=0.05)
+
+    client = zerorpc.Events(zmq.DEALER)
+    client.connect(endpoint)
+
+    client.emit('hello', (0,), {u'caps': client.capabilities})
+    event = server.recv()
+    identity = event.identity
+    assert u'batch' in server.peer_capabilities(identity)
+
+    batch_sizes = []
+    unpack_batch = client._unpack_batch
+
+    def spy_unpack_batch(batch):
+        batch_sizes.append(len(batch.args))
+        return unpack_batch(batch)
+    client._unpack_batch = spy_unpack_batch
+
+    for i in range(100):
+        reply_event = server.new_event('answer', (i, b'x' * 30))
+        reply_event.identity = identity
+        server.emit_event(reply_event)
+
+    for i in range(100):
+        event = client.recv()
+        assert event.name == 'answer'
+        assert list(event.args) == [i, b'x' * 30]
+    assert sum(batch_sizes) > 50
+    assert max(batch_sizes) < 30
+
+
+def test_events_drain():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.PUSH)
+    client.connect(endpoint)
+
+    for x in range(500):
+        client.emit('myevent', (x,))
+
+    for x in range(500):
+        event = server.recv()
+        assert list(event.args) == [x]
+    with pytest.raises(zerorpc.TimeoutExpired):
+        server.recv(timeout=0.05)
+
+
+def test_send_queue():
+    from zerorpc.events import SendQueue
+    queue = SendQueue(100, quantum=100)
+
+    # A channel queues large events, then another channel small ones.
+    for i in range(3):
+        queue.put(([b'a' * 250], i), flow=u'a', name=u'STREAM')
+    for i in range(3):
+        queue.put(([b'b' * 10], i), flow=u'b', name=u'STREAM')
+    queue.put(([b'hb'], None), flow=u'a', name=u'_zpc_hb')
+    assert len(queue) == 7
+
+    order = []
+    while len(queue):
+        (parts, i) = queue.get_nowait()
+        order.append((parts[0][:2], i))
+    # Heartbeat first, then the small events don't wait for all the large.
+    assert order[0] == (b'hb', None)
+    assert order.index((b'bb', 2)) < order.index((b'aa', 2))
+    assert [i for (p, i) in order if p == b'aa'] == [0, 1, 2]
+    assert [i for (p, i) in order if p == b'bb'] == [0, 1, 2]
+
+    stats = queue.stats
+    assert stats['sent'] == 7
+    assert stats['control_sent'] == 1
+    assert stats['max_queued'] == 7
+    assert stats['queued'] == 0
+
+    with pytest.raises(gevent.queue.Empty):
+        queue.get(timeout=0.01)
+
+
+def test_send_queue_limits():
+    from zerorpc.events import SendQueue
+    with pytest.raises(ValueError):
+        SendQueue(100, quantum=100, weights={u'STREAM': 0})
+    with pytest.raises(ValueError):
+        SendQueue(100, quantum=0)
+
+    # A full queue still takes the control events.
+    queue = SendQueue(2, quantum=100)
+    queue.put(([b'a'], 0), flow=u'a', name=u'STREAM')
+    queue.put(([b'a'], 1), flow=u'a', name=u'STREAM')
+    with pytest.raises(gevent.queue.Full):
+        queue.put(([b'a'], 2), timeout=0.01, flow=u'a', name=u'STREAM')
+    queue.put(([b'more'], None), timeout=0.01, flow=u'a', name=u'_zpc_more')
+    queue.put(([b'hb'], None), timeout=0.01, flow=u'a', name=u'_zpc_hb')
+    assert len(queue) == 4
+    assert queue.get_nowait()[0] == [b'more']
+    assert queue.get_nowait()[0] == [b'hb']
+
+
+def test_sender_batch_delay_busy_queue():
+    from zerorpc.events import Sender
+
+    class SlowSocket(object):
+        def __init__(self):
+            self.sent = []
+
+        def send_multipart(self, parts, copy=False):
+            gevent.sleep(0.002)
+            self.sent.append((time.time(), parts))
+
+    socket = SlowSocket()
+    sender = Sender(socket)
+    sender.enable_batching(lambda blobs: b''.join(blobs), 65536, delay=0.05)
+    # A batch for a quiet peer, behind a steady flow to a busy one.
+    start = time.time()
+    sender([b'quiet', b'x'], batchable=True)
+    for x in range(200):
+        sender([b'busy', b'y'])
+    gevent.sleep(0.1)
+    try:
+        sent_at = [t for (t, parts) in socket.sent if parts[0] == b'quiet']
+        assert len(sent_at) == 1
+        assert sent_at[0] - start < 0.09
+        assert len(socket.sent) < 201
+    finally:
+        sender.close()
+
+
+def test_events_fair_queuing():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.PUSH)
+    client.connect(endpoint)
+    client.enable_fair_queuing(quantum=1024)
+
+    for x in range(100):
+        client.emit('myevent', (x,), {u'message_id': x % 4})
+
+    received = [[] for x in range(4)]
+    for x in range(100):
+        event = server.recv()
+        received[event.header[u'message_id']].append(event.args[0])
+    for flow in range(4):
+        assert received[flow] == list(range(flow, 100, 4))
+    assert client.send_stats['sent'] == 100
+
+
+def test_events_fragmentation():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.ROUTER)
+    server.bind(endpoint)
+    server.enable_fair_queuing(quantum=1000)
+    server.enable_fragmentation(max_size=1000)
+
+    client = zerorpc.Events(zmq.DEALER)
+    client.connect(endpoint)
+
+    # Whole events until the peer capabilities are known.
+    client.emit('hello', (0,), {u'caps': client.capabilities})
+    event = server.recv()
+    identity = event.identity
+    assert u'frag' in server.peer_capabilities(identity)
+
+    big = bytes(bytearray(range(256))) * 40
+    big_event = server.new_event('big', (big, 42), {u'message_id': u'big'})
+    big_event.identity = identity
+    small_event = server.new_event('small', (1,), {u'message_id': u'small'})
+    small_event.identity = identity
+    server.emit_event(big_event)
+    server.emit_event(small_event)
+
+    # The small event is not stuck behind the fragments of the big one.
+    event = client.recv()
+    assert event.name == 'small'
+    event = client.recv()
+    assert event.name == 'big'
+    assert list(event.args) == [big, 42]
+    assert not client._fragments
+    assert server.send_stats['sent'] > 10
+
+
+def test_events_fragmentation_hwm():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.ROUTER)
+    server.enable_fragmentation(max_size=1000)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.DEALER)
+    client.connect(endpoint)
+    client.emit('hello', (0,), {u'caps': client.capabilities})
+    identity = server.recv().identity
+
+    # Many more fragments than the default high water mark, sent before the
+    # client reads any of them: none is dropped.
+    big = b'a' * 5000000
+    big_event = server.new_event('big', (big,))
+    big_event.identity = identity
+    server.emit_event(big_event)
+    gevent.sleep(0.5)
+    event = client.recv(timeout=5)
+    assert bytes(event.args[0]) == big
+
+
+def test_events_fragmentation_expiry(monkeypatch):
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.PUSH)
+    client.connect(endpoint)
+
+    def fragments(fragment_id):
+        frames = client._codec.pack_frames(client.new_event('big',
+            (b'a' * 300,)))
+        return list(client._codec.pack_fragments(frames, 64, fragment_id))
+
+    def send(fragment):
+        client._socket.send_multipart(fragment)
+        with pytest.raises(zerorpc.TimeoutExpired):
+            server.recv(timeout=0.05)
+
+    # The fragments stopped coming.
+    monkeypatch.setattr(zerorpc.events, '_fragments_ttl', 0.1)
+    send(fragments(u'a')[0])
+    gevent.sleep(0.2)
+    send(fragments(u'b')[0])
+    assert [key[1] for key in server._fragments] == [u'b']
+
+    # Too many bytes being reassembled.
+    monkeypatch.setattr(zerorpc.events, '_max_fragmented_bytes', 350)
+    c = fragments(u'c')
+    for fragment in c:
+        client._socket.send_multipart(fragment)
+    event = server.recv(timeout=1)
+    assert list(event.args) == [b'a' * 300]
+    assert not server._fragments
+    assert server._fragments_bytes == 0
+
+
+def test_events_fragmentation_oob():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.PUSH)
+    client.connect(endpoint)
+    client.oob_threshold = 100
+    client.enable_fragmentation(max_size=64)
+    client._peer_caps[None] = frozenset(server.capabilities)
+
+    payload = (b'a' * 300, b'b' * 10, b'c' * 129)
+    client.emit('myevent', payload)
+    client.emit('myevent', (b'',))
+    event = server.recv()
+    assert [bytes(arg) for arg in event.args] == list(payload)
+    event = server.recv()
+    assert list(event.args) == [b'']
+
+
+def test_events_fragmentation_invalid():
+    endpoint = random_ipc_endpoint()
+    server = zerorpc.Events(zmq.PULL)
+    server.bind(endpoint)
+
+    client = zerorpc.Events(zmq.PUSH)
+    client.connect(endpoint)
+
+    # A fragment must come with its chunk.
+    client.emit('_zpc_frag', (u'x', True, True))
+    with pytest.raises(zerorpc.DecodeError):
+        server.recv()
+
+    # The timeout covers all the fragments of an event, not each of them.
+    frames = client._codec.pack_frames(client.new_event('big', (b'a' * 300,)))
+    fragments = list(client._codec.pack_fragments(frames, 64, u'big'))
+    assert len(fragments) > 3
+
+    def send_slowly():
+        for fragment in fragments:
+            client._socket.send_multipart(fragment)
+            gevent.sleep(0.05)
+    sender = gevent.spawn(send_slowly)
+    with pytest.raises(zerorpc.TimeoutExpired):
+        server.recv(timeout=0.12)
+    sender.join()
+    event = server.recv(timeout=1)
+    assert list(event.args) == [b'a' * 300]
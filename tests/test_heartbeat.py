@@ -29,11 +29,13 @@ from builtins import range
 
 import pytest
 import gevent
+import time
 import sys
 
 from zerorpc import zmq
 import zerorpc
-from .testutils import teardown, random_ipc_endpoint, TIME_FACTOR
+from .testutils import teardown, random_ipc_endpoint, spy_emit_event, \
+        TIME_FACTOR
 
 
 def test_close_server_hbchan():
@@ -362,3 +364,75 @@ def test_do_some_req_rep_client_timeout():
     client_task.get()
     client.close()
     server.close()
+
+
+def test_peer_heartbeat_shared():
+    endpoint = random_ipc_endpoint()
+    server_events = zerorpc.Events(zmq.ROUTER)
+    server_events.bind(endpoint)
+    server = zerorpc.ChannelMultiplexer(server_events)
+
+    client_events = zerorpc.Events(zmq.DEALER)
+    client_events.connect(endpoint)
+    client = zerorpc.ChannelMultiplexer(client_events, ignore_broadcast=True)
+
+    heartbeats = []
+    heartbeats_at = []
+    sent_at = []
+
+    def on_emit(event):
+        if event.name == u'_zpc_hb':
+            heartbeats.append(event.header)
+            heartbeats_at.append(time.time())
+        sent_at.append(time.time())
+    spy_emit_event(client_events, on_emit)
+
+    lost = []
+
+    def client_do(x):
+        client_channel = client.channel()
+        client_hbchan = zerorpc.HeartBeatOnChannel(client_channel,
+                freq=TIME_FACTOR * 1)
+        client_hbchan.emit('open', (x,))
+        assert client_hbchan.recv().name == 'OK'
+        with pytest.raises(zerorpc.LostRemote):
+            client_hbchan.recv()
+        lost.append(x)
+        client_hbchan.close()
+
+    client_tasks = [gevent.spawn(client_do, x) for x in range(20)]
+
+    server_hbchans = []
+    for x in range(20):
+        event = server.recv()
+        server_channel = server.channel(event)
+        server_hbchan = zerorpc.HeartBeatOnChannel(server_channel,
+                freq=TIME_FACTOR * 1)
+        server_hbchan.recv()
+        server_hbchan.emit('OK', ())
+        server_hbchans.append(server_hbchan)
+
+    gevent.sleep(TIME_FACTOR * 2)
+    # Something else sent in the middle of a period delays the next
+    # heartbeat, but not past a period.
+    count = len(heartbeats)
+    while len(heartbeats) == count:
+        gevent.sleep(TIME_FACTOR * 0.02)
+    gevent.sleep(TIME_FACTOR * 0.6)
+    client.channel().emit('data', ())
+    gevent.sleep(TIME_FACTOR * 2)
+    # One heartbeat per half period for the peer, not one per channel.
+    assert 0 < len(heartbeats) <= 11
+    assert all(header.get(u'peer') for header in heartbeats)
+    # Once heartbeating, the server never goes a period without hearing
+    # from the client.
+    sent_at = [t for t in sent_at if t >= heartbeats_at[0]]
+    gaps = [b - a for (a, b) in zip(sent_at, sent_at[1:])]
+    assert max(gaps) < TIME_FACTOR * 1.2
+
+    # The server stops answering: every channel loses it at once.
+    server.close()
+    server_events.close()
+    gevent.joinall(client_tasks, raise_error=True)
+    assert sorted(lost) == list(range(20))
+    client.close()
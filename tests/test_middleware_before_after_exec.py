@@ -211,7 +211,8 @@ def test_hook_server_after_exec_stream():
     test_server = zerorpc.Server(EchoModule(), context=zero_ctx)
     test_server.bind(endpoint)
     test_server_task = gevent.spawn(test_server.run)
-    test_client = zerorpc.Client()
+    # The items one by one (no STREAM_BATCH), each waiting for the client.
+    test_client = zerorpc.Client(stream_batching=False)
     test_client.connect(endpoint)
 
     # Test without a middleware
@@ -27,10 +27,15 @@ from __future__ import print_function
 from __future__ import absolute_import
 from builtins import range
 
+import pytest
 import gevent
+import gevent.event
+import gevent.local
+import time
 
 import zerorpc
-from .testutils import teardown, random_ipc_endpoint, TIME_FACTOR
+from .testutils import teardown, random_ipc_endpoint, spy_emit_event, \
+        TIME_FACTOR
 
 try:
     # Try collections.abc for 3.4+
@@ -71,3 +76,297 @@ def test_rcp_streaming():
     for x in r:
         l.append(x)
     assert l == list(range(10))
+
+
+def test_rcp_streaming_batches():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.stream
+        def xrange(self, max):
+            return range(max)
+
+        @zerorpc.stream
+        def trickle(self):
+            yield 1
+            gevent.sleep(TIME_FACTOR * 5)
+            yield 2
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 4)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    emitted = spy_emit_event(srv._events)
+
+    def emitted_names():
+        return [event.name for event in emitted]
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 4)
+    client.connect(endpoint)
+
+    assert list(client.xrange(2500)) == list(range(2500))
+    assert emitted_names() == [u'STREAM_BATCH'] * 3 + [u'STREAM_DONE']
+
+    # A batch doesn't wait for the next item for long.
+    del emitted[:]
+    stream = client.trickle()
+    with gevent.Timeout(TIME_FACTOR * 3):
+        assert next(stream) == 1
+    assert list(stream) == [2]
+    assert emitted_names() == [u'STREAM', u'STREAM', u'STREAM_DONE']
+
+    # Peers which don't know about batches get one item per event.
+    client.close()
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 4, stream_batching=False)
+    client.connect(endpoint)
+    del emitted[:]
+    assert list(client.xrange(10)) == list(range(10))
+    assert emitted_names() == [u'STREAM'] * 10 + [u'STREAM_DONE']
+    client.close()
+    srv.close()
+
+
+def test_stream_batcher_close():
+    from zerorpc.patterns import ReqStream, _StreamBatcher
+
+    class FakeChannel(object):
+        context = zerorpc.Context()
+
+        def __init__(self):
+            self.emitted = []
+
+        def emit(self, name, args, xheader=None):
+            self.emitted.append(name)
+
+    channel = FakeChannel()
+    pattern = ReqStream(batch_max_delay=0.01)
+    batcher = _StreamBatcher(pattern, channel, {})
+    batcher.add(1)
+    batcher.close()
+    gevent.sleep(0.05)
+    assert channel.emitted == []
+
+    # Even when the timer already fired, and the flush waits for its turn.
+    batcher = _StreamBatcher(pattern, channel, {})
+    with batcher._lock:
+        batcher.add(1)
+        gevent.sleep(0.05)
+        batcher.close()
+    gevent.sleep(0)
+    assert channel.emitted == []
+
+
+def test_stream_batcher_estimated_size():
+    import msgpack
+    from zerorpc.patterns import _estimated_size
+
+    values = [
+        b'x' * 1000,
+        u'\u00e9t\u00e9' * 100,
+        [[b'x' * 100] * 10] * 10,
+        {u'k': {u'nested': [u'\u4e2d\u6587' * 50, 42, 3.14]}},
+    ]
+    for value in values:
+        packed = len(msgpack.packb(value, use_bin_type=True))
+        estimated = _estimated_size(value)
+        assert packed <= estimated <= packed * 1.1 + 50
+
+    # Nested deeper than it looks, the rest is guessed.
+    deep = [0]
+    for x in range(1000):
+        deep = [deep]
+    assert _estimated_size(deep) < 100
+
+
+def test_rcp_streaming_produce_ahead():
+    endpoint = random_ipc_endpoint()
+    produced = []
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.stream.options(produce_ahead=50)
+        def ahead(self, max):
+            for x in range(max):
+                produced.append(x)
+                yield x
+            raise RuntimeError('done')
+
+        @zerorpc.stream.options(threaded=True)
+        def blocking(self, max):
+            for x in range(max):
+                time.sleep(0.001)
+                yield x
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 4)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 4, stream_batching=False)
+    client.connect(endpoint)
+
+    # The client gave a single credit so far: the server keeps producing,
+    # up to 50 items ahead of what it could send.
+    stream = client.ahead(1000, slots=100)
+    assert next(stream) == 0
+    gevent.sleep(TIME_FACTOR * 1)
+    assert 50 < len(produced) < 60
+    with pytest.raises(zerorpc.RemoteError):
+        assert list(stream) == list(range(1, 1000))
+    assert len(produced) == 1000
+
+    assert list(client.blocking(20)) == list(range(20))
+    client.close()
+    srv.close()
+
+
+def test_rcp_streaming_produce_ahead_task_context():
+    endpoint = random_ipc_endpoint()
+
+    class Tracer(object):
+        def __init__(self, trace_id=None):
+            self.locals = gevent.local.local()
+            self.locals.trace_id = trace_id
+
+        def load_task_context(self, event_header):
+            self.locals.trace_id = event_header.get(u'trace_id')
+
+        def get_task_context(self):
+            return {u'trace_id': getattr(self.locals, 'trace_id', None)}
+
+    srv_ctx = zerorpc.Context()
+    tracer = Tracer()
+    srv_ctx.register_middleware(tracer)
+    cli_ctx = zerorpc.Context()
+    cli_ctx.register_middleware(Tracer(u'abc'))
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.stream.options(produce_ahead=10)
+        def traced(self):
+            # Produced in its own greenlet, in the context of the call.
+            for x in range(3):
+                yield getattr(tracer.locals, 'trace_id', None)
+
+    srv = MySrv(context=srv_ctx, heartbeat=TIME_FACTOR * 4)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(context=cli_ctx, heartbeat=TIME_FACTOR * 4)
+    client.connect(endpoint)
+    assert list(client.traced()) == [u'abc'] * 3
+    client.close()
+    srv.close()
+
+
+def test_produce_ahead_threaded_close():
+    from zerorpc.patterns import _ProduceAhead
+    closed = []
+
+    def blocking():
+        try:
+            for x in range(1000):
+                yield x
+                time.sleep(0.05)
+        finally:
+            closed.append(True)
+
+    results = _ProduceAhead(blocking(), 10, threaded=True)
+    assert next(results) == 0
+    # Closed by the thread, once done with the item it is on.
+    results.close()
+    gevent.sleep(0.2)
+    assert closed == [True]
+
+
+def test_rcp_streaming_prefetch():
+    endpoint = random_ipc_endpoint()
+    produced = []
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.stream
+        def xrange(self, max):
+            for x in range(max):
+                produced.append(x)
+                yield x
+
+        @zerorpc.stream
+        def broken(self):
+            yield 1
+            raise RuntimeError('broken')
+
+        def lolita(self):
+            return 42
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 4)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 4, stream_batching=False)
+    client.connect(endpoint)
+
+    # While the consumer works on the first item, the next ones arrive (and
+    # credits go back to the server as they do).
+    stream = client.xrange(1000, prefetch=200)
+    assert next(stream) == 0
+    gevent.sleep(TIME_FACTOR * 1)
+    assert len(produced) > 200
+    assert list(stream) == list(range(1, 1000))
+
+    stream = client.broken(prefetch=10)
+    assert next(stream) == 1
+    with pytest.raises(zerorpc.RemoteError):
+        next(stream)
+
+    assert client.lolita(prefetch=10) == 42
+    client.close()
+    srv.close()
+
+
+def test_rcp_streaming_cancel():
+    endpoint = random_ipc_endpoint()
+    closed = gevent.event.Event()
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.stream
+        def forever(self):
+            try:
+                x = 0
+                while True:
+                    yield x
+                    x += 1
+            finally:
+                closed.set()
+
+        def slow(self):
+            try:
+                gevent.sleep(TIME_FACTOR * 20)
+            finally:
+                closed.set()
+
+    srv = MySrv(heartbeat=TIME_FACTOR * 4, pool_size=1)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(heartbeat=TIME_FACTOR * 4)
+    client.connect(endpoint)
+
+    # The client drops the stream: the generator is closed right away.
+    stream = client.forever()
+    assert [next(stream) for x in range(5)] == list(range(5))
+    stream.close()
+    assert closed.wait(TIME_FACTOR * 2)
+    gevent.sleep(0)
+    assert srv._task_pool.free_count() == 1
+
+    # Same when a call times out.
+    closed.clear()
+    with pytest.raises(zerorpc.TimeoutExpired):
+        client.slow(timeout=TIME_FACTOR * 1)
+    assert closed.wait(TIME_FACTOR * 2)
+    gevent.sleep(0)
+    assert srv._task_pool.free_count() == 1
+    client.close()
+    srv.close()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+from builtins import range
+
+import pytest
+import gevent
+import gevent.event
+import time
+
+import zerorpc
+from .testutils import teardown, random_ipc_endpoint, TIME_FACTOR
+
+
+def requests(scheduler, priorities, received_at=None, deadlines=None):
+    now = time.time() if received_at is None else received_at
+    for (i, priority) in enumerate(priorities):
+        deadline = None if deadlines is None else deadlines[i]
+        scheduler.put(zerorpc.Request(i, now, deadline, priority))
+
+
+def served(scheduler):
+    return [scheduler.get().event for i in range(scheduler.qsize())]
+
+
+def test_fifo_scheduler():
+    scheduler = zerorpc.FifoScheduler()
+    requests(scheduler, [None, 1, None])
+    assert scheduler.qsize() == 3
+    assert served(scheduler) == [0, 1, 2]
+    stats = scheduler.stats
+    assert stats[None]['served'] == 2
+    assert stats[1] == dict(stats[1], queued=0, served=1)
+
+
+def test_priority_scheduler():
+    scheduler = zerorpc.PriorityScheduler(aging=None)
+    requests(scheduler, [None, 10, -1, 10, None])
+    assert served(scheduler) == [1, 3, 0, 4, 2]
+
+    # Old enough, a request of low priority goes first.
+    scheduler = zerorpc.PriorityScheduler(aging=1.0)
+    requests(scheduler, [-1], received_at=time.time() - 5)
+    requests(scheduler, [2])
+    assert served(scheduler) == [0, 0]
+
+
+def test_weighted_scheduler():
+    scheduler = zerorpc.WeightedScheduler({'a': 3, 'b': 1})
+    requests(scheduler, ['a'] * 8 + ['b'] * 8)
+    classes = [('a' if event < 8 else 'b') for event in served(scheduler)]
+    assert classes[:8].count('a') == 6
+    assert classes[8:].count('b') == 6
+
+    # No catching up after being idle.
+    requests(scheduler, ['a'] * 8 + ['b'] * 4)
+    classes = [('a' if event < 8 else 'b') for event in served(scheduler)]
+    assert 'b' in classes[:6]
+
+
+def test_deadline_scheduler():
+    scheduler = zerorpc.DeadlineScheduler(max_wait=10)
+    now = time.time()
+    requests(scheduler, [None] * 4, received_at=now,
+            deadlines=[now + 20, None, now + 1, now + 5])
+    assert served(scheduler) == [2, 3, 1, 0]
+
+
+def test_server_scheduler():
+    endpoint = random_ipc_endpoint()
+    served = []
+
+    class MySrv(zerorpc.Server):
+
+        def work(self, n):
+            served.append(n)
+            gevent.sleep(TIME_FACTOR * 0.1)
+
+        @zerorpc.rep.options(priority=10)
+        def health(self):
+            served.append('health')
+
+    # Requests only queue up to be scheduled with a backlog.
+    srv = MySrv(pool_size=1, backlog=10, scheduler=zerorpc.PriorityScheduler())
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    calls = [client.work(0, async_=True)]
+    gevent.sleep(TIME_FACTOR * 0.05)
+    calls += [client.work(n, async_=True) for n in (1, 2)]
+    calls.append(client.work(3, async_=True, priority=5))
+    calls.append(client.health(async_=True))
+    for call in calls:
+        call.get()
+    assert served == [0, 'health', 3, 1, 2]
+    assert srv._scheduler.stats[10]['served'] == 1
+
+    # Priorities (and timeouts) which aren't numbers are ignored.
+    del served[:]
+    assert client.work(4, priority=[1]) is None
+    assert client.work(5, priority='high') is None
+    assert client.work(6, priority=True) is None
+    assert served == [4, 5, 6]
+    assert srv._scheduler.stats[None]['served'] == 6
+    client.close()
+    srv.close()
+
+
+def test_server_bulkheads():
+    endpoint = random_ipc_endpoint()
+    report_done = gevent.event.Event()
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.rep.options(concurrency=1, queue_size=1)
+        def report(self):
+            report_done.wait()
+            return 'report'
+
+        def lolita(self):
+            return 42
+
+    srv = MySrv(pool_size=3)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    # One report running, one waiting: the next one is rejected, and the
+    # other methods still have tasks for them.
+    reports = [client.report(async_=True), client.report(async_=True)]
+    gevent.sleep(TIME_FACTOR * 0.1)
+    with pytest.raises(zerorpc.Overloaded):
+        client.report()
+    assert client.lolita() == 42
+    assert client._zerorpc_bulkheads() == {'report': {'concurrency': 1,
+        'queue_size': 1, 'running': 1, 'queued': 1, 'rejected': 1}}
+
+    report_done.set()
+    assert [report.get() for report in reports] == ['report', 'report']
+    assert client._zerorpc_bulkheads()['report']['running'] == 0
+    client.close()
+    srv.close()
+
+
+def test_bulkhead_limits():
+    assert zerorpc.Bulkhead(2).queue_size == 100
+    with pytest.raises(ValueError):
+        zerorpc.Bulkhead(0)
+    with pytest.raises(ValueError):
+        zerorpc.Bulkhead(1, queue_size=-1)
+    with pytest.raises(ValueError):
+        zerorpc.rep.options(concurrency=0)(lambda: None)
+    with pytest.raises(ValueError):
+        zerorpc.stream.options(queue_size=10)(lambda: None)
+
+
+def test_server_bulkheads_backlog():
+    endpoint = random_ipc_endpoint()
+    report_done = gevent.event.Event()
+
+    class MySrv(zerorpc.Server):
+
+        @zerorpc.rep.options(concurrency=1)
+        def report(self):
+            report_done.wait()
+            return 'report'
+
+    srv = MySrv(pool_size=1, backlog=2)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    # The reports waiting for their bulkhead are in the backlog too.
+    reports = [client.report(async_=True) for x in range(3)]
+    gevent.sleep(TIME_FACTOR * 0.1)
+    with gevent.Timeout(TIME_FACTOR * 0.5):
+        with pytest.raises(zerorpc.Overloaded):
+            client.report()
+    assert srv._bulkheads['report'].queued == 2
+    report_done.set()
+    assert [report.get() for report in reports] == ['report'] * 3
+    client.close()
+    srv.close()
+
+
+class FakeEvent(object):
+
+    def __init__(self, n, size=None):
+        self.n = n
+        self.size = size
+
+
+def peer_requests(scheduler, items, size=None):
+    reqs = [zerorpc.Request(FakeEvent(n, size), time.time(), peer=peer)
+            for (peer, n) in items]
+    for request in reqs:
+        scheduler.put(request)
+    return reqs
+
+
+def test_fair_scheduler():
+    scheduler = zerorpc.FairScheduler(quantum=100)
+    peer_requests(scheduler, [(b'a', n) for n in range(6)] +
+            [(b'b', n) for n in range(2)], size=100)
+    order = [(r.peer, r.event.n) for r in
+            [scheduler.get() for i in range(8)]]
+    assert order[:4] == [(b'a', 0), (b'b', 0), (b'a', 1), (b'b', 1)]
+
+    # A client with its tasks all busy waits, the others go on.
+    scheduler = zerorpc.FairScheduler(max_in_flight=1)
+    reqs = peer_requests(scheduler, [(b'a', 0), (b'a', 1), (b'b', 0)])
+    assert scheduler.get() is reqs[0]
+    assert scheduler.get() is reqs[2]
+    waiting = gevent.spawn(scheduler.get)
+    gevent.sleep(0)
+    assert not waiting.ready()
+    scheduler.done(reqs[0])
+    assert waiting.get(timeout=1) is reqs[1]
+
+    with pytest.raises(ValueError):
+        zerorpc.FairScheduler(quantum=0)
+    with pytest.raises(ValueError):
+        zerorpc.FairScheduler(max_in_flight=0)
+
+
+def test_peer_registry():
+    peers = zerorpc.PeerRegistry(max_peers=2)
+    (a, b, c, d) = [zerorpc.Request(FakeEvent(0, 10), time.time(), peer=peer)
+            for peer in (b'a', b'b', b'c', b'd')]
+    peers.received(a)
+    peers.received(b)
+    peers.started(a)
+    # The least recently seen client without a call in flight goes.
+    peers.received(c)
+    assert sorted(peers.stats) == [b'a', b'c']
+    peers.done(a)
+    peers.received(a)
+    peers.received(d)
+    assert sorted(peers.stats) == [b'a', b'd']
+    assert peers.stats[b'a']['requests'] == 2
+
+
+def test_server_peers():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def lolita(self):
+            return 42
+
+    srv = MySrv(scheduler=zerorpc.FairScheduler(max_in_flight=2))
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    clients = [zerorpc.Client(endpoint) for i in range(2)]
+    for client in clients:
+        assert [client.lolita(async_=True) for i in range(5)
+                ][-1].get() == 42
+
+    peers = clients[0]._zerorpc_peers()
+    assert len(peers) == 2
+    assert sorted(peer['requests'] for peer in peers.values()) == [5, 6]
+    assert all(peer['bytes'] > 0 and peer['last_seen']
+            for peer in peers.values())
+    assert sum(peer['in_flight'] for peer in peers.values()) == 1
+    for client in clients:
+        client.close()
+    srv.close()
@@ -229,3 +229,129 @@ def test_removed_unscriptable_error_format_args_spec():
     srv = MySrv()
     return_value = srv._format_args_spec(None)
     assert return_value is None
+
+
+def test_client_server_deadline():
+    endpoint = random_ipc_endpoint()
+    called = []
+
+    class MySrv(zerorpc.Server):
+
+        def slow(self):
+            gevent.sleep(TIME_FACTOR * 3)
+
+        def lolita(self):
+            called.append(True)
+            return 42
+
+        def budget(self):
+            forked = gevent.spawn(zerorpc.fork_task_context(
+                zerorpc.remaining_time))
+            return [zerorpc.remaining_time(), forked.get()]
+
+        @zerorpc.stream
+        def budgets(self):
+            for x in range(3):
+                yield zerorpc.remaining_time()
+
+    srv = MySrv(pool_size=1)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client(timeout=TIME_FACTOR * 10)
+    client.connect(endpoint)
+
+    remaining, forked = client.budget()
+    assert TIME_FACTOR * 9 < forked <= remaining <= TIME_FACTOR * 10
+    assert zerorpc.remaining_time() is None
+
+    # A stream has a deadline until its first item.
+    budgets = list(client.budgets())
+    assert budgets[0] > TIME_FACTOR * 9
+    assert budgets[1:] == [None, None]
+
+    # The client gives up on lolita while the server is busy: once free, the
+    # server doesn't even start it.
+    slow = client.slow(async_=True)
+    with pytest.raises(zerorpc.TimeoutExpired):
+        client.lolita(timeout=TIME_FACTOR * 1)
+    slow.get()
+    assert client.lolita() == 42
+    assert called == [True]
+    assert client._zerorpc_stats()['expired'] == 1
+    client.close()
+    srv.close()
+
+
+def test_client_server_overloaded():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def slow(self):
+            gevent.sleep(TIME_FACTOR * 1)
+            return 42
+
+    srv = MySrv(pool_size=1, backlog=1)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    # One call running, one waiting: the next one is turned down at once.
+    running = client.slow(async_=True)
+    gevent.sleep(TIME_FACTOR * 0.1)
+    waiting = client.slow(async_=True)
+    gevent.sleep(TIME_FACTOR * 0.1)
+    with gevent.Timeout(TIME_FACTOR * 0.5):
+        with pytest.raises(zerorpc.Overloaded) as excinfo:
+            client.slow()
+    assert excinfo.value.retry_after is not None
+    assert isinstance(excinfo.value, zerorpc.RemoteError)
+    assert running.get() == 42
+    assert waiting.get() == 42
+    assert srv._stats['rejected'] == 1
+
+    # With some room, everything is served again.
+    assert client.slow() == 42
+    client.close()
+    srv.close()
+
+
+def test_client_server_no_backlog():
+    endpoint = random_ipc_endpoint()
+
+    class MySrv(zerorpc.Server):
+
+        def slow(self):
+            gevent.sleep(TIME_FACTOR * 1)
+            return 42
+
+        @zerorpc.stream
+        def slow_stream(self):
+            yield 1
+            gevent.sleep(TIME_FACTOR * 1)
+            yield 2
+
+    srv = MySrv(pool_size=1)
+    srv.bind(endpoint)
+    gevent.spawn(srv.run)
+
+    client = zerorpc.Client()
+    client.connect(endpoint)
+
+    # A single call waits in the queue, the next ones in the socket.
+    calls = [client.slow(async_=True) for x in range(4)]
+    gevent.sleep(TIME_FACTOR * 0.5)
+    assert srv._scheduler.qsize() == 1
+    assert sum(peer['requests'] for peer in srv._peers.stats.values()) == 2
+    assert [call.get() for call in calls] == [42] * 4
+    service_time = srv._service_time
+    assert service_time < TIME_FACTOR * 2
+
+    # Streams don't count in the time a call takes.
+    assert list(client.slow_stream()) == [1, 2]
+    assert srv._service_time == service_time
+    client.close()
+    srv.close()
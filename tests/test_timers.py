@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+
+import pytest
+import gevent
+import threading
+
+import zerorpc
+
+
+def test_timer_wheel_expiry():
+    wheel = zerorpc.TimerWheel(resolution=0.01, slots=8)
+    fired = []
+    wheel.arm(0.05, fired.append, 'b')
+    wheel.arm(0.01, fired.append, 'a')
+    # Further than a turn of the ring.
+    wheel.arm(0.15, fired.append, 'c')
+    cancelled = wheel.arm(0.02, fired.append, 'x')
+    assert wheel.active == 4
+
+    cancelled.cancel()
+    assert not cancelled.active
+    assert wheel.active == 3
+    cancelled.cancel()
+    assert wheel.active == 3
+
+    gevent.sleep(0.1)
+    assert fired == ['a', 'b']
+    gevent.sleep(0.1)
+    assert fired == ['a', 'b', 'c']
+    assert wheel.stats == {'active': 0, 'expired': 3}
+    assert wheel._driver is None
+
+
+def test_timer_wheel_wakeups():
+    wheel = zerorpc.TimerWheel(resolution=0.01)
+    wakeups = []
+    expire = wheel._expire
+
+    def spy_expire():
+        wakeups.append(True)
+        expire()
+    wheel._expire = spy_expire
+    fired = []
+    wheel.arm(0.2, fired.append, 'b')
+    # The loop only wakes up for the ticks with timers.
+    wheel.arm(0.05, fired.append, 'a')
+    gevent.sleep(0.3)
+    assert fired == ['a', 'b']
+    assert len(wakeups) <= 4
+    assert wheel._driver is None
+
+    # A callback cancelling a timer expiring in the same tick.
+    timers = []
+    timers.append(wheel.arm(0.01, lambda: timers[1].cancel()))
+    timers.append(wheel.arm(0.01, fired.append, 'x'))
+    gevent.sleep(0.05)
+    assert fired == ['a', 'b']
+    assert wheel.active == 0
+
+
+def test_timer_wheel_timeout():
+    wheel = zerorpc.TimerWheel()
+
+    with pytest.raises(zerorpc.TimeoutExpired):
+        with wheel.timeout(0.05):
+            gevent.sleep(1)
+    assert wheel.active == 0
+
+    with wheel.timeout(1):
+        gevent.sleep(0.01)
+    assert wheel.active == 0
+
+    with pytest.raises(gevent.Timeout):
+        with wheel.timeout(0.05, gevent.Timeout(0.05)):
+            gevent.sleep(1)
+
+    with wheel.timeout(None):
+        gevent.sleep(0.01)
+
+    wheel.sleep(0.05)
+    assert wheel.stats['expired'] == 3
+
+
+def test_context_timer_wheel():
+    context = zerorpc.Context()
+    assert context.timer_wheel is context.timer_wheel
+
+    # Each thread (and hub) gets its own.
+    wheels = []
+    thread = threading.Thread(target=lambda:
+            wheels.append(context.timer_wheel))
+    thread.start()
+    thread.join()
+    assert wheels[0] is not context.timer_wheel
+
+    events = zerorpc.Events(zerorpc.zmq.PULL, context=context)
+    with pytest.raises(zerorpc.TimeoutExpired):
+        events.recv(timeout=0.05)
+    assert context.timer_wheel.active == 0
+    assert context.timer_wheel.stats['expired'] == 1
+    events.close()
@@ -64,3 +64,34 @@ def test1():
     s = gevent.spawn(server)
     c = gevent.spawn(client)
     c.join()
+
+
+def test_multipart():
+    endpoint = random_ipc_endpoint()
+    c = zmq.Context()
+    puller = c.socket(zmq.PULL)
+    puller.bind(endpoint)
+    pusher = c.socket(zmq.PUSH)
+    pusher.connect(endpoint)
+
+    def producer():
+        for i in range(100):
+            pusher.send_multipart([b'a', str(i).encode(), memoryview(b'c')],
+                    copy=False)
+    p = gevent.spawn(producer)
+
+    for i in range(100):
+        parts = puller.recv_multipart(copy=False)
+        assert [part.bytes for part in parts] == [b'a', str(i).encode(), b'c']
+    p.join()
+
+    # Nothing left, a blocking recv_multipart waits for the next message.
+    with gevent.Timeout(0.1, False):
+        puller.recv_multipart()
+        assert False
+    pusher.send_multipart([b'x', b'y'])
+    assert puller.recv_multipart() == [b'x', b'y']
+
+    pusher.close()
+    puller.close()
+    c.term()
@@ -48,6 +48,23 @@ def teardown():
             pass
     _tmpfiles = []
 
+def spy_emit_event(events, callback=None):
+    """Record the events emitted through `events`, returns their list.
+
+    `callback` (if any) is called with each event as well.
+
+    """
+    emitted = []
+    emit_event = events.emit_event
+
+    def spy(event, timeout=None):
+        emitted.append(event)
+        if callback is not None:
+            callback(event)
+        return emit_event(event, timeout)
+    events.emit_event = spy
+    return emitted
+
 def skip(reason):
     def _skip(test):
         @functools.wraps(test)
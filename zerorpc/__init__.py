@@ -26,10 +26,13 @@
 # flake8: noqa
 from .version import *
 from .exceptions import *
+from .timers import *
 from .context import *
 from .socket import *
 from .channel import *
+from .codec import *
 from .events import *
+from .scheduler import *
 from .core import *
 from .heartbeat import *
 from .decorators import *
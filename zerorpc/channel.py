@@ -28,20 +28,28 @@ import gevent.event
 import gevent.local
 import gevent.lock
 import logging
+import time
 
-from .exceptions import TimeoutExpired
-from .channel_base import ChannelBase
+from .exceptions import TimeoutExpired, DecodeError
+from .channel_base import ChannelBase, PushChannelBase
+from .heartbeat import PeerHeartBeat
 
 
 logger = logging.getLogger(__name__)
 
 
 class ChannelMultiplexer(ChannelBase):
-    def __init__(self, events, ignore_broadcast=False):
+    def __init__(self, events, ignore_broadcast=False, capabilities=()):
         self._events = events
+        # Advertised on top of the ones of the events (the RPC layer's).
+        self._capabilities = list(capabilities)
         self._active_channels = {}
         self._channel_dispatcher_task = None
         self._broadcast_queue = None
+        self._peer_heartbeat = None
+        self._peer_key = getattr(events, '_peer_key', lambda identity: None)
+        if events.recv_is_supported:
+            self._peer_heartbeat = PeerHeartBeat(self)
         if events.recv_is_supported and not ignore_broadcast:
             self._broadcast_queue = gevent.queue.Queue(maxsize=1)
             self._channel_dispatcher_task = gevent.spawn(
@@ -58,13 +66,55 @@ class ChannelMultiplexer(ChannelBase):
     def close(self):
         if self._channel_dispatcher_task:
             self._channel_dispatcher_task.kill()
+        if self._peer_heartbeat is not None:
+            self._peer_heartbeat.close()
 
     def new_event(self, name, args, xheader=None):
         return self._events.new_event(name, args, xheader)
 
     def emit_event(self, event, timeout=None):
+        heartbeat = self._peer_heartbeat
+        if heartbeat is not None and heartbeat.active:
+            heartbeat.sent(self._peer_key(event.identity))
         return self._events.emit_event(event, timeout)
 
+    def emit_peer_heartbeat(self, identity, kind):
+        event = self._events.new_event(u'_zpc_hb', (0,), {u'peer': kind})
+        event.identity = identity
+        self._events.emit_event(event)
+
+    def peer_heartbeat(self, identity, passive=False):
+        """The PeerHeartBeat to use with a remote, None if unsupported."""
+        if self._peer_heartbeat is None or (not passive and
+                u'peer_hb' not in self.peer_capabilities(identity)):
+            return None
+        return self._peer_heartbeat
+
+    def peer_capabilities(self, identity=None):
+        return self._events.peer_capabilities(identity)
+
+    def advertise_capabilities(self, identity=None):
+        return self._events.advertise_capabilities(identity)
+
+    def last_seen(self, identity):
+        if getattr(self._events, 'transport_alive', False):
+            # libzmq heartbeats the connection, see
+            # Events.enable_transport_heartbeat.
+            return time.time()
+        if self._peer_heartbeat is None:
+            return None
+        return self._peer_heartbeat.last_seen(self._peer_key(identity))
+
+    @property
+    def capabilities(self):
+        caps = list(self._events.capabilities) + self._capabilities
+        if self._peer_heartbeat is not None:
+            caps.append(u'peer_hb')
+        return caps
+
+    def release_channel(self, channel_id):
+        self._events.release_channel(channel_id)
+
     def recv(self, timeout=None):
         if self._broadcast_queue is not None:
             event = self._broadcast_queue.get(timeout=timeout)
@@ -76,25 +126,78 @@ class ChannelMultiplexer(ChannelBase):
         while True:
             try:
                 event = self._events.recv()
+            except DecodeError as e:
+                self._decode_error(e)
+                continue
             except Exception:
                 logger.exception('zerorpc.ChannelMultiplexer ignoring error on recv')
                 continue
+            if self._peer_heartbeat is not None and self._peer_heartbeat.seen(
+                    self._peer_key(event.identity), event):
+                continue
             channel_id = event.header.get(u'response_to', None)
 
-            queue = None
             if channel_id is not None:
                 channel = self._active_channels.get(channel_id, None)
                 if channel is not None:
-                    queue = channel._queue
+                    # The event goes through the layers of the channel right
+                    # away, only the greenlet waiting on it wakes up.
+                    try:
+                        channel._push(event)
+                    except Exception as e:
+                        logger.exception('zerorpc.ChannelMultiplexer,'
+                                ' error on event: {0}'.format(
+                                    event.__str__(ignore_args=True)))
+                        # Like a remote ignoring its credits: the channel
+                        # can't be trusted anymore, its reader gets an ERR.
+                        error = self._events.new_event(u'ERR',
+                                (type(e).__name__, str(e), None))
+                        error.header[u'response_to'] = channel_id
+                        error.identity = event.identity
+                        channel._abort(error)
+                    continue
+                if event.name == u'_zpc_cancel':
+                    # The channel is already gone (or was never opened, its
+                    # request having expired): nothing left to cancel.
+                    continue
             elif self._broadcast_queue is not None:
-                queue = self._broadcast_queue
+                self._broadcast_queue.put(event)
+                continue
 
-            if queue is None:
-                logger.warning('zerorpc.ChannelMultiplexer,'
-                        ' unable to route event: {0}'.format(
-                            event.__str__(ignore_args=True)))
-            else:
-                queue.put(event)
+            logger.warning('zerorpc.ChannelMultiplexer,'
+                    ' unable to route event: {0}'.format(
+                        event.__str__(ignore_args=True)))
+
+    def _decode_error(self, error):
+        # Answer with an ERR rather than let the remote wait for a reply:
+        # the local channel the event was for gets it, else the sender of a
+        # request.
+        header = error.header
+        channel_id = None if header is None else header.get(u'response_to')
+        channel = self._active_channels.get(channel_id)
+        if channel_id is not None and channel is None:
+            # For a channel already closed, like the events after it.
+            logger.debug('zerorpc.ChannelMultiplexer,'
+                    ' unable to decode event: {0}'.format(error))
+            return
+        logger.warning('zerorpc.ChannelMultiplexer,'
+                ' unable to decode event: {0}'.format(error))
+        if header is None:
+            return
+        args = ('DecodeError', str(error), None)
+        if channel is not None:
+            event = self._events.new_event(u'ERR', args)
+            event.header[u'response_to'] = channel_id
+            event.identity = error.identity
+            channel._push(event)
+        elif (self._broadcast_queue is not None and
+                u'message_id' in header and self.emit_is_supported):
+            if header.get(u'v', 1) < 2:
+                args = ('DecodeError: {0}'.format(error),)
+            event = self._events.new_event(u'ERR', args)
+            event.header[u'response_to'] = header[u'message_id']
+            event.identity = error.identity
+            self.emit_event(event)
 
     def channel(self, from_event=None):
         if self._channel_dispatcher_task is None:
@@ -111,19 +214,27 @@ class ChannelMultiplexer(ChannelBase):
         return self._events.context
 
 
-class Channel(ChannelBase):
+class Channel(PushChannelBase):
+
+    __slots__ = ('_multiplexer', '_channel_id', '_zmqid', '_encoding')
+
+    # There is no flow control at this level, see BufferedChannel.
+    _inbox_size = 100
 
     def __init__(self, multiplexer, from_event=None):
+        self._init_push()
         self._multiplexer = multiplexer
         self._channel_id = None
         self._zmqid = None
-        self._queue = gevent.queue.Queue(maxsize=1)
+        self._encoding = None
         if from_event is not None:
             self._channel_id = from_event.header[u'message_id']
             self._zmqid = from_event.identity
+            # Answer with the encoding chosen by the remote.
+            self._encoding = from_event.header.get(u'enc')
             self._multiplexer._active_channels[self._channel_id] = self
             logger.debug('<-- new channel %s', self._channel_id)
-            self._queue.put(from_event)
+            self._deliver(from_event)
 
     @property
     def recv_is_supported(self):
@@ -136,6 +247,7 @@ class Channel(ChannelBase):
     def close(self):
         if self._channel_id is not None:
             del self._multiplexer._active_channels[self._channel_id]
+            self._multiplexer.release_channel(self._channel_id)
             logger.debug('-x- closed channel %s', self._channel_id)
             self._channel_id = None
 
@@ -147,36 +259,94 @@ class Channel(ChannelBase):
             logger.debug('--> new channel %s', self._channel_id)
         else:
             event.header[u'response_to'] = self._channel_id
+        if self._encoding is not None:
+            event.header[u'enc'] = self._encoding
+        if self._multiplexer.advertise_capabilities(self._zmqid):
+            # Advertise what we understand, once per peer, so that the
+            # remote end can use it on this channel and the next ones.
+            caps = self._multiplexer.capabilities
+            if caps:
+                event.header[u'caps'] = list(caps)
         event.identity = self._zmqid
         return event
 
     def emit_event(self, event, timeout=None):
         self._multiplexer.emit_event(event, timeout)
 
+    def _push(self, event):
+        self._deliver(event)
+
     def recv(self, timeout=None):
-        try:
-            event = self._queue.get(timeout=timeout)
-        except gevent.queue.Empty:
-            raise TimeoutExpired(timeout)
-        return event
+        return self._recv_inbox(timeout)
+
+    def join_peer_heartbeat(self, hbchan, passive=False):
+        # Share the heartbeat of the remote peer, if it supports it. Passive
+        # channels always join, to answer the remote when it starts.
+        heartbeat = self._multiplexer.peer_heartbeat(self._zmqid, passive)
+        if heartbeat is not None:
+            heartbeat.add(self._multiplexer._peer_key(self._zmqid),
+                    self._zmqid, hbchan, passive)
+        return heartbeat
+
+    def last_seen(self):
+        return self._multiplexer.last_seen(self._zmqid)
+
+    def peer_capabilities(self, identity=None):
+        return self._multiplexer.peer_capabilities(identity or self._zmqid)
 
     @property
     def context(self):
         return self._multiplexer.context
 
 
-class BufferedChannel(ChannelBase):
-
-    def __init__(self, channel, inqueue_size=100):
+class BufferedChannel(PushChannelBase):
+
+    __slots__ = ('_channel', '_input_queue_size', '_remote_queue_open_slots',
+            '_input_queue_reserved', '_remote_can_recv', '_queued',
+            '_verbose', '_on_close_if', '_recv_task', '_input_queue_bytes',
+            '_adaptive', '_window', '_queued_bytes', '_max_sizes', '_rtt',
+            '_rate', '_credit_sent_at', '_consumed', '_consumed_since',
+            '_stats', '_on_cancel', '_sizes_seen')
+
+    # The credits (_zpc_more) given to the remote are counted in events.
+    #
+    # With `inqueue_bytes`, the events queued are also budgeted in bytes:
+    # the remote is given as many credits as events of the largest size
+    # among the last `inqueue_size` or so received fit in what is left of
+    # the budget. A burst of large events after small ones can only
+    # overflow it once, not each time it comes back. With `adaptive`, the
+    # window grows and shrinks with the rate at which events are consumed
+    # and the time a credit takes to bring an event (twice their product,
+    # so the remote never waits for credits if it can keep up), between 2 and
+    # `inqueue_size`. It starts at 10 events: as long as the window is what
+    # limits the rate, it about doubles with each refill.
+    def __init__(self, channel, inqueue_size=100, inqueue_bytes=None,
+            adaptive=False):
+        self._init_push()
         self._channel = channel
         self._input_queue_size = inqueue_size
+        self._input_queue_bytes = inqueue_bytes
+        self._adaptive = adaptive
+        self._window = min(inqueue_size, 10) if adaptive else inqueue_size
         self._remote_queue_open_slots = 1
         self._input_queue_reserved = 1
-        self._remote_can_recv = gevent.event.Event()
-        self._input_queue = gevent.queue.Queue()
+        self._remote_can_recv = None
+        self._queued = 0
+        self._queued_bytes = 0
+        # Largest event size, of the previous and of the current run of
+        # `inqueue_size` events.
+        self._max_sizes = [0, 0]
+        self._sizes_seen = 0
+        self._rtt = None
+        self._rate = None
+        self._credit_sent_at = None
+        self._consumed = 0
+        self._consumed_since = time.time()
+        self._stats = {'stalls': 0, 'stall_time': 0.0, 'credits_sent': 0}
         self._verbose = False
         self._on_close_if = None
-        self._recv_task = gevent.spawn(self._recver)
+        self._on_cancel = None
+        self._recv_task = self._attach(channel)
 
     @property
     def recv_is_supported(self):
@@ -194,6 +364,30 @@ class BufferedChannel(ChannelBase):
     def on_close_if(self, cb):
         self._on_close_if = cb
 
+    @property
+    def on_cancel(self):
+        """Called when the remote cancels the channel, see cancel."""
+        return self._on_cancel
+
+    @on_cancel.setter
+    def on_cancel(self, cb):
+        self._on_cancel = cb
+
+    def cancel(self):
+        """Close the channel, telling the remote to stop working on it.
+
+        The '_zpc_cancel' event doesn't wait for credits. Peers which don't
+        know about it ignore it.
+
+        """
+        if self._channel is not None:
+            try:
+                self._channel.emit(u'_zpc_cancel', None)
+            except Exception:
+                logger.debug('zerorpc.BufferedChannel, unable to cancel',
+                        exc_info=True)
+        self.close()
+
     def close(self):
         if self._recv_task is not None:
             self._recv_task.kill()
@@ -202,33 +396,82 @@ class BufferedChannel(ChannelBase):
             self._channel.close()
             self._channel = None
 
-    def _recver(self):
-        while True:
-            event = self._channel.recv()
-            if event.name == u'_zpc_more':
-                try:
-                    self._remote_queue_open_slots += int(event.args[0])
-                except Exception:
-                    logger.exception('gevent_zerorpc.BufferedChannel._recver')
-                if self._remote_queue_open_slots > 0:
-                    self._remote_can_recv.set()
-            elif self._input_queue.qsize() == self._input_queue_size:
-                raise RuntimeError(
-                    'BufferedChannel, queue overflow on event:', event)
-            else:
-                self._input_queue.put(event)
-                if self._on_close_if is not None and self._on_close_if(event):
-                    self._recv_task = None
-                    self.close()
-                    return
+    def _push(self, event):
+        if event.name == u'_zpc_more':
+            try:
+                self._remote_queue_open_slots += int(event.args[0])
+            except Exception:
+                logger.exception('gevent_zerorpc.BufferedChannel._push')
+            if (self._remote_queue_open_slots > 0 and
+                    self._remote_can_recv is not None):
+                self._remote_can_recv.set()
+        elif event.name == u'_zpc_cancel':
+            if self._on_cancel is not None:
+                self._on_cancel()
+        elif self._queued == self._input_queue_size:
+            raise RuntimeError(
+                'BufferedChannel, queue overflow on event:', event)
+        else:
+            self._queued += 1
+            self._account(event)
+            self._deliver(event)
+            if self._on_close_if is not None and self._on_close_if(event):
+                self.close()
 
     def new_event(self, name, args, xheader=None):
         return self._channel.new_event(name, args, xheader)
 
+    def _account(self, event):
+        size = event.size or 0
+        self._queued_bytes += size
+        if size > self._max_sizes[1]:
+            self._max_sizes[1] = size
+        self._sizes_seen += 1
+        if self._sizes_seen == self._input_queue_size:
+            self._max_sizes = [self._max_sizes[1], 0]
+            self._sizes_seen = 0
+        if self._credit_sent_at is not None:
+            # The first event since credits were sent.
+            rtt = time.time() - self._credit_sent_at
+            self._credit_sent_at = None
+            if self._rtt is None:
+                self._rtt = rtt
+            else:
+                self._rtt += (rtt - self._rtt) / 8
+
+    @property
+    def stats(self):
+        """Flow control counters.
+
+        `stalls` and `stall_time` count the emits which waited for credits
+        from the remote, and for how long. The others are about the events
+        received: the current window, what's queued, the round trip time of
+        a credit and the rate at which events are consumed.
+
+        """
+        stats = dict(self._stats)
+        stats.update({
+            'credits': self._remote_queue_open_slots,
+            'window': self._window_size(),
+            'queued': self._queued,
+            'queued_bytes': self._queued_bytes,
+            'rtt': self._rtt,
+            'rate': self._rate,
+        })
+        return stats
+
     def emit_event(self, event, timeout=None):
         if self._remote_queue_open_slots == 0:
+            if self._remote_can_recv is None:
+                self._remote_can_recv = gevent.event.Event()
             self._remote_can_recv.clear()
-            self._remote_can_recv.wait(timeout=timeout)
+            self._stats['stalls'] += 1
+            stalled_at = time.time()
+            try:
+                if not self._remote_can_recv.wait(timeout=timeout):
+                    raise TimeoutExpired(timeout)
+            finally:
+                self._stats['stall_time'] += time.time() - stalled_at
         self._remote_queue_open_slots -= 1
         try:
             self._channel.emit_event(event)
@@ -236,9 +479,34 @@ class BufferedChannel(ChannelBase):
             self._remote_queue_open_slots += 1
             raise
 
-    def _request_data(self):
-        open_slots = self._input_queue_size - self._input_queue_reserved
+    def _window_size(self):
+        window = self._window
+        max_size = max(self._max_sizes)
+        if self._input_queue_bytes is not None and max_size:
+            free = max(0, self._input_queue_bytes - self._queued_bytes)
+            window = min(window, self._queued + free // max_size)
+        return min(self._input_queue_size, max(2, window))
+
+    def _adapt_window(self):
+        now = time.time()
+        elapsed = now - self._consumed_since
+        if self._consumed and elapsed > 0:
+            rate = self._consumed / elapsed
+            if self._rate is None:
+                self._rate = rate
+            else:
+                self._rate += (rate - self._rate) / 4
+            self._consumed = 0
+            self._consumed_since = now
+        if self._rate is not None and self._rtt is not None:
+            self._window = int(self._rate * self._rtt * 2) + 1
+
+    def _request_data(self, window):
+        open_slots = window - self._input_queue_reserved
         self._input_queue_reserved += open_slots
+        if self._credit_sent_at is None:
+            self._credit_sent_at = time.time()
+        self._stats['credits_sent'] += open_slots
         self._channel.emit(u'_zpc_more', (open_slots,))
 
     def recv(self, timeout=None):
@@ -246,19 +514,26 @@ class BufferedChannel(ChannelBase):
         # sees a suitable message from the remote end...
         #
         if self._verbose and self._channel:
-            if self._input_queue_reserved < self._input_queue_size // 2:
-                self._request_data()
+            window = self._window_size()
+            if self._input_queue_reserved < window // 2:
+                if self._adaptive:
+                    self._adapt_window()
+                    window = self._window_size()
+                if self._input_queue_reserved < window:
+                    self._request_data(window)
         else:
             self._verbose = True
 
-        try:
-            event = self._input_queue.get(timeout=timeout)
-        except gevent.queue.Empty:
-            raise TimeoutExpired(timeout)
-
+        event = self._recv_inbox(timeout)
+        self._queued -= 1
+        self._queued_bytes -= event.size or 0
         self._input_queue_reserved -= 1
+        self._consumed += 1
         return event
 
+    def peer_capabilities(self, identity=None):
+        return self._channel.peer_capabilities(identity)
+
     @property
     def channel(self):
         return self._channel
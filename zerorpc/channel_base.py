@@ -23,8 +23,16 @@
 # SOFTWARE.
 
 
+import gevent
+import gevent.queue
+
+from .exceptions import TimeoutExpired
+
+
 class ChannelBase(object):
 
+    __slots__ = ()
+
     @property
     def context(self):
         raise NotImplementedError()
@@ -37,6 +45,19 @@ class ChannelBase(object):
     def emit_is_supported(self):
         raise NotImplementedError()
 
+    @property
+    def capabilities(self):
+        return ()
+
+    def release_channel(self, channel_id):
+        pass
+
+    def peer_capabilities(self, identity=None):
+        return ()
+
+    def advertise_capabilities(self, identity=None):
+        return True
+
     def close(self):
         raise NotImplementedError()
 
@@ -52,3 +73,80 @@ class ChannelBase(object):
 
     def recv(self, timeout=None):
         raise NotImplementedError()
+
+
+class PushChannelBase(ChannelBase):
+    """A channel handing its events over as they arrive.
+
+    Instead of each layer of a channel stack reading the layer below from its
+    own greenlet, the layer above registers itself as the receiver, and gets
+    the events through _push(), called from the greenlet dispatching them.
+    Only the topmost layer queues its events, until someone calls recv().
+
+    """
+
+    __slots__ = ('_receiver', '_inbox')
+
+    # Events queued until someone calls recv(), None for no limit. Pushing
+    # one more raises a RuntimeError, never blocks the dispatching greenlet.
+    _inbox_size = None
+
+    def _init_push(self):
+        self._receiver = None
+        self._inbox = None
+
+    def _push(self, event):
+        raise NotImplementedError()
+
+    def _deliver(self, event):
+        if self._receiver is not None:
+            self._receiver._push(event)
+            return
+        if self._inbox is None:
+            self._inbox = gevent.queue.Queue()
+        elif (self._inbox_size is not None and
+                self._inbox.qsize() >= self._inbox_size):
+            raise RuntimeError('queue overflow on event:', event)
+        self._inbox.put(event)
+
+    def _abort(self, event):
+        # Close the whole channel stack, `event` (an ERR) being the last
+        # event its reader gets.
+        top = self
+        while top._receiver is not None:
+            top = top._receiver
+        top.close()
+        if top._inbox is None:
+            top._inbox = gevent.queue.Queue()
+        top._inbox.put(event)
+
+    def _set_receiver(self, receiver):
+        self._receiver = receiver
+        inbox = self._inbox
+        self._inbox = None
+        if inbox is not None:
+            while not inbox.empty():
+                receiver._push(inbox.get_nowait())
+
+    def _attach(self, channel):
+        # Get the events of `channel` through _push. Returns the greenlet
+        # reading them if `channel` can't push them.
+        if isinstance(channel, PushChannelBase):
+            channel._set_receiver(self)
+            return None
+        return gevent.spawn(self._pull, channel)
+
+    def _pull(self, channel):
+        while True:
+            self._push(channel.recv())
+
+    def _recv_inbox(self, timeout=None):
+        if self._inbox is None:
+            self._inbox = gevent.queue.Queue()
+        if timeout and self._inbox.empty():
+            with self.context.timer_wheel.timeout(timeout):
+                return self._inbox.get()
+        try:
+            return self._inbox.get(timeout=timeout)
+        except gevent.queue.Empty:
+            raise TimeoutExpired(timeout)
@@ -0,0 +1,594 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+
+import sys
+import uuid
+import struct
+import pickle
+import decimal
+import datetime
+
+import msgpack
+
+from .compression import available_compressors
+from .exceptions import DecodeError
+
+
+def _encode_datetime(value):
+    return value.isoformat().encode('ascii')
+
+
+def _decode_datetime(data):
+    data = data.decode('ascii')
+    try:
+        return datetime.datetime.fromisoformat(data)
+    except AttributeError:
+        # Before Python 3.7, only naive datetimes can be parsed.
+        if any(c in data.partition('T')[2] for c in '+-Z'):
+            raise ValueError('can not decode timezone aware datetime {0} '
+                    'with this version of Python'.format(data))
+        fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in data else '%Y-%m-%dT%H:%M:%S'
+        return datetime.datetime.strptime(data, fmt)
+
+
+def _decode_date(data):
+    return datetime.datetime.strptime(data.decode('ascii'), '%Y-%m-%d').date()
+
+
+# (code, type, encoder, decoder), see Context.register_standard_ext_types.
+STANDARD_EXT_TYPES = (
+    (100, datetime.datetime, _encode_datetime, _decode_datetime),
+    (101, datetime.date, lambda v: v.isoformat().encode('ascii'), _decode_date),
+    (102, uuid.UUID, lambda v: v.bytes, lambda d: uuid.UUID(bytes=bytes(d))),
+    (103, decimal.Decimal, lambda v: str(v).encode('ascii'),
+        lambda d: decimal.Decimal(d.decode('ascii'))),
+)
+
+# Protocol 5 (Python >= 3.8) handles large buffers more efficiently.
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+
+
+def pickle_dumps(args):
+    return pickle.dumps(args, protocol=PICKLE_PROTOCOL)
+
+
+# Only register pickle on a Context when every peer is trusted: unpickling
+# data received from the network can run arbitrary code.
+PICKLE_SERIALIZER = (u'pickle', pickle_dumps, pickle.loads)
+
+
+# Channels released lately, remembered for the stream events still in flight.
+_max_released = 1024
+
+# ext type of the placeholders left in the event for out-of-band frames.
+OOB_EXT_CODE = 127
+# ext type of numpy arrays, see EventCodec._pack_ndarray.
+NDARRAY_EXT_CODE = 126
+
+_oob_types = (bytes, bytearray, memoryview)
+
+
+def _nbytes(value):
+    if type(value) is memoryview:
+        return value.nbytes
+    return len(value)
+
+
+def _byte_view(value):
+    # A flat view of the bytes, whatever the shape and item size.
+    view = memoryview(value)
+    if view.ndim != 1 or view.itemsize != 1:
+        try:
+            view = view.cast('B')
+        except AttributeError:
+            # Python 2.
+            view = memoryview(view.tobytes())
+    return view
+
+
+def _loaded_numpy():
+    # numpy is optional: if the application didn't import it, there can't be
+    # any array to send, and no reason to pay for its import.
+    return sys.modules.get('numpy')
+
+
+class LazyArgs(object):
+    """Arguments of a received event, still encoded.
+
+    `raw` is the slice of the received frame holding the msgpack encoded
+    arguments, `frames` the out-of-band frames they may refer to.
+    """
+
+    __slots__ = ('codec', 'raw', 'frames')
+
+    def __init__(self, codec, raw, frames):
+        self.codec = codec
+        self.raw = raw
+        self.frames = frames
+
+    def decode(self, header):
+        return self.codec.unpack_args(self.raw, header, self.frames)
+
+    def __repr__(self):
+        return '<lazy args {0} bytes>'.format(len(self.raw))
+
+
+class EventCodec(object):
+    """Serialize events to and from their wire representation.
+
+    Every `Events` instance owns one codec. The msgpack packer is created once
+    and reused for every outgoing event (it resets its internal buffer after
+    each pack), and incoming frames are decoded in one call directly from the
+    frame buffer, without an intermediate streaming unpacker.
+
+    The ext types and serializers registered on the context are applied here:
+    ext types for values msgpack doesn't know about, and serializers for the
+    arguments of events with an `enc` header field.
+
+    When `oob_threshold` is set, bytes, bytearray and memoryview arguments of
+    at least that many bytes are not copied into the event: they travel as
+    their own ZMQ frames, in front of the event frame, and are received as
+    memoryviews over the ZMQ frames. Both peers must support it.
+
+    numpy arrays are supported natively (numpy itself stays optional): dtype,
+    shape and strides travel in the event, the data inline or, above the
+    `oob_threshold`, in its own frame. The receiver rebuilds the array over
+    the received buffer without copying it (such arrays are read-only).
+
+    Events of `lazy_threshold` bytes or more are decoded in two steps: the
+    header and the name right away, the arguments only when accessed (see
+    `LazyArgs`). Routing and control messages never decode what they don't
+    look at, and an event forwarded without looking at its arguments is
+    re-packed without decoding them. Smaller events are cheaper to decode in
+    one go.
+
+    With `compression` set (to 'auto' or the name of a compressor) and a
+    peer advertising support for it, the arguments of events of at least
+    `compress_threshold` bytes are compressed. The arguments of events named
+    in `stream_event_names` are compressed with a context kept for the whole
+    channel, so that later items benefit from what earlier ones taught it;
+    `release_channel` drops it.
+
+    Subclass and pass an instance to `Events` to plug a different codec.
+    """
+
+    # Events of a channel sharing a compression context.
+    stream_event_names = (u'STREAM', u'STREAM_BATCH')
+    lazy_threshold = 1024
+    # Bytes fed to the header unpacker at first, doubled until enough.
+    _lazy_prefix = 256
+
+    def __init__(self, context=None, oob_threshold=None):
+        self._context = context
+        self._packer = msgpack.Packer(use_bin_type=True,
+                default=self._default)
+        self.oob_threshold = oob_threshold
+        self._frames = None
+        self._frames_used = 0
+        self.compression = None
+        self.compress_threshold = 1024
+        self._compressors = available_compressors()
+        self._stream_compressors = {}
+        self._stream_decompressors = {}
+        self._released_channels = {}
+
+    @property
+    def capabilities(self):
+        """What this codec can decode, to advertise to the peers."""
+        return [compressor.name for compressor in self._compressors]
+
+    def release_channel(self, channel_id):
+        self._stream_compressors.pop(channel_id, None)
+        if self._stream_decompressors.pop(channel_id, None) is not None:
+            released = self._released_channels
+            if len(released) >= _max_released:
+                del released[next(iter(released))]
+            released[channel_id] = None
+
+    @property
+    def context(self):
+        return self._context
+
+    def _default(self, obj):
+        numpy = _loaded_numpy()
+        if numpy is not None:
+            if isinstance(obj, numpy.ndarray):
+                return self._pack_ndarray(obj)
+            if isinstance(obj, numpy.generic):
+                return obj.item()
+        ext = None
+        if self._context is not None:
+            ext = self._context.ext_type_encoder(type(obj))
+        if ext is None:
+            raise TypeError('can not serialize {0!r} object'.format(
+                type(obj).__name__))
+        (code, encoder) = ext
+        return msgpack.ExtType(code, encoder(obj))
+
+    def _ndarray_buffer(self, array):
+        # C or Fortran ordered arrays are sent as is, along with their
+        # strides, anything else is made contiguous first.
+        if array.dtype.hasobject or array.dtype.fields is not None:
+            raise TypeError('can not serialize numpy array of dtype {0}'.format(
+                array.dtype))
+        if not (array.flags.c_contiguous or array.flags.f_contiguous):
+            array = _loaded_numpy().ascontiguousarray(array)
+        return (array.strides, memoryview(array.ravel(order='K')))
+
+    def _pack_ndarray(self, array, frames=None):
+        # The data is either inline, or the distance of its out-of-band frame.
+        (strides, data) = self._ndarray_buffer(array)
+        if frames is None:
+            data = data.tobytes()
+        else:
+            frames.append(data)
+            data = len(frames)
+        return msgpack.ExtType(NDARRAY_EXT_CODE, msgpack.packb(
+            (array.dtype.str, array.shape, strides, data), use_bin_type=True))
+
+    def _unpack_ndarray(self, data):
+        (dtype, shape, strides, data) = msgpack.unpackb(data, raw=False)
+        if isinstance(data, int):
+            data = self._frame_buffer(data)
+        import numpy
+        return numpy.ndarray(shape=shape, dtype=dtype, buffer=data,
+                strides=strides)
+
+    def _frame_buffer(self, distance):
+        # The distance comes from the remote: checked against the frames
+        # received, and the "oob" header once decoded (see unpack).
+        if not 1 <= distance <= len(self._frames):
+            raise DecodeError('invalid out-of-band frame {0}'.format(
+                distance))
+        self._frames_used = max(self._frames_used, distance)
+        frame = self._frames[-distance]
+        return memoryview(getattr(frame, 'buffer', frame))
+
+    def _ext_hook(self, code, data):
+        if code == OOB_EXT_CODE and self._frames is not None:
+            (distance,) = struct.unpack('>I', data)
+            return self._frame_buffer(distance)
+        if code == NDARRAY_EXT_CODE:
+            try:
+                return self._unpack_ndarray(data)
+            except ImportError:
+                pass
+        decoder = None
+        if self._context is not None:
+            decoder = self._context.ext_type_decoder(code)
+        if decoder is None:
+            return msgpack.ExtType(code, data)
+        return decoder(data)
+
+    def _serializer(self, encoding):
+        serializer = None
+        if self._context is not None:
+            serializer = self._context.serializer(encoding)
+        if serializer is None:
+            raise Exception('unsupported encoding "{0}"'.format(encoding))
+        return serializer
+
+    def _deserializer(self, encoding):
+        serializer = None
+        if self._context is not None:
+            serializer = self._context.serializer(encoding)
+        if serializer is None:
+            raise DecodeError('unsupported encoding "{0}"'.format(encoding))
+        return serializer[1]
+
+    def _extract_frames(self, value, frames):
+        # Replace the large buffers found in `value` by placeholders, frames
+        # are appended in reverse wire order, so that a placeholder only needs
+        # to know its distance from the event frame, which is always last.
+        vtype = type(value)
+        if vtype in _oob_types:
+            if _nbytes(value) < self.oob_threshold:
+                return value
+            if vtype is memoryview and not value.contiguous:
+                value = value.tobytes()
+            frames.append(value)
+            return msgpack.ExtType(OOB_EXT_CODE,
+                    struct.pack('>I', len(frames)))
+        if vtype in (tuple, list):
+            return [self._extract_frames(v, frames) for v in value]
+        if vtype is dict:
+            return dict((k, self._extract_frames(v, frames))
+                    for (k, v) in value.items())
+        numpy = _loaded_numpy()
+        if (numpy is not None and isinstance(value, numpy.ndarray) and
+                value.nbytes >= self.oob_threshold):
+            return self._pack_ndarray(value, frames)
+        return value
+
+    def pack(self, event):
+        """Return the event as a single msgpack blob."""
+        lazy = getattr(event, 'lazy_args', None)
+        if lazy is not None and not lazy.frames:
+            # Forward the still encoded arguments untouched: 0x93 is the
+            # msgpack header of an array of 3 elements.
+            return b''.join((b'\x93', self._packer.pack(event.header),
+                self._packer.pack(event.name), lazy.raw))
+        args = event.args
+        encoding = event.header.get(u'enc')
+        if encoding is not None:
+            args = self._serializer(encoding)[0](args)
+        return self._packer.pack((event.header, event.name, args))
+
+    def pack_fragments(self, frames, max_size, fragment_id):
+        """Split the frames of an event in messages of `max_size` bytes at most.
+
+        Each message is a chunk of one of the frames, followed by a
+        "_zpc_frag" event with [fragment_id, last chunk of the frame, last
+        chunk of the event] as arguments. Chunks are views, nothing is copied.
+
+        """
+        chunks = []
+        for frame in frames:
+            view = _byte_view(frame)
+            size = len(view)
+            for offset in range(0, max(size, 1), max_size):
+                chunks.append((view[offset:offset + max_size],
+                    offset + max_size >= size))
+        header = {u'v': 3, u'oob': 1}
+        last = len(chunks) - 1
+        for (i, (chunk, end_of_frame)) in enumerate(chunks):
+            args = (fragment_id, end_of_frame, i == last)
+            yield [chunk, self._packer.pack((header, u'_zpc_frag', args))]
+
+    def _select_compressor(self, peer_caps):
+        if self.compression is None or not peer_caps:
+            return None
+        for compressor in self._compressors:
+            if (compressor.name in peer_caps and
+                    self.compression in (u'auto', compressor.name)):
+                return compressor
+        return None
+
+    def _compress(self, compressor, header, name, raw):
+        # Return the packed (possibly compressed) arguments, updating header.
+        if len(raw) < self.compress_threshold:
+            return raw
+        if (name in self.stream_event_names and
+                compressor.stream_compressor is not None):
+            channel_id = header.get(u'response_to') or header[u'message_id']
+            compress = self._stream_compressors.get(channel_id)
+            if compress is None:
+                compress = compressor.stream_compressor()
+                self._stream_compressors[channel_id] = compress
+            # The peer must see every chunk out of this context, even the
+            # ones that didn't compress well.
+            header[u'z_stream'] = True
+        else:
+            compress = compressor.compress
+        data = compress(raw)
+        if len(data) >= len(raw) and u'z_stream' not in header:
+            return raw
+        header[u'z'] = compressor.name
+        return self._packer.pack(data)
+
+    def _decompress(self, header, data):
+        name = header.pop(u'z')
+        for compressor in self._compressors:
+            if compressor.name == name:
+                break
+        else:
+            raise DecodeError('unsupported compression "{0}"'.format(name),
+                    header)
+        if header.pop(u'z_stream', False):
+            channel_id = header.get(u'response_to') or header[u'message_id']
+            decompress = self._stream_decompressors.get(channel_id)
+            if decompress is None:
+                if channel_id in self._released_channels:
+                    # Sent before the remote knew the channel was closed:
+                    # the start of the stream is gone with the context.
+                    raise DecodeError('stream of a closed channel', header)
+                decompress = compressor.stream_decompressor()
+                self._stream_decompressors[channel_id] = decompress
+            try:
+                return decompress(data)
+            except Exception as e:
+                del self._stream_decompressors[channel_id]
+                raise DecodeError('invalid compressed stream: {0}'.format(e),
+                        header)
+        try:
+            return compressor.decompress(data)
+        except Exception as e:
+            raise DecodeError('invalid compressed data: {0}'.format(e),
+                    header)
+
+    def pack_frames(self, event, peer_caps=None):
+        """Return the list of frames of the event, the msgpack blob last.
+
+        `peer_caps` are the capabilities advertised by the receiving peer.
+
+        """
+        compressor = self._select_compressor(peer_caps)
+        if compressor is not None:
+            return self._pack_compressed_frames(event, compressor)
+        if self.oob_threshold is None or u'enc' in event.header:
+            return [self.pack(event)]
+        frames = []
+        args = self._extract_frames(event.args, frames)
+        if not frames:
+            return [self.pack(event)]
+        header = dict(event.header)
+        header[u'oob'] = len(frames)
+        frames.reverse()
+        frames.append(self._packer.pack((header, event.name, args)))
+        return frames
+
+    def _pack_compressed_frames(self, event, compressor):
+        frames = []
+        header = dict(event.header)
+        args = event.args
+        encoding = header.get(u'enc')
+        if encoding is not None:
+            args = self._serializer(encoding)[0](args)
+        elif self.oob_threshold is not None:
+            args = self._extract_frames(args, frames)
+        raw = self._compress(compressor, header, event.name,
+                self._packer.pack(args))
+        if frames:
+            header[u'oob'] = len(frames)
+            frames.reverse()
+        frames.append(b''.join((b'\x93', self._packer.pack(header),
+            self._packer.pack(event.name), raw)))
+        return frames
+
+    def pack_batch(self, blobs):
+        """Pack already packed events into a single '_zpc_batch' event."""
+        return self._packer.pack(({u'v': 3}, u'_zpc_batch', blobs))
+
+    def unpack(self, blob, frames=None, lazy=False):
+        """Decode a msgpack blob, `frames` are the frames preceding it.
+
+        With `lazy`, large events get a `LazyArgs` in place of their
+        arguments.
+
+        """
+        if (lazy and self.lazy_threshold is not None and
+                len(blob) >= self.lazy_threshold):
+            unpacked = self._unpack_header(blob)
+            if unpacked is not None:
+                (header, name, offset) = unpacked
+                if frames is not None:
+                    # Only the out-of-band frames, not the envelope.
+                    oob = header.get(u'oob', 0)
+                    if oob > len(frames):
+                        raise DecodeError('missing out-of-band frames',
+                                header)
+                    frames = frames[len(frames) - oob:] if oob else []
+                raw = memoryview(blob)[offset:]
+                if u'z' in header:
+                    try:
+                        raw = msgpack.unpackb(raw)
+                    except Exception as e:
+                        raise DecodeError('invalid compressed data: {0}'
+                                .format(e), header)
+                    raw = self._decompress(header, raw)
+                return (header, name, LazyArgs(self, raw, frames))
+
+        self._frames = frames
+        self._frames_used = 0
+        try:
+            unpacked_msg = msgpack.unpackb(blob, raw=False,
+                    ext_hook=self._ext_hook)
+        except Exception as e:
+            # Like an ext type decoder failing, or a message too large:
+            # still an answer for the sender, if the header can be read.
+            unpacked = self._unpack_header(blob)
+            header = None if unpacked is None else unpacked[0]
+            if isinstance(e, DecodeError):
+                if e.header is None:
+                    e.header = header
+                raise
+            raise DecodeError('unable to decode event: {0!r}'.format(e),
+                    header)
+        finally:
+            self._frames = None
+
+        try:
+            (header, name, args) = unpacked_msg
+        except Exception as e:
+            raise DecodeError('invalid msg format "{0}": {1}'.format(
+                unpacked_msg, e))
+
+        # Backward compatibility
+        if not isinstance(header, dict):
+            header = {}
+
+        if self._frames_used > header.get(u'oob', 0):
+            raise DecodeError('invalid out-of-band frame {0}'.format(
+                self._frames_used), header)
+
+        try:
+            if u'z' in header:
+                raw = self._decompress(header, args)
+                return (header, name, self.unpack_args(raw, header, frames))
+
+            encoding = header.get(u'enc')
+            if encoding is not None:
+                args = self._deserializer(encoding)(args)
+        except DecodeError as e:
+            # Enough to tell the sender (see ChannelMultiplexer).
+            if e.header is None:
+                e.header = header
+            raise
+        except Exception as e:
+            raise DecodeError('unable to decode arguments: {0!r}'.format(e),
+                    header)
+
+        return (header, name, args)
+
+    def _unpack_header(self, blob):
+        # Return (header, name, offset of the arguments), or None when the
+        # blob doesn't look like an event, leaving it to the full decoding to
+        # report the error.
+        view = memoryview(blob)
+        unpacker = msgpack.Unpacker(raw=False)
+        fed = 0
+        size = self._lazy_prefix
+        values = []
+        while len(values) < 3:
+            try:
+                if not values:
+                    values.append(unpacker.read_array_header())
+                    if values[0] != 3:
+                        return None
+                else:
+                    values.append(unpacker.unpack())
+            except msgpack.OutOfData:
+                if fed >= len(view):
+                    return None
+                unpacker.feed(view[fed:fed + size])
+                fed += size
+                size *= 2
+            except Exception:
+                return None
+        (_, header, name) = values
+        if not isinstance(header, dict):
+            header = {}
+        return (header, name, unpacker.tell())
+
+    def unpack_args(self, raw, header, frames=None):
+        """Decode the arguments of an event unpacked lazily."""
+        self._frames = frames
+        try:
+            args = msgpack.unpackb(raw, raw=False, ext_hook=self._ext_hook)
+            encoding = header.get(u'enc')
+            if encoding is not None:
+                args = self._deserializer(encoding)(args)
+        except DecodeError as e:
+            if e.header is None:
+                e.header = header
+            raise
+        except Exception as e:
+            raise DecodeError('unable to decode arguments: {0!r}'.format(e),
+                    header)
+        finally:
+            self._frames = None
+        return args
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class ZlibCompressor(object):
+    name = u'zlib'
+
+    def __init__(self, level=6):
+        self._level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self._level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+    def stream_compressor(self):
+        compressobj = zlib.compressobj(self._level)
+
+        def compress(data):
+            return compressobj.compress(data) + \
+                compressobj.flush(zlib.Z_SYNC_FLUSH)
+        return compress
+
+    def stream_decompressor(self):
+        return zlib.decompressobj().decompress
+
+
+class ZstdCompressor(object):
+    name = u'zstd'
+
+    def __init__(self, level=3):
+        self._level = level
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    # A stream has a context of its own: any other use of the context a
+    # compressobj (or decompressobj) comes from resets it.
+    def stream_compressor(self):
+        compressobj = zstandard.ZstdCompressor(
+            level=self._level).compressobj()
+
+        def compress(data):
+            return compressobj.compress(data) + \
+                compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return compress
+
+    def stream_decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+class Lz4Compressor(object):
+    name = u'lz4'
+
+    def compress(self, data):
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        return lz4.frame.decompress(data)
+
+    # lz4 frames can't be flushed without ending them, so there is no stream
+    # context to carry from an event to the next.
+    stream_compressor = None
+    stream_decompressor = None
+
+
+def available_compressors():
+    """Return the usable compressors, by order of preference."""
+    compressors = []
+    if zstandard is not None:
+        compressors.append(ZstdCompressor())
+    if lz4 is not None:
+        compressors.append(Lz4Compressor())
+    compressors.append(ZlibCompressor())
+    return compressors
@@ -28,8 +28,13 @@ from future.utils import tobytes
 
 import uuid
 import random
+import struct
+import binascii
+import weakref
+import gevent
 
 from . import gevent_zmq as zmq
+from .timers import TimerWheel
 
 
 class Context(zmq.Context):
@@ -50,6 +55,10 @@ class Context(zmq.Context):
             'client_after_request': [],
             'client_patterns_list': [],
         }
+        self._ext_encoders = {}
+        self._ext_decoders = {}
+        self._serializers = {}
+        self._timer_wheels = weakref.WeakKeyDictionary()
         self._reset_msgid()
 
     # NOTE: pyzmq 13.0.0 messed up with setattr (they turned it into a
@@ -72,6 +81,38 @@ class Context(zmq.Context):
     def _hooks(self, value):
         self.__dict__['_hooks'] = value
 
+    @property
+    def _ext_encoders(self):
+        return self.__dict__['_ext_encoders']
+
+    @_ext_encoders.setter
+    def _ext_encoders(self, value):
+        self.__dict__['_ext_encoders'] = value
+
+    @property
+    def _ext_decoders(self):
+        return self.__dict__['_ext_decoders']
+
+    @_ext_decoders.setter
+    def _ext_decoders(self, value):
+        self.__dict__['_ext_decoders'] = value
+
+    @property
+    def _serializers(self):
+        return self.__dict__['_serializers']
+
+    @_serializers.setter
+    def _serializers(self, value):
+        self.__dict__['_serializers'] = value
+
+    @property
+    def _timer_wheels(self):
+        return self.__dict__['_timer_wheels']
+
+    @_timer_wheels.setter
+    def _timer_wheels(self, value):
+        self.__dict__['_timer_wheels'] = value
+
     @property
     def _msg_id_base(self):
         return self.__dict__['_msg_id_base']
@@ -102,6 +143,16 @@ class Context(zmq.Context):
             Context._instance = Context()
         return Context._instance
 
+    @property
+    def timer_wheel(self):
+        """The TimerWheel used for the timeouts and heartbeats, one per hub
+        (so per thread) using the context."""
+        hub = gevent.get_hub()
+        wheel = self._timer_wheels.get(hub)
+        if wheel is None:
+            wheel = self._timer_wheels[hub] = TimerWheel()
+        return wheel
+
     def _reset_msgid(self):
         self._msg_id_base = tobytes(uuid.uuid4().hex)[8:]
         self._msg_id_counter = random.randrange(0, 2 ** 32)
@@ -112,7 +163,10 @@ class Context(zmq.Context):
             self._reset_msgid()
         else:
             self._msg_id_counter = (self._msg_id_counter + 1)
-        return tobytes('{0:08x}'.format(self._msg_id_counter)) + self._msg_id_base
+        # Same bytes as '{0:08x}'.format(counter), without the string
+        # formatting round trip.
+        return binascii.hexlify(struct.pack('>I', self._msg_id_counter)) + \
+            self._msg_id_base
 
     def register_middleware(self, middleware_instance):
         registered_count = 0
@@ -129,6 +183,57 @@ class Context(zmq.Context):
                 registered_count += 1
         return registered_count
 
+    #
+    # serialization
+    #
+    def register_ext_type(self, code, cls, encoder, decoder):
+        """Teach the event codec to carry instances of `cls`.
+
+        `encoder(obj)` must return bytes, which are sent as the msgpack ext
+        type `code`. `decoder(data)` gets those bytes back on the receiving
+        side. Codes 0 to 99 are free for applications, zerorpc uses the
+        codes starting from 100.
+
+        """
+        if not 0 <= code <= 127:
+            raise ValueError('msgpack ext type code must be in [0, 127]')
+        self._ext_encoders[cls] = (code, encoder)
+        self._ext_decoders[code] = decoder
+
+    def ext_type_encoder(self, cls):
+        """Return (code, encoder) for `cls` or one of its bases, or None."""
+        ext = self._ext_encoders.get(cls)
+        if ext is None:
+            for base in cls.__mro__[1:]:
+                ext = self._ext_encoders.get(base)
+                if ext is not None:
+                    self._ext_encoders[cls] = ext
+                    break
+        return ext
+
+    def ext_type_decoder(self, code):
+        return self._ext_decoders.get(code)
+
+    def register_standard_ext_types(self):
+        """Register the ext types for datetime, date, UUID and Decimal."""
+        from .codec import STANDARD_EXT_TYPES
+        for (code, cls, encoder, decoder) in STANDARD_EXT_TYPES:
+            self.register_ext_type(code, cls, encoder, decoder)
+
+    def register_serializer(self, name, dumps, loads):
+        """Register an alternative encoding for the arguments of events.
+
+        Events carrying the header field `enc` set to `name` have their
+        arguments encoded with `dumps(args)` (which must return bytes) and
+        decoded with `loads(data)`.
+
+        """
+        self._serializers[name] = (dumps, loads)
+
+    def serializer(self, name):
+        """Return (dumps, loads) for the encoding `name`, or None."""
+        return self._serializers.get(name)
+
     #
     # client/server
     #
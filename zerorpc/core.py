@@ -29,7 +29,10 @@ from builtins import zip
 from future.utils import iteritems
 
 import sys
+import time
 import traceback
+import binascii
+import numbers
 import gevent.pool
 import gevent.queue
 import gevent.event
@@ -37,22 +40,67 @@ import gevent.local
 import gevent.lock
 
 from . import gevent_zmq as zmq
-from .exceptions import TimeoutExpired, RemoteError, LostRemote
+from .exceptions import TimeoutExpired, RemoteError, LostRemote, Overloaded
 from .channel import ChannelMultiplexer, BufferedChannel
 from .socket import SocketBase
 from .heartbeat import HeartBeatOnChannel
 from .context import Context
 from .decorators import DecoratorBase, rep
+from .scheduler import Request, FifoScheduler, Bulkhead, PeerRegistry
 from . import patterns
 from logging import getLogger
 
 logger = getLogger(__name__)
 
+# The request (see Request) the current task works for, its deadline is
+# shared with the tasks forked from it.
+_task_request = gevent.local.local()
+
+
+def remaining_time():
+    '''Seconds left before the deadline of the current task, or None.
+
+        A zerorpc.Server task gets the deadline of the client it answers
+        (its timeout), and the zerorpc.Client calls it makes don't wait any
+        longer than that. The deadline is for the first reply: once a stream
+        started, it goes on for as long as it takes. See also
+        fork_task_context.
+    '''
+    request = getattr(_task_request, 'request', None)
+    if request is None or request.deadline is None:
+        return None
+    return request.deadline - time.time()
+
+
+def _reply_started():
+    # The client got an answer in time, no more deadline for the task.
+    request = getattr(_task_request, 'request', None)
+    if request is not None:
+        request.deadline = None
+
+
+def _number(value):
+    # A number from a header of the remote, None if it isn't one.
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return value
+    return None
+
 
 class ServerBase(object):
 
+    # Requests wait for a slot of the pool (of `pool_size` tasks) in a queue
+    # of `backlog` requests at most: when it's full, they are rejected right
+    # away (the client raises Overloaded) instead of piling up unseen in the
+    # socket until their clients time out. The `scheduler` decides in which
+    # order they leave the queue (see FifoScheduler). Without a `backlog`, a
+    # request waiting in the queue stops the server from reading the next
+    # ones: they wait in the socket, pushing back on the clients.
+    # A method can get a Bulkhead (limiting how many tasks run it at once)
+    # from its decorator (see DecoratorBase.options), or `bulkheads`, a dict
+    # of method name -> Bulkhead.
     def __init__(self, channel, methods=None, name=None, context=None,
-            pool_size=None, heartbeat=5):
+            pool_size=None, heartbeat=5, heartbeat_delay=None, backlog=None,
+            scheduler=None, bulkheads=None):
         self._multiplexer = ChannelMultiplexer(channel)
 
         if methods is None:
@@ -61,16 +109,31 @@ class ServerBase(object):
         self._context = context or Context.get_instance()
         self._name = name or self._extract_name()
         self._task_pool = gevent.pool.Pool(size=pool_size)
+        self._scheduler = scheduler or FifoScheduler()
+        self._peers = PeerRegistry()
+        self._backlog = backlog
+        self._dequeued = gevent.event.Event()
+        self._service_time = None
         self._acceptor_task = None
+        # expired: requests dropped unanswered, their client having given
+        # up before a task could work on them. rejected: requests turned
+        # down, the backlog being full.
+        self._stats = {'expired': 0, 'rejected': 0}
         self._methods = self._filter_methods(ServerBase, self, methods)
 
         self._inject_builtins()
         self._heartbeat_freq = heartbeat
+        self._heartbeat_delay = heartbeat_delay
 
         for (k, functor) in iteritems(self._methods):
             if not isinstance(functor, DecoratorBase):
                 self._methods[k] = rep(functor)
 
+        self._bulkheads = dict((k, Bulkhead(functor.concurrency,
+            functor.queue_size)) for (k, functor) in iteritems(self._methods)
+            if functor.concurrency is not None)
+        self._bulkheads.update(bulkheads or {})
+
     @staticmethod
     def _filter_methods(cls, self, methods):
         if isinstance(methods, dict):
@@ -120,6 +183,16 @@ class ServerBase(object):
         self._methods['_zerorpc_args'] = \
             lambda m: self._methods[m]._zerorpc_args()
         self._methods['_zerorpc_inspect'] = self._zerorpc_inspect
+        self._methods['_zerorpc_bulkheads'] = lambda: dict((m, b.stats)
+                for (m, b) in iteritems(self._bulkheads))
+        self._methods['_zerorpc_peers'] = self._zerorpc_peers
+        self._methods['_zerorpc_stats'] = lambda: dict(self._stats)
+
+    def _zerorpc_peers(self):
+        # ZMQ identities are binary, they are given in hexadecimal.
+        return dict(('.'.join(binascii.hexlify(frame).decode()
+            for frame in peer or ()), stats)
+            for (peer, stats) in iteritems(self._peers.stats))
 
     def __call__(self, method, *args):
         if method not in self._methods:
@@ -137,13 +210,27 @@ class ServerBase(object):
         human_msg = str(exc_value)
         return (name, human_msg, human_traceback)
 
-    def _async_task(self, initial_event):
+    def _async_task(self, request):
+        initial_event = request.event
+        if request.deadline is not None:
+            if time.time() >= request.deadline:
+                self._stats['expired'] += 1
+                logger.debug('dropping expired request %s',
+                        initial_event.name)
+                return
+        _task_request.request = request
         protocol_v1 = initial_event.header.get(u'v', 1) < 2
         channel = self._multiplexer.channel(initial_event)
         hbchan = HeartBeatOnChannel(channel, freq=self._heartbeat_freq,
-                passive=protocol_v1)
+                passive=protocol_v1, delay=self._heartbeat_delay)
         bufchan = BufferedChannel(hbchan)
+        # The client gave up: stop working for it (see
+        # BufferedChannel.cancel), closing the iterator of a stream.
+        task = gevent.getcurrent()
+        bufchan.on_cancel = lambda: task.kill(block=False)
         exc_infos = None
+        functor = None
+        started_at = time.time()
         event = bufchan.recv()
         try:
             self._context.hook_load_task_context(event.header)
@@ -164,11 +251,100 @@ class ServerBase(object):
         finally:
             del exc_infos
             bufchan.close()
+            if isinstance(getattr(functor, 'pattern', None), patterns.ReqRep):
+                # Average time a call takes, for the hint given with
+                # Overloaded. Streams last as long as their client wants.
+                elapsed = time.time() - started_at
+                if self._service_time is None:
+                    self._service_time = elapsed
+                else:
+                    self._service_time += (elapsed - self._service_time) * 0.1
+
+    def _queued(self):
+        # The backlog: requests waiting for a task, or for their bulkhead.
+        return self._scheduler.qsize() + sum(bulkhead.queued
+                for bulkhead in self._bulkheads.values())
+
+    def _retry_after(self):
+        # Time for the pool to go through the backlog.
+        slots = self._task_pool.size or 1
+        return (self._service_time or 0) * (self._queued() + 1) / slots
+
+    def _reject(self, initial_event, name, msg, xheader=None):
+        channel = self._multiplexer.channel(initial_event)
+        try:
+            if initial_event.header.get(u'v', 1) < 2:
+                args = ('{0}: {1}'.format(name, msg),)
+            else:
+                args = (name, msg, None)
+            channel.emit(u'ERR', args, xheader)
+        finally:
+            channel.close()
 
-    def _acceptor(self):
+    def _overloaded(self, initial_event, retry_after):
+        self._stats['rejected'] += 1
+        self._reject(initial_event, 'Overloaded',
+                'server overloaded, retry in {0:.3f}s'.format(retry_after),
+                {u'retry_after': retry_after})
+
+    def _dispatcher(self):
         while True:
-            initial_event = self._multiplexer.recv()
-            self._task_pool.spawn(self._async_task, initial_event)
+            # The requests stay in the backlog until a task can take them.
+            self._task_pool.wait_available()
+            request = self._scheduler.get()
+            self._dequeued.set()
+            self._peers.started(request)
+            task = self._task_pool.spawn(self._async_task, request)
+            task.rawlink(lambda task, request=request:
+                    self._task_done(request))
+
+    def _task_done(self, request):
+        # From the hub, without blocking.
+        self._peers.done(request)
+        self._scheduler.done(request)
+        bulkhead = self._bulkheads.get(request.event.name)
+        if bulkhead is not None:
+            request = bulkhead.release()
+            if request is not None:
+                self._scheduler.put(request)
+
+    def _request(self, initial_event):
+        received_at = time.time()
+        timeout = _number(initial_event.header.get(u'timeout'))
+        deadline = None if timeout is None else received_at + timeout
+        priority = _number(initial_event.header.get(u'priority'))
+        if priority is None:
+            functor = self._methods.get(initial_event.name)
+            priority = getattr(functor, 'priority', None)
+        return Request(initial_event, received_at, deadline, priority,
+                self._multiplexer._peer_key(initial_event.identity))
+
+    def _acceptor(self):
+        dispatcher = gevent.spawn(self._dispatcher)
+        try:
+            while True:
+                initial_event = self._multiplexer.recv()
+                request = self._request(initial_event)
+                self._peers.received(request)
+                bulkhead = self._bulkheads.get(initial_event.name)
+                if (self._backlog is not None and
+                        self._task_pool.full() and
+                        self._queued() >= self._backlog):
+                    self._overloaded(initial_event, self._retry_after())
+                    continue
+                if bulkhead is not None and bulkhead.full:
+                    bulkhead.reject()
+                    self._overloaded(initial_event,
+                            (self._service_time or 0) *
+                            (bulkhead.queue_size + 1) / bulkhead.concurrency)
+                    continue
+                if bulkhead is None or bulkhead.admit(request):
+                    self._scheduler.put(request)
+                while self._backlog is None and self._scheduler.qsize():
+                    self._dequeued.clear()
+                    self._dequeued.wait()
+        finally:
+            dispatcher.kill()
 
     def run(self):
         self._acceptor_task = gevent.spawn(self._acceptor)
@@ -187,13 +363,19 @@ class ServerBase(object):
 class ClientBase(object):
 
     def __init__(self, channel, context=None, timeout=30, heartbeat=5,
-            passive_heartbeat=False):
+            passive_heartbeat=False, heartbeat_delay=None,
+            stream_batching=True):
+        # Without stream_batching, the server is not told the client can
+        # take STREAM_BATCH events, and streams one item per event.
         self._multiplexer = ChannelMultiplexer(channel,
-                ignore_broadcast=True)
+                ignore_broadcast=True,
+                capabilities=patterns.ReqStream.capabilities
+                if stream_batching else ())
         self._context = context or Context.get_instance()
         self._timeout = timeout
         self._heartbeat_freq = heartbeat
         self._passive_heartbeat = passive_heartbeat
+        self._heartbeat_delay = heartbeat_delay
 
     def close(self):
         self._multiplexer.close()
@@ -203,7 +385,10 @@ class ClientBase(object):
         if not exception:
             if event.header.get(u'v', 1) >= 2:
                 (name, msg, traceback) = event.args
-                exception = RemoteError(name, msg, traceback)
+                if name == 'Overloaded' and u'retry_after' in event.header:
+                    exception = Overloaded(msg, event.header[u'retry_after'])
+                else:
+                    exception = RemoteError(name, msg, traceback)
             else:
                 (msg,) = event.args
                 exception = RemoteError('RemoteError', msg, None)
@@ -217,9 +402,10 @@ class ClientBase(object):
                 return pattern
         return None
 
-    def _process_response(self, request_event, bufchan, timeout):
+    def _process_response(self, request_event, bufchan, timeout,
+            prefetch=None):
         def raise_error(ex):
-            bufchan.close()
+            bufchan.cancel()
             self._context.hook_client_after_request(request_event, None, ex)
             raise ex
 
@@ -234,6 +420,10 @@ class ClientBase(object):
             raise_error(RuntimeError(
                 'Unable to find a pattern for: {0}'.format(request_event)))
 
+        if prefetch:
+            return pattern.process_answer(self._context, bufchan,
+                    request_event, reply_event, self._handle_remote_error,
+                    prefetch=prefetch)
         return pattern.process_answer(self._context, bufchan, request_event,
                 reply_event, self._handle_remote_error)
 
@@ -256,25 +446,37 @@ class ClientBase(object):
             method = method.decode('utf-8')
 
         timeout = kargs.get('timeout', self._timeout)
+        remaining = remaining_time()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            timeout = max(remaining, 0)
         channel = self._multiplexer.channel()
         hbchan = HeartBeatOnChannel(channel, freq=self._heartbeat_freq,
-                passive=self._passive_heartbeat)
+                passive=self._passive_heartbeat, delay=self._heartbeat_delay)
         bufchan = BufferedChannel(hbchan, inqueue_size=kargs.get('slots', 100))
 
         xheader = self._context.hook_get_task_context()
+        if timeout is not None:
+            # The server doesn't start working on a request the client
+            # already gave up on.
+            xheader[u'timeout'] = timeout
+        if kargs.get('priority') is not None:
+            xheader[u'priority'] = kargs['priority']
         request_event = bufchan.new_event(method, args, xheader)
         self._context.hook_client_before_request(request_event)
         bufchan.emit_event(request_event)
 
         # In python 3.7, "async" is a reserved keyword, clients should now use
         # "async_": support both for the time being
+        # `prefetch` items of a stream are received ahead of the consumer.
+        prefetch = kargs.get('prefetch')
         if (kargs.get('async', False) is False and
             kargs.get('async_', False) is False):
-            return self._process_response(request_event, bufchan, timeout)
+            return self._process_response(request_event, bufchan, timeout,
+                    prefetch)
 
         async_result = gevent.event.AsyncResult()
         gevent.spawn(self._process_response, request_event, bufchan,
-                timeout).link(async_result)
+                timeout, prefetch).link(async_result)
         return async_result
 
     def __getattr__(self, method):
@@ -284,7 +486,8 @@ class ClientBase(object):
 class Server(SocketBase, ServerBase):
 
     def __init__(self, methods=None, name=None, context=None, pool_size=None,
-            heartbeat=5):
+            heartbeat=5, heartbeat_delay=None, backlog=None, scheduler=None,
+            bulkheads=None):
         SocketBase.__init__(self, zmq.ROUTER, context)
         if methods is None:
             methods = self
@@ -292,7 +495,8 @@ class Server(SocketBase, ServerBase):
         name = name or ServerBase._extract_name(methods)
         methods = ServerBase._filter_methods(Server, self, methods)
         ServerBase.__init__(self, self._events, methods, name, context,
-                pool_size, heartbeat)
+                pool_size, heartbeat, heartbeat_delay, backlog, scheduler,
+                bulkheads)
 
     def close(self):
         ServerBase.close(self)
@@ -302,10 +506,11 @@ class Server(SocketBase, ServerBase):
 class Client(SocketBase, ClientBase):
 
     def __init__(self, connect_to=None, context=None, timeout=30, heartbeat=5,
-            passive_heartbeat=False):
+            passive_heartbeat=False, heartbeat_delay=None,
+            stream_batching=True):
         SocketBase.__init__(self, zmq.DEALER, context=context)
         ClientBase.__init__(self, self._events, context, timeout, heartbeat,
-                passive_heartbeat)
+                passive_heartbeat, heartbeat_delay, stream_batching)
         if connect_to:
             self.connect(connect_to)
 
@@ -422,13 +627,19 @@ def fork_task_context(functor, context=None):
         context. This permit passing the trace_id from a zerorpc.Server to
         another via zerorpc.Client.
 
+        The deadline of the initial event (see remaining_time) is inherited
+        the same way.
+
         The simple rule to know if a task need to be wrapped is:
             - if the new task will make any zerorpc call, it should be wrapped.
     '''
     context = context or Context.get_instance()
     xheader = context.hook_get_task_context()
+    request = getattr(_task_request, 'request', None)
 
     def wrapped(*args, **kargs):
         context.hook_load_task_context(xheader)
+        if request is not None:
+            _task_request.request = request
         return functor(*args, **kargs)
     return wrapped
@@ -29,16 +29,48 @@ from .patterns import ReqRep, ReqStream
 
 class DecoratorBase(object):
     pattern = None
+    # The class of the calls for the scheduler of the server, when the
+    # client doesn't give one (see FifoScheduler).
+    priority = None
+    # The limits of the Bulkhead of the method on the server, if any.
+    concurrency = None
+    queue_size = None
 
-    def __init__(self, functor):
+    def __init__(self, functor, pattern=None, priority=None,
+            concurrency=None, queue_size=None):
         self._functor = functor
         self.__doc__ = functor.__doc__
         self.__name__ = getattr(functor, "__name__", str(functor))
+        if pattern is not None:
+            self.pattern = pattern
+        if priority is not None:
+            self.priority = priority
+        if concurrency is not None:
+            if concurrency < 1:
+                raise ValueError('concurrency must be > 0, got {0!r}'.format(
+                    concurrency))
+            self.concurrency = concurrency
+            self.queue_size = queue_size
+        elif queue_size is not None:
+            raise ValueError('queue_size needs a concurrency')
 
     def __get__(self, instance, type_instance=None):
         if instance is None:
             return self
-        return self.__class__(self._functor.__get__(instance, type_instance))
+        return self.__class__(self._functor.__get__(instance, type_instance),
+                self.pattern, self.priority, self.concurrency,
+                self.queue_size)
+
+    @classmethod
+    def options(cls, priority=None, concurrency=None, queue_size=None,
+            **kargs):
+        """A decorator with options, for example
+        @zerorpc.rep.options(priority=10, concurrency=2), or
+        @zerorpc.stream.options(produce_ahead=100) (the others are given to
+        the pattern)."""
+        pattern = type(cls.pattern)(**kargs) if kargs else None
+        return lambda functor: cls(functor, pattern, priority, concurrency,
+                queue_size)
 
     def __call__(self, *args, **kargs):
         return self._functor(*args, **kargs)
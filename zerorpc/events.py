@@ -25,21 +25,23 @@
 
 from __future__ import absolute_import
 from builtins import str
-from builtins import range
 
-import msgpack
 import gevent.pool
 import gevent.queue
 import gevent.event
 import gevent.local
 import gevent.lock
 import logging
+import time
 import sys
+from collections import deque, OrderedDict
+from zmq.utils.monitor import recv_monitor_message
 
 from . import gevent_zmq as zmq
-from .exceptions import TimeoutExpired
+from .exceptions import TimeoutExpired, DecodeError
 from .context import Context
 from .channel_base import ChannelBase
+from .codec import EventCodec, LazyArgs, _nbytes
 
 
 if sys.version_info < (2, 7):
@@ -56,31 +58,62 @@ if sys.version_info >= (3, 0) and gevent.version_info <= (1, 1, 0, 'rc', '5'):
 
 logger = logging.getLogger(__name__)
 
+# Events being reassembled from fragments, at most, and their bytes.
+_max_fragmented = 1024
+_max_fragmented_bytes = 256 * 1024 * 1024
+
+# An event is dropped when its fragments take longer than that to arrive.
+_fragments_ttl = 60
+
+# Bytes the pipe of a connection holds with fragmentation, see
+# Events.enable_fragmentation.
+_fragments_pipe_bytes = 256 * 1024 * 1024
+
+# Capabilities are remembered for that many peers at most.
+_max_peers = 4096
+
+# Used by Event.pack and Event.unpack, when no Events instance is around.
+_default_codec = EventCodec()
+
+
+def _kill(task):
+    # Events can be garbage collected in the hub (while it runs timers),
+    # where nothing may block.
+    task.kill(block=gevent.getcurrent() is not gevent.get_hub())
+
+
+def _identity(parts):
+    # The envelope of a message (its frames before the event frame, without
+    # the out-of-band ones): the identity, then an empty delimiter.
+    if len(parts) > 2:
+        return parts[0:-2]
+    elif len(parts) == 2:
+        return parts[0:-1]
+    return None
+
+
+def _timeout(timers, timeout):
+    # Still raises a gevent.Timeout, as it always did.
+    if timers is None:
+        return gevent.Timeout(timeout)
+    return timers.timeout(timeout, gevent.Timeout(timeout))
+
 
 class SequentialSender(object):
 
-    def __init__(self, socket):
+    def __init__(self, socket, timers=None):
         self._socket = socket
+        self._timers = timers
 
     def _send(self, parts):
-        e = None
-        for i in range(len(parts) - 1):
-            try:
-                self._socket.send(parts[i], copy=False, flags=zmq.SNDMORE)
-            except (gevent.GreenletExit, gevent.Timeout) as e:
-                if i == 0:
-                    raise
-                self._socket.send(parts[i], copy=False, flags=zmq.SNDMORE)
-        try:
-            self._socket.send(parts[-1], copy=False)
-        except (gevent.GreenletExit, gevent.Timeout) as e:
-            self._socket.send(parts[-1], copy=False)
-        if e:
-            raise e
+        # send_multipart can only be interrupted (by a GreenletExit or a
+        # Timeout) while waiting for the first part to be accepted, a message
+        # is never sent partially.
+        self._socket.send_multipart(parts, copy=False)
 
     def __call__(self, parts, timeout=None):
         if timeout:
-            with gevent.Timeout(timeout):
+            with _timeout(self._timers, timeout):
                 self._send(parts)
         else:
             self._send(parts)
@@ -88,83 +121,373 @@ class SequentialSender(object):
 
 class SequentialReceiver(object):
 
-    def __init__(self, socket):
+    def __init__(self, socket, timers=None):
         self._socket = socket
+        self._timers = timers
 
     def _recv(self):
-        e = None
-        parts = []
-        while True:
-            try:
-                part = self._socket.recv(copy=False)
-            except (gevent.GreenletExit, gevent.Timeout) as e:
-                if len(parts) == 0:
-                    raise
-                part = self._socket.recv(copy=False)
-            parts.append(part)
-            if not part.more:
-                break
-        if e:
-            raise e
-        return parts
+        # Like send_multipart, recv_multipart can only be interrupted before
+        # receiving the first part of a message.
+        return self._socket.recv_multipart(copy=False)
 
     def __call__(self, timeout=None):
         if timeout:
-            with gevent.Timeout(timeout):
+            with _timeout(self._timers, timeout):
                 return self._recv()
         else:
             return self._recv()
 
 
+class SendQueue(object):
+    """The messages waiting to be sent by a Sender.
+
+    Messages are queued by flow (a channel), and taken out by deficit round
+    robin over the flows: each flow gets to send `quantum` times its weight
+    in bytes per round, the weight being looked up by event name in
+    `weights` (1 by default). One flow sending large events can't delay the
+    others by more than a round. Control events (heartbeats and credits)
+    skip the queue entirely, and never wait for room in it. Without a
+    `quantum`, messages leave in order.
+    Timeouts are armed on `timers` (a TimerWheel) when given.
+
+    """
+
+    control_names = (u'_zpc_hb', u'_zpc_more', u'_zpc_cancel')
+
+    def __init__(self, maxsize, quantum=None, weights=None, timers=None):
+        self._maxsize = maxsize
+        self._timers = timers
+        self.quantum = quantum
+        self.weights = weights
+        self._control = deque()
+        self._flows = {}
+        self._active = deque()
+        self._deficits = {}
+        self._size = 0
+        self._bytes = 0
+        self._not_empty = gevent.event.Event()
+        self._not_full = gevent.event.Event()
+        self._not_full.set()
+        self._stats = {
+            'queued': 0,
+            'queued_bytes': 0,
+            'max_queued': 0,
+            'sent': 0,
+            'control_sent': 0,
+            'wait_total': 0.0,
+            'wait_max': 0.0,
+            'blocked_puts': 0,
+        }
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def quantum(self):
+        return self._quantum
+
+    @quantum.setter
+    def quantum(self, quantum):
+        if quantum is not None and quantum <= 0:
+            raise ValueError('quantum must be > 0, got {0!r}'.format(quantum))
+        self._quantum = quantum
+
+    @property
+    def weights(self):
+        return self._weights
+
+    @weights.setter
+    def weights(self, weights):
+        # A flow never sends an event whose weight doesn't raise its
+        # deficit.
+        for (name, weight) in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError('weight of {0!r} must be > 0, got {1!r}'
+                                 .format(name, weight))
+        self._weights = weights or {}
+
+    @property
+    def stats(self):
+        stats = dict(self._stats)
+        stats['queued'] = self._size
+        stats['queued_bytes'] = self._bytes
+        stats['flows'] = len(self._flows)
+        return stats
+
+    def put(self, item, timeout=None, flow=None, name=None):
+        control = name in self.control_names
+        # Control events are never held back by the data in the queue.
+        if not control and self._size >= self._maxsize:
+            self._stats['blocked_puts'] += 1
+            while self._size >= self._maxsize:
+                self._not_full.clear()
+                self._wait(self._not_full, timeout, gevent.queue.Full())
+        size = sum(_nbytes(part) for part in item[0])
+        entry = (item, size, time.time(), name)
+        if control:
+            self._control.append(entry)
+        else:
+            if self.quantum is None:
+                flow = None
+            queue = self._flows.get(flow)
+            if queue is None:
+                queue = self._flows[flow] = deque()
+                self._deficits[flow] = 0
+                self._active.append(flow)
+            queue.append(entry)
+        self._size += 1
+        self._bytes += size
+        if self._size > self._stats['max_queued']:
+            self._stats['max_queued'] = self._size
+        self._not_empty.set()
+
+    def _pop(self):
+        if self._control:
+            self._stats['control_sent'] += 1
+            return self._control.popleft()
+        while True:
+            flow = self._active[0]
+            queue = self._flows[flow]
+            entry = queue[0]
+            if self.quantum is not None and self._deficits[flow] < entry[1]:
+                # Not enough credit left: next flow, this one gets its share
+                # for the next round.
+                weight = self.weights.get(entry[3], 1)
+                self._deficits[flow] += self.quantum * weight
+                self._active.rotate(-1)
+                continue
+            self._deficits[flow] -= entry[1]
+            queue.popleft()
+            if not queue:
+                self._active.popleft()
+                del self._flows[flow]
+                del self._deficits[flow]
+            return entry
+
+    def get_nowait(self):
+        if not self._size:
+            raise gevent.queue.Empty()
+        (item, size, queued_at, _) = self._pop()
+        self._size -= 1
+        self._bytes -= size
+        wait = time.time() - queued_at
+        self._stats['sent'] += 1
+        self._stats['wait_total'] += wait
+        if wait > self._stats['wait_max']:
+            self._stats['wait_max'] = wait
+        self._not_full.set()
+        return item
+
+    def get(self, timeout=None):
+        while not self._size:
+            self._not_empty.clear()
+            self._wait(self._not_empty, timeout, gevent.queue.Empty())
+        return self.get_nowait()
+
+    def _wait(self, event, timeout, exception):
+        if self._timers is None or timeout is None or timeout <= 0:
+            if not event.wait(timeout=timeout):
+                raise exception
+        else:
+            with self._timers.timeout(timeout, exception):
+                event.wait()
+
+
 class Sender(SequentialSender):
 
-    def __init__(self, socket):
+    # Events waiting in the send queue, before __call__ blocks.
+    queue_size = 4096
+
+    def __init__(self, socket, timers=None):
         self._socket = socket
+        self._timers = timers
         self._send_queue = gevent.queue.Channel()
         self._send_task = gevent.spawn(self._sender)
+        self._queue = None
+        self._queue_task = None
+        self._pack_batch = None
+        self._batch_max_bytes = None
+        self._batch_delay = 0
 
     def close(self):
         if self._send_task:
-            self._send_task.kill()
+            _kill(self._send_task)
+        if self._queue_task:
+            _kill(self._queue_task)
 
     def _sender(self):
         for parts in self._send_queue:
             super(Sender, self)._send(parts)
 
-    def __call__(self, parts, timeout=None):
+    def _enable_queue(self):
+        # Messages don't go through a rendezvous with the sending coroutine
+        # anymore, but through a SendQueue.
+        if self._queue_task is None:
+            self._queue = SendQueue(self.queue_size, timers=self._timers)
+            self._queue_task = gevent.spawn(self._queue_sender)
+
+    @property
+    def stats(self):
+        if self._queue is None:
+            return None
+        return self._queue.stats
+
+    def enable_batching(self, pack_batch, max_bytes, delay=0):
+        """Coalesce the events queued for the same peer.
+
+        Consecutive batchable events to the same envelope are sent as one
+        message, made of `pack_batch(blobs)`. A batch is sent as soon as it
+        reaches `max_bytes`, or once the events queued along with its first
+        one are sent. A `delay` (in seconds) trades latency for throughput:
+        a batch is then sent at most that long after its first event, be the
+        queue idle or busy.
+
+        """
+        self._pack_batch = pack_batch
+        self._batch_max_bytes = max_bytes
+        self._batch_delay = delay
+        self._enable_queue()
+
+    def enable_fair_queuing(self, quantum=16384, weights=None):
+        """Share the socket fairly between flows, see SendQueue."""
+        self._enable_queue()
+        self._queue.quantum = quantum
+        self._queue.weights = weights or {}
+
+    def _queue_sender(self):
+        queue = self._queue
+        batches = {}
+        while True:
+            if not batches:
+                item = queue.get()
+            else:
+                # Wait for more events until the oldest batch is due.
+                due = min(batch[3] for batch in batches.values())
+                remaining = due - time.time()
+                try:
+                    if remaining <= 0:
+                        raise gevent.queue.Empty()
+                    item = queue.get(timeout=remaining)
+                except gevent.queue.Empty:
+                    self._flush_due(batches)
+                    continue
+            # Drain what is queued right now, flushing the batches as they
+            # fall due: a busy queue must not hold them back.
+            count = len(queue)
+            while True:
+                self._batch_item(item, batches)
+                if self._batch_delay:
+                    self._flush_due(batches)
+                if not count:
+                    break
+                count -= 1
+                item = queue.get_nowait()
+            self._flush_due(batches)
+
+    def _flush_due(self, batches):
+        now = time.time()
+        for (key, batch) in list(batches.items()):
+            if batch[3] <= now:
+                self._flush_batch(batches.pop(key))
+
+    def _batch_item(self, item, batches):
+        (parts, batchable) = item
+        if self._pack_batch is None:
+            super(Sender, self)._send(parts)
+            return
+        key = tuple(getattr(part, 'bytes', part) for part in parts[:-1])
+        batch = batches.get(key)
+        if not batchable:
+            # Keep the order of the events to this peer.
+            if batch is not None:
+                self._flush_batch(batches.pop(key))
+            super(Sender, self)._send(parts)
+            return
+        if batch is None:
+            # [envelope, blobs, size, due time]
+            batch = batches[key] = [parts[:-1], [], 0,
+                    time.time() + self._batch_delay]
+        batch[1].append(parts[-1])
+        batch[2] += len(parts[-1])
+        if batch[2] >= self._batch_max_bytes:
+            self._flush_batch(batches.pop(key))
+
+    def _flush_batch(self, batch):
+        (envelope, blobs, _, _) = batch
+        parts = list(envelope)
+        if len(blobs) == 1:
+            parts.append(blobs[0])
+        else:
+            parts.append(self._pack_batch(blobs))
+        super(Sender, self)._send(parts)
+
+    def __call__(self, parts, timeout=None, batchable=False, flow=None,
+            name=None):
         try:
-            self._send_queue.put(parts, timeout=timeout)
+            if self._queue is not None:
+                self._queue.put((parts, batchable), timeout, flow, name)
+            elif self._timers is not None and timeout:
+                with self._timers.timeout(timeout):
+                    self._send_queue.put(parts)
+            else:
+                self._send_queue.put(parts, timeout=timeout)
         except gevent.queue.Full:
             raise TimeoutExpired(timeout)
 
 
 class Receiver(SequentialReceiver):
 
-    def __init__(self, socket):
+    # Messages read at most at once, before handing them to the consumer.
+    drain_max = 64
+
+    def __init__(self, socket, timers=None):
         self._socket = socket
+        self._timers = timers
         self._recv_queue = gevent.queue.Channel()
+        self._recv_pending = deque()
         self._recv_task = gevent.spawn(self._recver)
 
     def close(self):
         if self._recv_task:
-            self._recv_task.kill()
+            _kill(self._recv_task)
         self._recv_queue = None
 
+    def _drain(self):
+        # Wait for a message, then keep whatever else is already there. The
+        # consumer gets them all in a single switch.
+        batch = [super(Receiver, self)._recv()]
+        while len(batch) < self.drain_max:
+            try:
+                batch.append(self._socket.recv_multipart(zmq.NOBLOCK,
+                    copy=False))
+            except zmq.Again:
+                break
+        if len(batch) > 1:
+            # The non blocking reads didn't poll the socket state.
+            self._socket._on_state_changed()
+        return batch
+
     def _recver(self):
         while True:
-            parts = super(Receiver, self)._recv()
-            self._recv_queue.put(parts)
+            self._recv_queue.put(self._drain())
 
     def __call__(self, timeout=None):
-        try:
-            return self._recv_queue.get(timeout=timeout)
-        except gevent.queue.Empty:
-            raise TimeoutExpired(timeout)
+        if not self._recv_pending:
+            if self._timers is not None and timeout:
+                with self._timers.timeout(timeout):
+                    self._recv_pending.extend(self._recv_queue.get())
+            else:
+                try:
+                    self._recv_pending.extend(
+                        self._recv_queue.get(timeout=timeout))
+                except gevent.queue.Empty:
+                    raise TimeoutExpired(timeout)
+        return self._recv_pending.popleft()
 
 
 class Event(object):
 
-    __slots__ = ['_name', '_args', '_header', '_identity']
+    __slots__ = ['_name', '_args', '_header', '_identity', '_size']
 
     # protocol details:
     #  - `name` and `header` keys must be unicode strings.
@@ -178,6 +501,7 @@ class Event(object):
         else:
             self._header = header
         self._identity = None
+        self._size = None
 
     @property
     def header(self):
@@ -193,8 +517,17 @@ class Event(object):
 
     @property
     def args(self):
+        if type(self._args) is LazyArgs:
+            self._args = self._args.decode(self._header)
         return self._args
 
+    @property
+    def lazy_args(self):
+        """The still encoded arguments (a LazyArgs), None once decoded."""
+        if type(self._args) is LazyArgs:
+            return self._args
+        return None
+
     @property
     def identity(self):
         return self._identity
@@ -203,34 +536,29 @@ class Event(object):
     def identity(self, v):
         self._identity = v
 
-    def pack(self):
-        payload = (self._header, self._name, self._args)
-        r = msgpack.Packer(use_bin_type=True).pack(payload)
-        return r
+    @property
+    def size(self):
+        """Bytes the event took on the wire, None if it wasn't received."""
+        return self._size
 
-    @staticmethod
-    def unpack(blob):
-        unpacker = msgpack.Unpacker(raw=False)
-        unpacker.feed(blob)
-        unpacked_msg = unpacker.unpack()
+    @size.setter
+    def size(self, v):
+        self._size = v
 
-        try:
-            (header, name, args) = unpacked_msg
-        except Exception as e:
-            raise Exception('invalid msg format "{0}": {1}'.format(
-                unpacked_msg, e))
-
-        # Backward compatibility
-        if not isinstance(header, dict):
-            header = {}
+    def pack(self, codec=None):
+        return (codec or _default_codec).pack(self)
 
+    @staticmethod
+    def unpack(blob, codec=None, frames=None, lazy=False):
+        (header, name, args) = (codec or _default_codec).unpack(blob, frames,
+                lazy)
         return Event(name, args, None, header)
 
     def __str__(self, ignore_args=False):
         if ignore_args:
             args = '[...]'
         else:
-            args = self._args
+            args = self.args
             try:
                 args = '<<{0}>>'.format(str(self.unpack(self._args)))
             except Exception:
@@ -243,23 +571,37 @@ class Event(object):
 
 
 class Events(ChannelBase):
-    def __init__(self, zmq_socket_type, context=None):
+    def __init__(self, zmq_socket_type, context=None, codec=None):
         self._debug = False
         self._zmq_socket_type = zmq_socket_type
         self._context = context or Context.get_instance()
         self._socket = self._context.socket(zmq_socket_type)
-
+        self._codec = codec or EventCodec(self._context)
+        self._encoding = None
+        self._peer_caps = {}
+        self._caps_advertised = set()
+        self._batching = False
+        self._queued = False
+        self._fragment_size = None
+        self._fragments = OrderedDict()
+        self._fragments_bytes = 0
+        self._recv_pending = deque()
+        self._transport_task = None
+        self._transport_heartbeat = False
+        self._transport_connections = 0
+
+        timers = self._context.timer_wheel
         if zmq_socket_type in (zmq.PUSH, zmq.PUB, zmq.DEALER, zmq.ROUTER):
-            self._send = Sender(self._socket)
+            self._send = Sender(self._socket, timers)
         elif zmq_socket_type in (zmq.REQ, zmq.REP):
-            self._send = SequentialSender(self._socket)
+            self._send = SequentialSender(self._socket, timers)
         else:
             self._send = None
 
         if zmq_socket_type in (zmq.PULL, zmq.SUB, zmq.DEALER, zmq.ROUTER):
-            self._recv = Receiver(self._socket)
+            self._recv = Receiver(self._socket, timers)
         elif zmq_socket_type in (zmq.REQ, zmq.REP):
-            self._recv = SequentialReceiver(self._socket)
+            self._recv = SequentialReceiver(self._socket, timers)
         else:
             self._recv = None
 
@@ -279,6 +621,10 @@ class Events(ChannelBase):
             pass
 
     def close(self):
+        if self._transport_task is not None:
+            _kill(self._transport_task)
+            self._transport_task = None
+            self._socket.disable_monitor()
         try:
             self._send.close()
         except (AttributeError, TypeError, gevent.GreenletExit):
@@ -289,6 +635,205 @@ class Events(ChannelBase):
             pass
         self._socket.close()
 
+    @property
+    def codec(self):
+        return self._codec
+
+    @codec.setter
+    def codec(self, v):
+        self._codec = v
+
+    @property
+    def capabilities(self):
+        caps = list(self._codec.capabilities)
+        if self._recv is not None:
+            caps.extend((u'batch', u'frag'))
+        return caps
+
+    def enable_batching(self, max_bytes=65536, delay=0):
+        """Coalesce small events queued for the same peer (see Sender).
+
+        Only used towards peers advertising the 'batch' capability.
+
+        """
+        if not isinstance(self._send, Sender):
+            raise ValueError('batching is not supported on this socket type')
+        self._send.enable_batching(self._codec.pack_batch, max_bytes, delay)
+        self._batching = True
+        self._queued = True
+
+    def enable_fair_queuing(self, quantum=16384, weights=None):
+        """Schedule the outgoing events fairly between channels.
+
+        Heartbeats and credits are sent first, then each channel gets to
+        send `quantum` bytes per round, times the weight given to the event
+        name by `weights`, see SendQueue.
+
+        """
+        if not isinstance(self._send, Sender):
+            raise ValueError('fair queuing is not supported on this socket type')
+        self._send.enable_fair_queuing(quantum, weights)
+        self._queued = True
+
+    def enable_fragmentation(self, max_size=65536):
+        """Split the events larger than `max_size` bytes in fragments.
+
+        Fragments are interleaved with the events of the other channels, so
+        a huge event doesn't hold back everything queued after it. Fair
+        queuing is enabled if it wasn't already, since it is what does the
+        interleaving. Only used towards peers advertising the 'frag'
+        capability, the others still get whole events.
+
+        libzmq counts messages, not bytes, against the high water marks of
+        the socket, and each fragment is a message: they are raised so that
+        a connection holds up to 256MB worth of fragments, lest a ROUTER
+        silently drops the fragments of the events bigger than the high
+        water mark times `max_size`. Must be called before connect or bind.
+
+        """
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+        if not isinstance(self._send, Sender):
+            raise ValueError('fragmentation is not supported on this socket type')
+        queue = self._send._queue
+        if queue is None or queue.quantum is None:
+            self.enable_fair_queuing()
+        hwm = max(_fragments_pipe_bytes // max_size, 1)
+        for option in (zmq.SNDHWM, zmq.RCVHWM):
+            current = self._socket.getsockopt(option)
+            if current and current < hwm:
+                self._socket.setsockopt(option, hwm)
+        self._fragment_size = max_size
+
+    @property
+    def send_stats(self):
+        """Queue depth and wait time counters, when a send queue is used."""
+        return getattr(self._send, 'stats', None)
+
+    def enable_transport_heartbeat(self, interval=1, timeout=None):
+        """Let libzmq heartbeat the connections (ZMTP PING/PONG).
+
+        libzmq answers the heartbeats from its own I/O thread, so a remote
+        whose gevent loop is blocked (a CPU bound call) still answers them,
+        and a dead one is disconnected after `timeout` seconds (3 intervals
+        by default). The remote is then known alive for as long as a
+        connection is up, whatever the channel heartbeats say (see
+        transport_alive). Must be called before connect or bind.
+
+        With several peers on one socket (a server), any connection keeps
+        all of them alive: this is meant for clients.
+
+        """
+        if zmq.zmq_version_info() < (4, 2):
+            raise ValueError('transport heartbeats need libzmq >= 4.2')
+        if timeout is None:
+            timeout = interval * 3
+        self._socket.setsockopt(zmq.HEARTBEAT_IVL, int(interval * 1000))
+        self._socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, int(timeout * 1000))
+        self._socket.setsockopt(zmq.HEARTBEAT_TTL, int(timeout * 1000))
+        self._transport_heartbeat = True
+        self._watch_transport()
+
+    def _watch_transport(self):
+        if self._transport_task is None:
+            monitor = self._socket.get_monitor_socket(zmq.EVENT_CONNECTED |
+                    zmq.EVENT_ACCEPTED | zmq.EVENT_DISCONNECTED)
+            self._transport_task = gevent.spawn(self._transport_monitor,
+                    monitor)
+
+    def _transport_monitor(self, monitor):
+        try:
+            while True:
+                event = recv_monitor_message(monitor)[u'event']
+                if event == zmq.EVENT_DISCONNECTED:
+                    self._transport_connections -= 1
+                else:
+                    self._transport_connections += 1
+                # The remote may be a new process, tell it everything again.
+                self._caps_advertised.clear()
+        finally:
+            monitor.close()
+
+    @property
+    def transport_alive(self):
+        """True while a heartbeated connection is up."""
+        return self._transport_heartbeat and self._transport_connections > 0
+
+    def _peer_key(self, identity):
+        # Peers are told apart by identity on a ROUTER socket, any other
+        # socket type is assumed to talk to a single kind of peer.
+        if self._zmq_socket_type != zmq.ROUTER or not identity:
+            return None
+        return tuple(getattr(frame, 'bytes', frame) for frame in identity)
+
+    def peer_capabilities(self, identity=None):
+        return self._peer_caps.get(self._peer_key(identity), ())
+
+    def advertise_capabilities(self, identity=None):
+        """True if our capabilities are to be sent to this peer.
+
+        They are sent once per peer, and again after the socket connects,
+        accepts or loses a connection, since the remote may then be a new
+        process which never heard of them.
+
+        """
+        key = self._peer_key(identity)
+        if key in self._caps_advertised:
+            return False
+        self._watch_transport()
+        if len(self._caps_advertised) >= _max_peers:
+            self._caps_advertised.pop()
+        self._caps_advertised.add(key)
+        return True
+
+    def _record_peer_caps(self, event, caps):
+        key = self._peer_key(event.identity)
+        if key not in self._peer_caps and len(self._peer_caps) >= _max_peers:
+            del self._peer_caps[next(iter(self._peer_caps))]
+        self._peer_caps[key] = frozenset(caps)
+
+    def release_channel(self, channel_id):
+        self._codec.release_channel(channel_id)
+
+    @property
+    def compression(self):
+        return self._codec.compression
+
+    @compression.setter
+    def compression(self, v):
+        if v not in (None, u'auto') and v not in self._codec.capabilities:
+            raise ValueError('unavailable compression "{0}"'.format(v))
+        self._codec.compression = v
+
+    @property
+    def compress_threshold(self):
+        return self._codec.compress_threshold
+
+    @compress_threshold.setter
+    def compress_threshold(self, v):
+        self._codec.compress_threshold = v
+
+    @property
+    def oob_threshold(self):
+        return self._codec.oob_threshold
+
+    @oob_threshold.setter
+    def oob_threshold(self, v):
+        self._codec.oob_threshold = v
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    @encoding.setter
+    def encoding(self, v):
+        if v == u'msgpack':
+            v = None
+        if v is not None and self._context.serializer(v) is None:
+            raise ValueError('unknown encoding "{0}", see '
+                    'Context.register_serializer'.format(v))
+        self._encoding = v
+
     @property
     def debug(self):
         return self._debug
@@ -337,37 +882,150 @@ class Events(ChannelBase):
         event = Event(name, args, context=self._context)
         if xheader:
             event.header.update(xheader)
+        if self._encoding is not None:
+            event.header[u'enc'] = self._encoding
         return event
 
     def emit_event(self, event, timeout=None):
         if self._debug:
             logger.debug('--> %s', event)
+        # Out-of-band frames (if any) sit between the envelope and the blob,
+        # keeping the blob last: this is what the receiver relies on.
+        peer_caps = self._peer_caps.get(self._peer_key(event.identity), ())
+        frames = self._codec.pack_frames(event, peer_caps)
         if event.identity:
             parts = list(event.identity or list())
-            parts.extend([b'', event.pack()])
+            parts.append(b'')
+            parts.extend(frames)
         elif self._zmq_socket_type in (zmq.DEALER, zmq.ROUTER):
-            parts = (b'', event.pack())
+            parts = [b'']
+            parts.extend(frames)
         else:
-            parts = (event.pack(),)
-        self._send(parts, timeout)
+            parts = frames
+        if not self._queued:
+            self._send(parts, timeout)
+            return
+        flow = event.header.get(u'response_to') or \
+            event.header.get(u'message_id')
+        if (self._fragment_size is not None and u'frag' in peer_caps and
+                sum(_nbytes(frame) for frame in frames) > self._fragment_size):
+            envelope = parts[:len(parts) - len(frames)]
+            fragments = self._codec.pack_fragments(frames, self._fragment_size,
+                    self._context.new_msgid())
+            for fragment in fragments:
+                self._send(envelope + fragment, timeout, False, flow,
+                        event.name)
+            return
+        batchable = (self._batching and len(frames) == 1 and
+                u'batch' in peer_caps)
+        self._send(parts, timeout, batchable, flow, event.name)
 
     def recv(self, timeout=None):
+        if self._recv_pending:
+            return self._recv_pending.popleft()
+        if timeout:
+            # One timeout for all the fragments of an event.
+            deadline = time.time() + timeout
         parts = self._recv(timeout=timeout)
-        if len(parts) > 2:
-            identity = parts[0:-2]
-            blob = parts[-1]
-        elif len(parts) == 2:
-            identity = parts[0:-1]
+        while True:
             blob = parts[-1]
-        else:
-            identity = None
-            blob = parts[0]
-        event = Event.unpack(get_pyzmq_frame_buffer(blob))
-        event.identity = identity
+            if isinstance(blob, zmq.Frame):
+                buf = get_pyzmq_frame_buffer(blob)
+            else:
+                # Reassembled from fragments.
+                buf = blob
+            try:
+                event = Event.unpack(buf, self._codec, parts[:-1], lazy=True)
+            except DecodeError as e:
+                if e.header is not None:
+                    oob = e.header.get(u'oob', 0)
+                    e.identity = _identity(parts[:-1 - oob] + [blob])
+                raise
+            event.size = _nbytes(buf)
+            oob = event.header.pop(u'oob', 0)
+            if oob:
+                frames = parts[-1 - oob:-1]
+                parts = parts[:-1 - oob]
+                parts.append(blob)
+                event.size += sum(len(frame) for frame in frames)
+            event.identity = _identity(parts)
+            if event.name != u'_zpc_frag':
+                break
+            if oob != 1:
+                e = DecodeError('fragment without its chunk', event.header)
+                e.identity = event.identity
+                raise e
+            parts = self._reassemble(event, parts[:-1], frames[0])
+            if parts is None:
+                if timeout:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutExpired(timeout)
+                    parts = self._recv(timeout=remaining)
+                else:
+                    parts = self._recv(timeout=timeout)
+        if event.name == u'_zpc_batch':
+            return self._unpack_batch(event)
+        caps = event.header.get(u'caps')
+        if caps is not None:
+            self._record_peer_caps(event, caps)
         if self._debug:
             logger.debug('<-- %s', event)
         return event
 
+    def _reassemble(self, fragment, envelope, chunk):
+        # Return the parts of the event once its last fragment is received.
+        (fragment_id, end_of_frame, end) = fragment.args
+        key = (self._peer_key(fragment.identity), fragment_id)
+        self._expire_fragments()
+        state = self._fragments.get(key)
+        if state is None:
+            # [complete frames, chunks of the current frame, bytes, started]
+            state = self._fragments[key] = [[], [], 0, time.time()]
+        chunk = getattr(chunk, 'buffer', chunk)
+        state[1].append(chunk)
+        state[2] += len(chunk)
+        self._fragments_bytes += len(chunk)
+        if end_of_frame:
+            chunks = state[1]
+            state[0].append(chunks[0] if len(chunks) == 1 else b''.join(chunks))
+            state[1] = []
+        if not end:
+            return None
+        del self._fragments[key]
+        self._fragments_bytes -= state[2]
+        return list(envelope) + state[0]
+
+    def _expire_fragments(self):
+        # Drop the oldest events being reassembled, when there are too many
+        # of them or their bytes, or their fragments stopped coming.
+        expired = time.time() - _fragments_ttl
+        while self._fragments:
+            (key, state) = next(iter(self._fragments.items()))
+            if (len(self._fragments) < _max_fragmented and
+                    self._fragments_bytes < _max_fragmented_bytes and
+                    state[3] > expired):
+                break
+            logger.warning('dropping the fragments of an event from %s',
+                    key[0])
+            del self._fragments[key]
+            self._fragments_bytes -= state[2]
+
+    def _unpack_batch(self, batch):
+        for blob in batch.args:
+            event = Event.unpack(blob, self._codec, lazy=True)
+            event.identity = batch.identity
+            event.size = len(blob)
+            caps = event.header.get(u'caps')
+            if caps is not None:
+                self._record_peer_caps(event, caps)
+            if self._debug:
+                logger.debug('<-- %s', event)
+            self._recv_pending.append(event)
+        if not self._recv_pending:
+            return self.recv()
+        return self._recv_pending.popleft()
+
     def setsockopt(self, *args):
         return self._socket.setsockopt(*args)
 
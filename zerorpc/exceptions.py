@@ -47,3 +47,30 @@ class RemoteError(Exception):
         if self.traceback is not None:
             return self.traceback
         return '{0}: {1}'.format(self.name, self.msg)
+
+
+class Overloaded(RemoteError):
+    """The server turned the call down right away, too busy to queue it.
+
+    `retry_after` is the server's guess of how many seconds it needs to get
+    back to it, or None.
+
+    """
+
+    def __init__(self, human_msg, retry_after=None):
+        super(Overloaded, self).__init__('Overloaded', human_msg, None)
+        self.retry_after = retry_after
+
+
+class DecodeError(Exception):
+    """A received event couldn't be decoded.
+
+    `header` is its header if that much could be decoded, else None, and
+    `identity` the ZMQ identity of its sender.
+
+    """
+
+    def __init__(self, msg, header=None):
+        super(DecodeError, self).__init__(msg)
+        self.header = header
+        self.identity = None
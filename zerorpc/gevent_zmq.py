@@ -154,6 +154,37 @@ class Socket(_zmq.Socket):
                     if e.errno not in (_zmq.EAGAIN, errno.EINTR):
                         raise
 
+    def send_multipart(self, msg_parts, flags=0, copy=True, track=False):
+        # Once its first part is queued, ZMQ accepts the rest of a message
+        # without blocking: the only place this can switch to another
+        # coroutine (and be interrupted) is before anything was sent.
+        if flags & _zmq.NOBLOCK:
+            return super(Socket, self).send_multipart(msg_parts, flags, copy,
+                                                      track)
+        flags |= _zmq.NOBLOCK
+        while True:
+            try:
+                msg = super(Socket, self).send_multipart(msg_parts, flags,
+                                                         copy, track)
+                # See send() for why the state is polled here.
+                self._on_state_changed()
+                return msg
+            except _zmq.ZMQError as e:
+                if e.errno not in (_zmq.EAGAIN, errno.EINTR):
+                    raise
+            self._writable.clear()
+            # See send() for the sleep(0) and the wait loop.
+            gevent.sleep(0)
+            while not self._writable.wait(timeout=1):
+                try:
+                    if self.getsockopt(_zmq.EVENTS) & _zmq.POLLOUT:
+                        logger.error("/!\\ gevent_zeromq BUG /!\\ "
+                                     "catching up after missing event (SEND) /!\\")
+                        break
+                except ZMQError as e:
+                    if e.errno not in (_zmq.EAGAIN, errno.EINTR):
+                        raise
+
     def recv(self, flags=0, copy=True, track=False):
         if flags & _zmq.NOBLOCK:
             return super(Socket, self).recv(flags, copy, track)
@@ -193,3 +224,15 @@ class Socket(_zmq.Socket):
                 except ZMQError as e:
                     if e.errno not in (_zmq.EAGAIN, errno.EINTR):
                         raise
+
+    def recv_multipart(self, flags=0, copy=True, track=False):
+        # Only the first part can make us wait, the rest of a message is
+        # delivered along with it.
+        part = self.recv(flags, copy, track)
+        parts = [part]
+        more = part.more if not copy else self.getsockopt(_zmq.RCVMORE)
+        while more:
+            part = super(Socket, self).recv(_zmq.NOBLOCK, copy, track)
+            parts.append(part)
+            more = part.more if not copy else self.getsockopt(_zmq.RCVMORE)
+        return parts
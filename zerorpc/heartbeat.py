@@ -30,25 +30,172 @@ import gevent.event
 import gevent.local
 import gevent.lock
 
-from .exceptions import LostRemote, TimeoutExpired
-from .channel_base import ChannelBase
+from .exceptions import LostRemote
+from .channel_base import PushChannelBase
 
 
-class HeartBeatOnChannel(ChannelBase):
+# Liveness is remembered for that many peers at most.
+_max_peers = 4096
 
-    def __init__(self, channel, freq=5, passive=False):
+
+def _stalled(slept_at, wait, freq):
+    # Woke up a period later than planned: the loop was blocked.
+    return time.time() - slept_at > wait + freq
+
+
+class PeerHeartBeat(object):
+    """The heartbeat shared by all the channels to the same remote peer.
+
+    Any event received from a peer proves it alive, and an explicit
+    heartbeat (a "_zpc_hb" event with a "peer" header, outside of any
+    channel) is only sent when nothing else was sent to the peer during the
+    last half period. Passive channels start heartbeating when the remote
+    does, answering its first "ping" with a "pong".
+    A single greenlet per multiplexer watches all the peers: when one stops
+    answering, all its channels lose their remote at once.
+
+    Active channels only use it with peers advertising the 'peer_hb'
+    capability, the others get a heartbeat per channel.
+
+    When this process was stalled (by a CPU bound greenlet hogging the
+    loop), the heartbeats of the peers are probably just waiting to be
+    read: they get a full period again before being declared lost.
+
+    """
+
+    def __init__(self, multiplexer):
+        self._multiplexer = multiplexer
+        self._last_seen = {}
+        # peer key -> [identity, last sent, {channel: passive}, active]
+        self._peers = {}
+        self._channel_peers = {}
+        self._freq = None
+        self._task = None
+
+    def close(self):
+        if self._task is not None:
+            self._task.kill()
+            self._task = None
+
+    def last_seen(self, key):
+        return self._last_seen.get(key)
+
+    def seen(self, key, event):
+        """Record an event received from a peer.
+
+        Returns True if it was a peer heartbeat, which goes no further.
+
+        """
+        last_seen = self._last_seen
+        if key not in last_seen and len(last_seen) >= _max_peers:
+            del last_seen[next(iter(last_seen))]
+        last_seen[key] = time.time()
+        if event.name != u'_zpc_hb':
+            return False
+        kind = event.header.get(u'peer')
+        if kind is None:
+            return False
+        peer = self._peers.get(key)
+        if kind == u'ping' and peer is not None and not peer[3]:
+            # The remote heartbeats us, but our channels to it are passive:
+            # answer, and heartbeat from now on.
+            peer[3] = True
+            peer[1] = time.time()
+            self._multiplexer.emit_peer_heartbeat(event.identity, u'pong')
+        return True
+
+    def sent(self, key):
+        peer = self._peers.get(key)
+        if peer is not None:
+            peer[1] = time.time()
+
+    @property
+    def active(self):
+        return bool(self._peers)
+
+    def add(self, key, identity, channel, passive=False):
+        peer = self._peers.get(key)
+        freq = channel._heartbeat_freq
+        if peer is None:
+            peer = self._peers[key] = [identity, 0, {}, False]
+            # Give the remote a period to show up, like HeartBeatOnChannel.
+            self._last_seen[key] = max(self._last_seen.get(key, 0),
+                    time.time() + freq)
+        peer[2][channel] = passive
+        if not passive:
+            peer[3] = True
+        self._channel_peers[channel] = key
+        if self._freq is None or freq < self._freq:
+            self._freq = freq
+        if self._task is None:
+            self._task = gevent.spawn(self._heartbeat)
+
+    def remove(self, channel):
+        key = self._channel_peers.pop(channel, None)
+        peer = self._peers.get(key)
+        if peer is not None:
+            peer[2].pop(channel, None)
+            if not peer[2]:
+                del self._peers[key]
+
+    def _heartbeat(self):
+        timers = self._multiplexer.context.timer_wheel
+        resumed = 0
+        while self._peers:
+            # Waking up every half period, a peer never goes a full period
+            # without hearing from us, whenever the last event was sent.
+            wait = self._freq / 2.0
+            slept_at = time.time()
+            timers.sleep(wait)
+            now = time.time()
+            if _stalled(slept_at, wait, self._freq):
+                resumed = now
+            for (key, peer) in list(self._peers.items()):
+                if not peer[3]:
+                    continue
+                last_seen = max(self._multiplexer.last_seen(peer[0]) or now,
+                        resumed)
+                for channel in list(peer[2]):
+                    if now > last_seen + channel._heartbeat_freq * 2:
+                        self.remove(channel)
+                        channel._on_lost_remote()
+                if key in self._peers and now >= peer[1] + wait:
+                    peer[1] = now
+                    self._multiplexer.emit_peer_heartbeat(peer[0], u'ping')
+        self._task = None
+        self._freq = None
+
+
+class HeartBeatOnChannel(PushChannelBase):
+
+    __slots__ = ('_closed', '_channel', '_heartbeat_freq', '_remote_last_hb',
+            '_lost_remote', '_recv_task', '_heartbeat_task', '_delay_timer',
+            '_parent_coroutine', '_compat_v2', '_peer_heartbeat')
+
+    # The first heartbeat is sent `delay` seconds after the channel opens
+    # (`freq` by default), or `freq` seconds after the first heartbeat from the
+    # remote. Until then there is no heartbeat greenlet at all: a call shorter
+    # than the delay costs nothing, and a longer one still starts
+    # heartbeating on both ends, whichever starts first.
+    def __init__(self, channel, freq=5, passive=False, delay=None):
+        self._init_push()
         self._closed = False
         self._channel = channel
         self._heartbeat_freq = freq
-        self._input_queue = gevent.queue.Channel()
         self._remote_last_hb = None
         self._lost_remote = False
-        self._recv_task = gevent.spawn(self._recver)
         self._heartbeat_task = None
+        self._delay_timer = None
         self._parent_coroutine = gevent.getcurrent()
         self._compat_v2 = None
-        if not passive:
-            self._start_heartbeat()
+        self._peer_heartbeat = None
+        self._recv_task = self._attach(channel)
+        if passive and freq is not None:
+            self._join_peer_heartbeat(passive=True)
+        elif freq is not None:
+            timers = channel.context.timer_wheel
+            self._delay_timer = timers.arm(freq if delay is None else delay,
+                    self._start_heartbeat, 0)
 
     @property
     def recv_is_supported(self):
@@ -60,6 +207,10 @@ class HeartBeatOnChannel(ChannelBase):
 
     def close(self):
         self._closed = True
+        self._stop_delay_timer()
+        if self._peer_heartbeat is not None:
+            self._peer_heartbeat.remove(self)
+            self._peer_heartbeat = None
         if self._heartbeat_task is not None:
             self._heartbeat_task.kill()
             self._heartbeat_task = None
@@ -70,36 +221,70 @@ class HeartBeatOnChannel(ChannelBase):
             self._channel.close()
             self._channel = None
 
-    def _heartbeat(self):
+    def _stop_delay_timer(self):
+        if self._delay_timer is not None:
+            self._delay_timer.cancel()
+            self._delay_timer = None
+
+    def _heartbeat(self, wait):
+        last_seen = getattr(self._channel, 'last_seen', None)
+        timers = self.context.timer_wheel
         while True:
-            gevent.sleep(self._heartbeat_freq)
-            if self._remote_last_hb is None:
+            slept_at = time.time()
+            timers.sleep(wait)
+            if self._remote_last_hb is None or _stalled(slept_at, wait,
+                    self._heartbeat_freq):
+                # Just started, or this process was stalled: the remote gets
+                # a full period.
                 self._remote_last_hb = time.time()
+            wait = self._heartbeat_freq
+            if last_seen is not None:
+                # Anything received from the remote (like the heartbeat it
+                # shares between channels) proves it alive.
+                self._remote_last_hb = max(self._remote_last_hb,
+                        last_seen() or 0)
             if time.time() > self._remote_last_hb + self._heartbeat_freq * 2:
-                self._lost_remote = True
-                if not self._closed:
-                    gevent.kill(self._parent_coroutine,
-                            self._lost_remote_exception())
+                self._on_lost_remote()
                 break
             self._channel.emit(u'_zpc_hb', (0,))  # 0 -> compat with protocol v2
 
-    def _start_heartbeat(self):
+    def _on_lost_remote(self):
+        self._lost_remote = True
+        if not self._closed:
+            gevent.kill(self._parent_coroutine,
+                    self._lost_remote_exception())
+
+    def _join_peer_heartbeat(self, passive=False):
+        join = getattr(self._channel, 'join_peer_heartbeat', None)
+        if join is None:
+            return False
+        heartbeat = join(self, passive)
+        if heartbeat is None and self._peer_heartbeat is not None:
+            # Was waiting passively, but the remote heartbeats per channel.
+            self._peer_heartbeat.remove(self)
+        self._peer_heartbeat = heartbeat
+        return heartbeat is not None
+
+    def _start_heartbeat(self, wait=None):
+        self._stop_delay_timer()
         if self._heartbeat_task is None and self._heartbeat_freq is not None and not self._closed:
-            self._heartbeat_task = gevent.spawn(self._heartbeat)
+            if self._join_peer_heartbeat():
+                return
+            if wait is None:
+                wait = self._heartbeat_freq
+            self._heartbeat_task = gevent.spawn(self._heartbeat, wait)
 
-    def _recver(self):
-        while True:
-            event = self._channel.recv()
-            if self._compat_v2 is None:
-                self._compat_v2 = event.header.get(u'v', 0) < 3
-            if event.name == u'_zpc_hb':
-                self._remote_last_hb = time.time()
-                self._start_heartbeat()
-                if self._compat_v2:
-                    event.name = u'_zpc_more'
-                    self._input_queue.put(event)
-            else:
-                self._input_queue.put(event)
+    def _push(self, event):
+        if self._compat_v2 is None:
+            self._compat_v2 = event.header.get(u'v', 0) < 3
+        if event.name == u'_zpc_hb':
+            self._remote_last_hb = time.time()
+            self._start_heartbeat()
+            if self._compat_v2:
+                event.name = u'_zpc_more'
+                self._deliver(event)
+        else:
+            self._deliver(event)
 
     def _lost_remote_exception(self):
         return LostRemote('Lost remote after {0}s heartbeat'.format(
@@ -118,10 +303,10 @@ class HeartBeatOnChannel(ChannelBase):
     def recv(self, timeout=None):
         if self._lost_remote:
             raise self._lost_remote_exception()
-        try:
-            return self._input_queue.get(timeout=timeout)
-        except gevent.queue.Empty:
-            raise TimeoutExpired(timeout)
+        return self._recv_inbox(timeout)
+
+    def peer_capabilities(self, identity=None):
+        return self._channel.peer_capabilities(identity)
 
     @property
     def channel(self):
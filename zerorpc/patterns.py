@@ -23,6 +23,226 @@
 # SOFTWARE.
 
 
+from __future__ import absolute_import
+from builtins import str
+
+import time
+import gevent
+import gevent.lock
+import gevent.queue
+
+from .codec import _nbytes
+
+
+def _estimated_size(value, depth=8):
+    # A cheap guess of the packed size of a streamed item: strings count in
+    # UTF-8 bytes, containers down to `depth` levels, past which a value is
+    # guessed to take as much as a scalar.
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return _nbytes(value) + 5
+    if isinstance(value, str):
+        return len(value.encode('utf-8', 'surrogatepass')) + 5
+    if depth:
+        if isinstance(value, (tuple, list)):
+            return sum(_estimated_size(v, depth - 1) for v in value) + 5
+        if isinstance(value, dict):
+            return sum(_estimated_size(k, depth - 1) +
+                    _estimated_size(v, depth - 1)
+                    for (k, v) in value.items()) + 5
+    return 9
+
+
+class _StreamBatcher(object):
+    # Collects the items of a stream into STREAM_BATCH events. A batch is
+    # sent when full, or `max_delay` seconds after its first item, even if
+    # the stream is still waiting for the next one: then from another
+    # greenlet, the lock keeps the batches in order.
+
+    def __init__(self, pattern, channel, xheader):
+        self._pattern = pattern
+        self._channel = channel
+        self._xheader = xheader
+        self._items = []
+        self._bytes = 0
+        self._timer = None
+        self._flusher = None
+        self._lock = gevent.lock.Semaphore()
+        self._error = None
+
+    def add(self, item):
+        if self._error is not None:
+            raise self._error
+        self._items.append(item)
+        self._bytes += _estimated_size(item)
+        if (len(self._items) >= self._pattern.batch_max_items or
+                self._bytes >= self._pattern.batch_max_bytes):
+            self.flush()
+        elif self._timer is None:
+            timers = self._channel.context.timer_wheel
+            self._timer = timers.arm(self._pattern.batch_max_delay,
+                    self._spawn_flush)
+
+    def _spawn_flush(self):
+        self._timer = None
+        self._flusher = gevent.spawn(self._flush_later)
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._flusher = None
+
+    def close(self):
+        # Nothing is sent once the stream is over, even a batch which was
+        # about to be flushed from another greenlet.
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flusher is not None:
+            self._flusher.kill()
+            self._flusher = None
+        self._items = []
+        self._bytes = 0
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        with self._lock:
+            (items, self._items) = (self._items, [])
+            self._bytes = 0
+            if len(items) == 1:
+                self._channel.emit(u'STREAM', items[0], self._xheader)
+            elif items:
+                self._channel.emit(u'STREAM_BATCH', items, self._xheader)
+        if self._error is not None:
+            raise self._error
+
+
+class _ProduceAhead(object):
+    # Runs an iterator in its own greenlet, up to `size` items ahead of the
+    # consumer, in the task context of the call (see fork_task_context).
+    # With `threaded`, the items are taken from the iterator in a thread of
+    # the hub's threadpool (by chunks, for at most `chunk_delay` seconds),
+    # for iterators which block without yielding to gevent.
+
+    _done = object()
+    chunk_size = 64
+    chunk_delay = 0.01
+
+    def __init__(self, iterator, size, threaded=False, context=None):
+        from .core import fork_task_context
+        self._iterator = iterator
+        self._threaded = threaded
+        self._queue = gevent.queue.Queue(maxsize=size)
+        self._error = None
+        self._closed = False
+        self._task = gevent.spawn(fork_task_context(self._produce, context))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is self._done:
+            self._queue.put(item)
+            if self._error is not None:
+                raise self._error
+            raise StopIteration()
+        return item
+
+    next = __next__
+
+    def close(self):
+        self._closed = True
+        self._task.kill()
+        self._close_iterator()
+
+    def _close_iterator(self):
+        close = getattr(self._iterator, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except ValueError:
+                # Still running in a thread, which closes it once the item
+                # it is on is produced.
+                pass
+
+    def _chunk(self):
+        chunk = []
+        deadline = time.time() + self.chunk_delay
+        for item in self._iterator:
+            if self._closed:
+                break
+            chunk.append(item)
+            if len(chunk) == self.chunk_size or time.time() >= deadline:
+                break
+        if self._closed:
+            self._close_iterator()
+        return chunk
+
+    def _produce(self):
+        try:
+            if self._threaded:
+                threadpool = gevent.get_hub().threadpool
+                while True:
+                    chunk = threadpool.apply(self._chunk)
+                    if not chunk:
+                        break
+                    for item in chunk:
+                        self._queue.put(item)
+            else:
+                for item in self._iterator:
+                    self._queue.put(item)
+        except Exception as e:
+            self._error = e
+        self._queue.put(self._done)
+
+
+class _Prefetcher(object):
+    # Receives and decodes the items of a stream in its own greenlet, up to
+    # `depth` items ahead of the consumer. Receiving is what gives credits
+    # to the server, so they are topped up as items are consumed, not only
+    # when the consumer asks for the next one.
+
+    _done = object()
+
+    def __init__(self, channel, rep_event, depth):
+        self._channel = channel
+        self._queue = gevent.queue.Queue(maxsize=depth)
+        self._error = None
+        self.last_event = None
+        self._task = gevent.spawn(self._fetch, rep_event)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._done:
+                break
+            yield item
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        self._task.kill()
+
+    def _fetch(self, rep_event):
+        try:
+            while rep_event.name in (u'STREAM', u'STREAM_BATCH'):
+                if rep_event.name == u'STREAM':
+                    self._queue.put(rep_event.args)
+                else:
+                    for item in rep_event.args:
+                        self._queue.put(item)
+                rep_event = self._channel.recv()
+            self.last_event = rep_event
+        except Exception as e:
+            self._error = e
+        self._queue.put(self._done)
+
+
 class ReqRep(object):
 
     def process_call(self, context, channel, req_event, functor):
@@ -37,7 +257,7 @@ class ReqRep(object):
         return event.name in (u'OK', u'ERR')
 
     def process_answer(self, context, channel, req_event, rep_event,
-            handle_remote_error):
+            handle_remote_error, prefetch=None):
         try:
             if rep_event.name == u'ERR':
                 exception = handle_remote_error(rep_event)
@@ -50,12 +270,47 @@ class ReqRep(object):
 
 
 class ReqStream(object):
+    """Streams the items of an iterator, see STREAM in the protocol.
+
+    Towards peers advertising 'stream_batch', the items are sent by batches
+    of up to `batch_max_items` items, about `batch_max_bytes` bytes, and
+    `batch_max_delay` seconds after the first one.
+
+    With `produce_ahead`, the iterator runs in its own greenlet, up to that
+    many items ahead of what was sent: producing the items overlaps with
+    waiting for credits and sending them. With `threaded`, the items are
+    produced in a thread instead, for iterators which block without letting
+    gevent run (a database driver, for example). The code running in the
+    thread doesn't get the task context (it can't make zerorpc calls), and a
+    cancelled call can't interrupt it: a generator is only closed once done
+    with the item it is producing.
+
+    """
+
+    capabilities = (u'stream_batch',)
+
+    def __init__(self, batch_max_items=1000, batch_max_bytes=65536,
+            batch_max_delay=0.01, produce_ahead=None, threaded=False):
+        self.batch_max_items = batch_max_items
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_max_delay = batch_max_delay
+        self.produce_ahead = produce_ahead
+        self.threaded = threaded
 
     def process_call(self, context, channel, req_event, functor):
         context.hook_server_before_exec(req_event)
         xheader = context.hook_get_task_context()
-        for result in iter(functor(*req_event.args)):
-            channel.emit(u'STREAM', result, xheader)
+        results = iter(functor(*req_event.args))
+        if self.produce_ahead or self.threaded:
+            results = _ProduceAhead(results, self.produce_ahead or 1000,
+                    self.threaded, context)
+        try:
+            self._send_results(channel, results, xheader)
+        finally:
+            # Right away, when the call was cancelled or the remote lost.
+            close = getattr(results, 'close', None)
+            if close is not None:
+                close()
         done_event = channel.new_event(u'STREAM_DONE', None, xheader)
         # NOTE: "We" made the choice to call the hook once the stream is done,
         # the other choice was to call it at each iteration. I donu't think that
@@ -64,30 +319,69 @@ class ReqStream(object):
         context.hook_server_after_exec(req_event, done_event)
         channel.emit_event(done_event)
 
+    def _send_results(self, channel, results, xheader):
+        from .core import _reply_started
+        if u'stream_batch' in channel.peer_capabilities():
+            batcher = _StreamBatcher(self, channel, xheader)
+            try:
+                for result in results:
+                    batcher.add(result)
+                    _reply_started()
+            except Exception:
+                # What was produced before the error is sent first.
+                batcher.flush()
+                raise
+            else:
+                batcher.flush()
+            finally:
+                batcher.close()
+        else:
+            for result in results:
+                channel.emit(u'STREAM', result, xheader)
+                _reply_started()
+
     def accept_answer(self, event):
-        return event.name in (u'STREAM', u'STREAM_DONE')
+        return event.name in (u'STREAM', u'STREAM_BATCH', u'STREAM_DONE')
 
     def process_answer(self, context, channel, req_event, rep_event,
-            handle_remote_error):
+            handle_remote_error, prefetch=None):
 
         def is_stream_done(rep_event):
             return rep_event.name == u'STREAM_DONE'
         channel.on_close_if = is_stream_done
 
         def iterator(req_event, rep_event):
+            done = False
             try:
-                while rep_event.name == u'STREAM':
+                if prefetch:
+                    prefetcher = _Prefetcher(channel, rep_event, prefetch)
+                    try:
+                        for item in prefetcher:
+                            yield item
+                    finally:
+                        prefetcher.close()
+                    rep_event = prefetcher.last_event
+                while rep_event.name in (u'STREAM', u'STREAM_BATCH'):
                     # Like in process_call, we made the choice to call the
                     # after_exec hook only when the stream is done.
-                    yield rep_event.args
+                    if rep_event.name == u'STREAM':
+                        yield rep_event.args
+                    else:
+                        for item in rep_event.args:
+                            yield item
                     rep_event = channel.recv()
+                done = True
                 if rep_event.name == u'ERR':
                     exception = handle_remote_error(rep_event)
                     context.hook_client_after_request(req_event, rep_event, exception)
                     raise exception
                 context.hook_client_after_request(req_event, rep_event)
             finally:
-                channel.close()
+                if done:
+                    channel.close()
+                else:
+                    # Dropped before the end of the stream.
+                    channel.cancel()
 
         return iterator(req_event, rep_event)
 
@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+
+import heapq
+import time
+from collections import deque, OrderedDict
+
+import gevent.event
+
+# Counters are kept for that many clients at most.
+_max_peers = 4096
+
+
+class Request(object):
+    """A request waiting for a task of the server.
+
+    `priority` is the class of the request for the schedulers: the
+    "priority" header of the request, or else the priority of the method
+    (see DecoratorBase.options), None by default. `deadline` is when its
+    client gives up on it (see remaining_time), or None. `peer` tells its
+    client apart: its ZMQ identity (a tuple of frames), None if the socket
+    doesn't tell.
+
+    """
+
+    __slots__ = ('event', 'received_at', 'deadline', 'priority', 'peer')
+
+    def __init__(self, event, received_at, deadline=None, priority=None,
+            peer=None):
+        self.event = event
+        self.received_at = received_at
+        self.deadline = deadline
+        self.priority = priority
+        self.peer = peer
+
+
+class FifoScheduler(object):
+    """Decides in which order the requests waiting for a task are served.
+
+    The server put()s the requests it receives, and a task is started for
+    each request get() returns, blocking until there is one. done() is
+    called when the task ends. Subclasses implement _enqueue and _dequeue,
+    which can return None when none of the requests can be served yet. This
+    one serves them in order. Requests only queue up (and get a say in their
+    order) on a server with a backlog, see ServerBase.
+
+    `stats` maps the classes of requests (their priority) seen so far to the
+    number of requests `queued` and `served`, and the time the served ones
+    spent waiting: in total (`wait_time`) and at most (`max_wait`).
+
+    """
+
+    def __init__(self):
+        self._ready = gevent.event.Event()
+        self._size = 0
+        self._stats = {}
+        self._queue = deque()
+
+    def _enqueue(self, request):
+        self._queue.append(request)
+
+    def _dequeue(self):
+        return self._queue.popleft()
+
+    def _class_stats(self, priority):
+        stats = self._stats.get(priority)
+        if stats is None:
+            stats = self._stats[priority] = {'queued': 0, 'served': 0,
+                    'wait_time': 0.0, 'max_wait': 0.0}
+        return stats
+
+    def put(self, request):
+        self._enqueue(request)
+        self._size += 1
+        self._class_stats(request.priority)['queued'] += 1
+        self._ready.set()
+
+    def get(self):
+        while True:
+            request = self._dequeue() if self._size else None
+            if request is not None:
+                break
+            self._ready.clear()
+            self._ready.wait()
+        self._size -= 1
+        waited = time.time() - request.received_at
+        stats = self._class_stats(request.priority)
+        stats['queued'] -= 1
+        stats['served'] += 1
+        stats['wait_time'] += waited
+        stats['max_wait'] = max(stats['max_wait'], waited)
+        return request
+
+    def done(self, request):
+        pass
+
+    def qsize(self):
+        return self._size
+
+    @property
+    def stats(self):
+        return dict((priority, dict(stats))
+                for (priority, stats) in self._stats.items())
+
+
+class _ClassQueues(FifoScheduler):
+    # A FIFO per class of requests.
+
+    def __init__(self):
+        super(_ClassQueues, self).__init__()
+        self._queues = {}
+
+    def _enqueue(self, request):
+        queue = self._queues.get(request.priority)
+        if queue is None:
+            queue = self._queues[request.priority] = deque()
+        queue.append(request)
+
+    def _dequeue(self):
+        priority = self._select(dict((priority, queue)
+            for (priority, queue) in self._queues.items() if queue))
+        return self._queues[priority].popleft()
+
+    def _select(self, queues):
+        raise NotImplementedError()
+
+
+class PriorityScheduler(_ClassQueues):
+    """Serves the requests of the highest priority (a number, None counts
+    as 0) first.
+
+    Against starvation, the requests age: each `aging` seconds spent waiting
+    count as one more level of priority. With `aging=None`, the priorities
+    are strict.
+
+    """
+
+    def __init__(self, aging=1.0):
+        super(PriorityScheduler, self).__init__()
+        self._aging = aging
+
+    def _select(self, queues):
+        now = time.time()
+
+        def effective(priority):
+            level = priority or 0
+            if self._aging:
+                level += (now - queues[priority][0].received_at) / self._aging
+            return level
+        return max(queues, key=effective)
+
+
+class WeightedScheduler(_ClassQueues):
+    """Shares the tasks between the classes of requests, in proportion to
+    their `weights` ({priority: weight}, `default_weight` for the others).
+
+    A class which was idle doesn't get to catch up on the share it didn't
+    use.
+
+    """
+
+    def __init__(self, weights=None, default_weight=1):
+        super(WeightedScheduler, self).__init__()
+        self._weights = dict(weights or {})
+        self._default_weight = default_weight
+        # Stride scheduling: the class with the smallest pass goes next, and
+        # moves forward by the inverse of its weight.
+        self._passes = {}
+        self._pass = 0.0
+
+    def _select(self, queues):
+        for priority in queues:
+            self._passes[priority] = max(self._passes.get(priority, 0.0),
+                    self._pass)
+        priority = min(queues, key=lambda priority: self._passes[priority])
+        self._pass = self._passes[priority]
+        self._passes[priority] += 1.0 / self._weights.get(priority,
+                self._default_weight)
+        return priority
+
+
+class DeadlineScheduler(FifoScheduler):
+    """Serves the requests whose client gives up first (earliest deadline
+    first).
+
+    Requests without a deadline get one `max_wait` seconds after their
+    arrival, so that they are served eventually.
+
+    """
+
+    def __init__(self, max_wait=30):
+        super(DeadlineScheduler, self).__init__()
+        self._max_wait = max_wait
+        self._heap = []
+        self._counter = 0
+
+    def _enqueue(self, request):
+        deadline = request.deadline
+        if deadline is None:
+            deadline = request.received_at + self._max_wait
+        # The counter keeps the order of arrival between equal deadlines.
+        self._counter += 1
+        heapq.heappush(self._heap, (deadline, self._counter, request))
+
+    def _dequeue(self):
+        return heapq.heappop(self._heap)[2]
+
+
+def _cost(request):
+    # The size of the request on the wire, in bytes.
+    return getattr(request.event, 'size', None) or 1
+
+
+class FairScheduler(FifoScheduler):
+    """Shares the tasks fairly between the clients (ZMQ identities).
+
+    Deficit round robin: each client in turn is given `quantum` bytes worth
+    of requests, so that one client sending many requests only delays its
+    own. A client with `max_in_flight` tasks working for it waits for one
+    of them to end.
+
+    """
+
+    def __init__(self, quantum=4096, max_in_flight=None):
+        if quantum <= 0:
+            raise ValueError('quantum must be > 0, got {0!r}'.format(quantum))
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError('max_in_flight must be > 0, got {0!r}'.format(
+                max_in_flight))
+        super(FairScheduler, self).__init__()
+        self._quantum = quantum
+        self._max_in_flight = max_in_flight
+        self._queues = {}
+        self._deficits = {}
+        self._in_flight = {}
+        # The clients with queued requests, the one served next first.
+        self._active = deque()
+
+    def _enqueue(self, request):
+        identity = request.peer
+        queue = self._queues.get(identity)
+        if queue is None:
+            queue = self._queues[identity] = deque()
+            self._deficits[identity] = 0
+            self._active.append(identity)
+        queue.append(request)
+
+    def _dequeue(self):
+        active = self._active
+        skipped = 0
+        while skipped < len(active):
+            identity = active[0]
+            if (self._max_in_flight is not None and
+                    self._in_flight.get(identity, 0) >= self._max_in_flight):
+                active.rotate(-1)
+                skipped += 1
+                continue
+            skipped = 0
+            queue = self._queues[identity]
+            cost = _cost(queue[0])
+            if self._deficits[identity] < cost:
+                self._deficits[identity] += self._quantum
+                active.rotate(-1)
+                continue
+            self._deficits[identity] -= cost
+            request = queue.popleft()
+            if not queue:
+                # No banking of the quantum while idle.
+                active.popleft()
+                del self._queues[identity]
+                del self._deficits[identity]
+            self._in_flight[identity] = self._in_flight.get(identity, 0) + 1
+            return request
+        return None
+
+    def done(self, request):
+        identity = request.peer
+        in_flight = self._in_flight.get(identity, 0) - 1
+        if in_flight > 0:
+            self._in_flight[identity] = in_flight
+        else:
+            self._in_flight.pop(identity, None)
+        self._ready.set()
+
+
+class PeerRegistry(object):
+    """Counters of a server for each of its clients (ZMQ identities).
+
+    `stats` maps the identities to the number of `requests` received and
+    their `bytes`, how many are `in_flight` (being worked on by a task) and
+    when the client was `last_seen` (time.time() of its last request).
+    Past `max_peers` clients, the one seen the longest ago without a call
+    in flight is forgotten.
+
+    """
+
+    def __init__(self, max_peers=_max_peers):
+        self._max_peers = max_peers
+        # From the least to the most recently seen.
+        self._peers = OrderedDict()
+
+    def received(self, request):
+        peers = self._peers
+        peer = peers.pop(request.peer, None)
+        if peer is None:
+            if len(peers) >= self._max_peers:
+                self._evict()
+            peer = {'requests': 0, 'bytes': 0, 'in_flight': 0,
+                    'last_seen': None}
+        peers[request.peer] = peer
+        peer['requests'] += 1
+        peer['bytes'] += getattr(request.event, 'size', None) or 0
+        peer['last_seen'] = time.time()
+
+    def _evict(self):
+        for (identity, peer) in self._peers.items():
+            if not peer['in_flight']:
+                del self._peers[identity]
+                return
+
+    def started(self, request):
+        peer = self._peers.get(request.peer)
+        if peer is not None:
+            peer['in_flight'] += 1
+
+    def done(self, request):
+        peer = self._peers.get(request.peer)
+        if peer is not None and peer['in_flight'] > 0:
+            peer['in_flight'] -= 1
+
+    @property
+    def stats(self):
+        return dict((identity, dict(peer))
+                for (identity, peer) in self._peers.items())
+
+
+class Bulkhead(object):
+    """Limits how many tasks of the server run a method at once.
+
+    The calls over the limit wait in a queue of their own, of `queue_size`
+    calls at most (0 to reject them right away), instead of taking the tasks
+    the other methods need. They count in the backlog of the server. A call
+    admitted is given back with release() when its task ends, which admits
+    the next one.
+
+    """
+
+    queue_size = 100
+
+    def __init__(self, concurrency, queue_size=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be > 0, got {0!r}'.format(
+                concurrency))
+        if queue_size is not None:
+            if queue_size < 0:
+                raise ValueError('queue_size must be >= 0, got {0!r}'.format(
+                    queue_size))
+            self.queue_size = queue_size
+        self.concurrency = concurrency
+        self._running = 0
+        self._waiting = deque()
+        self._rejected = 0
+
+    @property
+    def full(self):
+        return (self._running >= self.concurrency and
+                len(self._waiting) >= self.queue_size)
+
+    @property
+    def queued(self):
+        return len(self._waiting)
+
+    def reject(self):
+        self._rejected += 1
+
+    def admit(self, request):
+        """True if the request can be scheduled now, else it waits."""
+        if self._running < self.concurrency:
+            self._running += 1
+            return True
+        self._waiting.append(request)
+        return False
+
+    def release(self):
+        """Returns the next request to schedule, if one was waiting."""
+        if self._waiting:
+            return self._waiting.popleft()
+        self._running -= 1
+        return None
+
+    @property
+    def stats(self):
+        return {'concurrency': self.concurrency,
+                'queue_size': self.queue_size,
+                'running': self._running,
+                'queued': len(self._waiting),
+                'rejected': self._rejected}
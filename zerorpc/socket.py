@@ -45,6 +45,22 @@ class SocketBase(object):
     def disconnect(self, endpoint, resolve=True):
         return self._events.disconnect(endpoint, resolve)
 
+    def enable_batching(self, max_bytes=65536, delay=0):
+        self._events.enable_batching(max_bytes, delay)
+
+    def enable_fair_queuing(self, quantum=16384, weights=None):
+        self._events.enable_fair_queuing(quantum, weights)
+
+    def enable_fragmentation(self, max_size=65536):
+        self._events.enable_fragmentation(max_size)
+
+    def enable_transport_heartbeat(self, interval=1, timeout=None):
+        self._events.enable_transport_heartbeat(interval, timeout)
+
+    @property
+    def send_stats(self):
+        return self._events.send_stats
+
     @property
     def debug(self):
         return self._events.debug
@@ -52,3 +68,35 @@ class SocketBase(object):
     @debug.setter
     def debug(self, v):
         self._events.debug = v
+
+    @property
+    def encoding(self):
+        return self._events.encoding
+
+    @encoding.setter
+    def encoding(self, v):
+        self._events.encoding = v
+
+    @property
+    def oob_threshold(self):
+        return self._events.oob_threshold
+
+    @oob_threshold.setter
+    def oob_threshold(self, v):
+        self._events.oob_threshold = v
+
+    @property
+    def compression(self):
+        return self._events.compression
+
+    @compression.setter
+    def compression(self, v):
+        self._events.compression = v
+
+    @property
+    def compress_threshold(self):
+        return self._events.compress_threshold
+
+    @compress_threshold.setter
+    def compress_threshold(self, v):
+        self._events.compress_threshold = v
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2015 François-Xavier Bourlet (bombela+zerorpc@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from __future__ import absolute_import
+
+import sys
+import gevent
+import gevent.hub
+
+from .exceptions import TimeoutExpired
+
+
+class Timer(object):
+    """A timer armed on a TimerWheel, see TimerWheel.arm."""
+
+    __slots__ = ('_wheel', '_tick', '_callback', '_args', '_slot',
+            '_cancelled')
+
+    def __init__(self, wheel, tick, callback, args):
+        self._wheel = wheel
+        self._tick = tick
+        self._callback = callback
+        self._args = args
+        self._slot = None
+        self._cancelled = False
+
+    @property
+    def active(self):
+        return self._slot is not None
+
+    def cancel(self):
+        # Also stops a timer expiring with others, before its turn comes.
+        self._cancelled = True
+        slot = self._slot
+        if slot is not None:
+            self._slot = None
+            del slot[self]
+            self._wheel._active -= 1
+            self._wheel._stop_if_idle()
+
+
+class _WheelTimeout(object):
+
+    __slots__ = ('_wheel', '_seconds', '_exception', '_timer')
+
+    def __init__(self, wheel, seconds, exception):
+        self._wheel = wheel
+        self._seconds = seconds
+        self._exception = exception
+        self._timer = None
+
+    def __enter__(self):
+        if self._seconds is not None:
+            exception = self._exception
+            if exception is None:
+                exception = TimeoutExpired(self._seconds)
+            self._timer = self._wheel.arm(self._seconds,
+                    gevent.getcurrent().throw, exception)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class TimerWheel(object):
+    """Coarse timers, shared by everything running on a Context.
+
+    Timers are hashed by expiry tick (`resolution` seconds) in a ring of
+    `slots` sets: arming and cancelling are O(1), and all the timers of a
+    tick expire together, from a single event loop timer set for the next
+    tick with timers (the loop doesn't wake up for the empty ones, nor at
+    all once no timer is armed). Callbacks run in the event loop, like the
+    ones of gevent timers: they must not block.
+
+    Expiry is rounded up to the next tick. A wheel belongs to the hub (the
+    thread) which created it, see Context.timer_wheel.
+
+    """
+
+    def __init__(self, resolution=0.01, slots=512):
+        self._resolution = resolution
+        self._slots = [{} for i in range(slots)]
+        self._loop = gevent.get_hub().loop
+        self._tick = self._current_tick()
+        self._active = 0
+        self._expired = 0
+        self._driver = None
+        self._driver_tick = None
+
+    def _current_tick(self):
+        # (not a tick early when the loop wakes up right on it)
+        return int(self._loop.now() / self._resolution + 1e-6)
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @property
+    def active(self):
+        """Number of armed timers."""
+        return self._active
+
+    @property
+    def stats(self):
+        return {'active': self._active, 'expired': self._expired}
+
+    def arm(self, seconds, callback, *args):
+        """Call `callback(*args)` in `seconds`, returns a Timer."""
+        if self._driver is None:
+            # Ticks are only counted while the driver runs.
+            self._loop.update_now()
+            self._tick = self._current_tick()
+        ticks = max(1, -int(-seconds // self._resolution))
+        timer = Timer(self, max(self._tick, self._current_tick()) + ticks,
+                callback, args)
+        slot = self._slots[timer._tick % len(self._slots)]
+        slot[timer] = None
+        timer._slot = slot
+        self._active += 1
+        if self._driver is None or timer._tick < self._driver_tick:
+            self._start_driver(timer._tick)
+        return timer
+
+    def _start_driver(self, tick):
+        if self._driver is not None:
+            self._driver.stop()
+        delay = max(0, tick * self._resolution - self._loop.now())
+        self._driver = self._loop.timer(delay)
+        self._driver_tick = tick
+        self._driver.start(self._expire)
+
+    def _next_tick(self):
+        # The earliest tick with a timer: the first slot of the ring after
+        # the current tick holding a timer for this turn, or else the
+        # earliest of the next turns.
+        slots = self._slots
+        earliest = None
+        for tick in range(self._tick + 1, self._tick + len(slots) + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            first = min(timer._tick for timer in slot)
+            if first == tick:
+                return tick
+            if earliest is None or first < earliest:
+                earliest = first
+        return earliest
+
+    def timeout(self, seconds, exception=None):
+        """Like gevent.Timeout, a context manager raising `exception`
+        (TimeoutExpired by default) in the current greenlet after `seconds`.
+        None means no timeout."""
+        return _WheelTimeout(self, seconds, exception)
+
+    def sleep(self, seconds):
+        waiter = gevent.hub.Waiter()
+        timer = self.arm(seconds, waiter.switch, None)
+        try:
+            waiter.get()
+        finally:
+            timer.cancel()
+
+    def _stop_if_idle(self):
+        if self._active == 0 and self._driver is not None:
+            self._driver.stop()
+            self._driver = None
+            self._driver_tick = None
+
+    def _expire(self):
+        self._driver = None
+        now = self._current_tick()
+        slots = self._slots
+        # After a long stall, a single pass over the ring is enough.
+        first = max(self._tick + 1, now - len(slots) + 1)
+        self._tick = now
+        for tick in range(first, now + 1):
+            slot = slots[tick % len(slots)]
+            if not slot:
+                continue
+            expired = [timer for timer in slot if timer._tick <= now]
+            for timer in expired:
+                del slot[timer]
+                timer._slot = None
+            self._active -= len(expired)
+            self._expired += len(expired)
+            for timer in expired:
+                if timer._cancelled:
+                    continue
+                try:
+                    timer._callback(*timer._args)
+                except Exception:
+                    gevent.get_hub().handle_error(timer, *sys.exc_info())
+        # Callbacks arming timers might have set the driver for theirs.
+        if self._active:
+            self._start_driver(self._next_tick())